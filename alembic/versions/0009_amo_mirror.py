@@ -0,0 +1,116 @@
+"""Add local mirror of amoCRM leads, customers and contacts."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0009_amo_mirror"
+down_revision: Union[str, Sequence[str], None] = "0008_order_suborders"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "amo_leads",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("pipeline_id", sa.BigInteger(), nullable=True),
+        sa.Column("status_id", sa.BigInteger(), nullable=True),
+        sa.Column("price", sa.BigInteger(), nullable=True),
+        sa.Column("contact_id", sa.BigInteger(), nullable=True),
+        sa.Column(
+            "shipment_at",
+            sa.BigInteger(),
+            server_default=sa.text("0"),
+            nullable=False,
+        ),
+        sa.Column(
+            "paid_at",
+            sa.BigInteger(),
+            server_default=sa.text("0"),
+            nullable=False,
+        ),
+        sa.Column("project", sa.String(length=255), nullable=True),
+        sa.Column("amo_created_at", sa.BigInteger(), nullable=True),
+        sa.Column("amo_closed_at", sa.BigInteger(), nullable=True),
+        sa.Column("amo_updated_at", sa.BigInteger(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_amo_leads_pipeline_id", "amo_leads", ["pipeline_id"], unique=False)
+    op.create_index("ix_amo_leads_status_id", "amo_leads", ["status_id"], unique=False)
+    op.create_index("ix_amo_leads_contact_id", "amo_leads", ["contact_id"], unique=False)
+    op.create_index(
+        "ix_amo_leads_amo_updated_at",
+        "amo_leads",
+        ["amo_updated_at"],
+        unique=False,
+    )
+
+    op.create_table(
+        "amo_customers",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("status", sa.String(length=255), nullable=True),
+        sa.Column("contact_ids", sa.JSON(), nullable=False),
+        sa.Column("amo_created_at", sa.BigInteger(), nullable=True),
+        sa.Column("amo_updated_at", sa.BigInteger(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_amo_customers_amo_updated_at",
+        "amo_customers",
+        ["amo_updated_at"],
+        unique=False,
+    )
+
+    op.create_table(
+        "amo_contacts",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("customer_id", sa.BigInteger(), nullable=True),
+        sa.Column(
+            "attestate_at",
+            sa.BigInteger(),
+            server_default=sa.text("0"),
+            nullable=False,
+        ),
+        sa.Column("amo_updated_at", sa.BigInteger(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_amo_contacts_customer_id",
+        "amo_contacts",
+        ["customer_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_amo_contacts_amo_updated_at",
+        "amo_contacts",
+        ["amo_updated_at"],
+        unique=False,
+    )
+
+    op.create_table(
+        "amo_sync_state",
+        sa.Column("key", sa.String(length=64), nullable=False),
+        sa.Column("updated_from", sa.BigInteger(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("amo_sync_state")
+    op.drop_index("ix_amo_contacts_amo_updated_at", table_name="amo_contacts")
+    op.drop_index("ix_amo_contacts_customer_id", table_name="amo_contacts")
+    op.drop_table("amo_contacts")
+    op.drop_index("ix_amo_customers_amo_updated_at", table_name="amo_customers")
+    op.drop_table("amo_customers")
+    op.drop_index("ix_amo_leads_amo_updated_at", table_name="amo_leads")
+    op.drop_index("ix_amo_leads_contact_id", table_name="amo_leads")
+    op.drop_index("ix_amo_leads_status_id", table_name="amo_leads")
+    op.drop_index("ix_amo_leads_pipeline_id", table_name="amo_leads")
+    op.drop_table("amo_leads")
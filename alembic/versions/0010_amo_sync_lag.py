@@ -0,0 +1,22 @@
+"""Track amoCRM change feed lag."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0010_amo_sync_lag"
+down_revision: Union[str, Sequence[str], None] = "0009_amo_mirror"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table("amo_sync_state") as batch_op:
+        batch_op.add_column(sa.Column("lag_seconds", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("amo_sync_state") as batch_op:
+        batch_op.drop_column("lag_seconds")
@@ -0,0 +1,29 @@
+"""Store amoCRM OAuth tokens shared between workers."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0011_amo_oauth_tokens"
+down_revision: Union[str, Sequence[str], None] = "0010_amo_sync_lag"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "amo_oauth_tokens",
+        sa.Column("key", sa.String(length=64), nullable=False),
+        sa.Column("access_token", sa.Text(), nullable=True),
+        sa.Column("refresh_token", sa.Text(), nullable=True),
+        sa.Column("refresh_owner", sa.String(length=64), nullable=True),
+        sa.Column("refresh_lease_until", sa.Float(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("amo_oauth_tokens")
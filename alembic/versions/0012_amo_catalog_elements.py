@@ -0,0 +1,41 @@
+"""Add local mirror of amoCRM catalog elements used for KP pricing."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0012_amo_catalog_elements"
+down_revision: Union[str, Sequence[str], None] = "0011_amo_oauth_tokens"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "amo_catalog_elements",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("catalog_id", sa.BigInteger(), nullable=False),
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column(
+            "price",
+            sa.Numeric(precision=14, scale=2),
+            server_default=sa.text("0"),
+            nullable=False,
+        ),
+        sa.Column("amo_updated_at", sa.BigInteger(), nullable=True),
+        sa.Column("synced_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_amo_catalog_elements_catalog_id",
+        "amo_catalog_elements",
+        ["catalog_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_amo_catalog_elements_catalog_id", table_name="amo_catalog_elements")
+    op.drop_table("amo_catalog_elements")
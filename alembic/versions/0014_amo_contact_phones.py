@@ -0,0 +1,35 @@
+"""Add normalized phone to amoCRM contact index."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0014_amo_contact_phones"
+down_revision: Union[str, Sequence[str], None] = "0013_amo_write_dead_letters"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "amo_contact_phones",
+        sa.Column("phone", sa.String(length=32), nullable=False),
+        sa.Column("contact_id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.PrimaryKeyConstraint("phone", "contact_id"),
+    )
+    op.create_index(
+        "ix_amo_contact_phones_contact_id",
+        "amo_contact_phones",
+        ["contact_id"],
+        unique=False,
+    )
+    # телефоны есть только у заново прочитанных контактов: следующая
+    # синхронизация контактов начнётся с полной выгрузки
+    op.execute(sa.text("DELETE FROM amo_sync_state WHERE key = 'contacts'"))
+
+
+def downgrade() -> None:
+    op.drop_index("ix_amo_contact_phones_contact_id", table_name="amo_contact_phones")
+    op.drop_table("amo_contact_phones")
@@ -0,0 +1,26 @@
+"""Add last analytics values written back to amoCRM leads."""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0015_amo_analytics_writeback"
+down_revision: Union[str, Sequence[str], None] = "0014_amo_contact_phones"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "amo_analytics_writeback",
+        sa.Column("lead_id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("field_values", sa.JSON(), nullable=False),
+        sa.Column("written_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("lead_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("amo_analytics_writeback")
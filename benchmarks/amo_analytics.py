@@ -0,0 +1,305 @@
+"""
+Бенчмарк расчёта аналитики по сделкам на синтетических данных.
+
+Данные берутся из ``SimulatedAmoAccount`` и сразу превращаются в ``AmoLead``
+и ``AmoCustomers`` без HTTP. Прежние реализации оставлены здесь как эталон:
+с ними сравниваются и результаты, и время.
+
+Запуск::
+
+    python -m benchmarks.amo_analytics --leads 10000 --customers 3000
+    python -m benchmarks.amo_analytics --case customers --leads 100000 --customers 30000
+    python -m benchmarks.amo_analytics --case memory --leads 100000 --customers 30000
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from benchmarks.amo_simulator import SimulatedAmoAccount
+from settings.async_amo_api import (
+    AmoCustomers,
+    AmoLead,
+    AmoResult,
+    AmoResultAnalizeCustomers,
+    build_amo_results_analize_customers,
+    compute_amo_result_metrics,
+    index_customers_by_contact,
+    join_leads_with_customers,
+)
+
+logger = logging.getLogger(__name__)
+
+# прежняя группировка по покупателям на полном аккаунте шла бы часами:
+# её время оценивается по первым покупателям и пересчитывается на всех
+BASELINE_CUSTOMERS = 1_000
+
+
+@dataclass
+class LegacyAmoLead:
+    """AmoLead до перехода на __slots__ — для сравнения памяти."""
+
+    lead_id: int
+    lead_price: int | float | None
+    created_at: int | None
+    close_at: int | None
+    contact_id: int | None
+    shipment_at: str | int | None
+    clean_price: int | float = 0
+    last_buy: int | str | None = None
+    time_from_attestate: int | str | None = None
+    paid_at: int | None = None
+    project: str | None | int = None
+    pipeline_id: int | None = None
+    status_id: int | None = None
+    updated_at: int | None = None
+
+
+@dataclass
+class LegacyAmoCustomers:
+    """AmoCustomers со списком id контактов, как раньше."""
+
+    customer_id: int | None
+    created_at: int | None
+    contacts_id: list[int]
+    status: str | int | None = None
+    updated_at: int | None = None
+
+
+@dataclass
+class LegacyAmoResult:
+    lead_obj: LegacyAmoLead
+    customer_obj: LegacyAmoCustomers
+
+
+def analytics_records(
+    account: SimulatedAmoAccount,
+    lead_type: type = AmoLead,
+    customer_type: type = AmoCustomers,
+) -> tuple[list, list]:
+    """Свежие записи аккаунта: расчёт метрик меняет сделки, поэтому на каждый прогон — новые."""
+    leads = [
+        lead_type(
+            lead_id=lead.lead_id,
+            lead_price=lead.price,
+            created_at=lead.created_at,
+            close_at=lead.shipment_at,
+            contact_id=lead.contact_id,
+            shipment_at=lead.shipment_at,
+            paid_at=lead.paid_at,
+            project=lead.project,
+            status_id=lead.status_id,
+        )
+        for lead in account.leads
+    ]
+    customers = [
+        customer_type(
+            customer_id=customer.customer_id,
+            created_at=customer.created_at,
+            contacts_id=list(customer.contact_ids),
+            status="Активный",
+        )
+        for customer in account.customers
+    ]
+    return leads, customers
+
+
+def join_nested(leads: list[AmoLead], customers: list[AmoCustomers]) -> list[AmoResult]:
+    """Прежний join: перебор всех покупателей для каждой сделки."""
+    result: list[AmoResult] = []
+    for lead_obj in leads:
+        lead_contact_id = lead_obj.contact_id
+        for customer_obj in customers:
+            if lead_contact_id in customer_obj.contacts_id:
+                result.append(AmoResult(lead_obj=lead_obj, customer_obj=customer_obj))
+                continue
+    return result
+
+
+def join_indexed(leads: list[AmoLead], customers: list[AmoCustomers]) -> list[AmoResult]:
+    return join_leads_with_customers(leads, index_customers_by_contact(customers))
+
+
+def compute_metrics_quadratic(result: list[AmoResult]) -> list[AmoResult]:
+    """Прежний расчёт метрик: для каждой записи заново отбираются прошлые сделки покупателя."""
+    result = sorted(filter(lambda x: x.lead_obj.project != "Крупные заказы", result), key=lambda x: x.lead_obj.shipment_at)
+
+    for index, record in enumerate(result):
+        current_lead = record.lead_obj
+        current_customer = record.customer_obj
+
+        try:
+            if current_customer.created_at and current_lead.shipment_at and current_lead.shipment_at > current_customer.created_at:
+                current_lead.time_from_attestate = current_lead.shipment_at - current_customer.created_at
+            else:
+                current_lead.time_from_attestate = None
+        except BaseException as error:
+            current_lead.time_from_attestate = None
+            logger.error(error)
+
+        if index != 0:
+            records_by_customer = list(filter(lambda x: x.customer_obj.customer_id == current_customer.customer_id, result[:index]))
+            if records_by_customer:
+                clean_price = sum(record.lead_obj.price for record in records_by_customer)
+                current_lead.clean_price = clean_price
+                try:
+                    if current_lead.shipment_at and records_by_customer[-1].lead_obj.shipment_at:
+                        current_lead.last_buy = current_lead.shipment_at - records_by_customer[-1].lead_obj.shipment_at
+                    else:
+                        current_lead.last_buy = 0
+                except BaseException as error:
+                    current_lead.last_buy = 0
+                    logger.error(error)
+            else:
+                current_lead.clean_price = 0
+                current_lead.last_buy = 0
+
+    return sorted(result, key=lambda x: x.lead_obj.lead_id)
+
+
+def group_customers_nested(
+    leads: list[AmoLead],
+    customers: list[AmoCustomers],
+) -> list[AmoResultAnalizeCustomers]:
+    """Прежняя группировка: перебор всех сделок для каждого покупателя."""
+    result: list[AmoResultAnalizeCustomers] = []
+    leads = [lead for lead in leads if lead.project != "Крупные заказы"]
+    for customer_obj in customers:
+        res = AmoResultAnalizeCustomers(customer_obj=customer_obj, lead_list=[])
+        for lead_obj in leads:
+            if lead_obj.contact_id in customer_obj.contacts_id:
+                res.lead_list.append(lead_obj)
+        result.append(res)
+    return result
+
+
+def customer_groups(results: list[AmoResultAnalizeCustomers]) -> list[tuple[int | None, list[int]]]:
+    return [(result.customer_obj.customer_id, [lead.lead_id for lead in result.lead_list]) for result in results]
+
+
+def metrics_snapshot(results: list[AmoResult]) -> list[tuple]:
+    return [
+        (
+            result.lead_obj.lead_id,
+            result.customer_obj.customer_id,
+            result.lead_obj.clean_price,
+            result.lead_obj.last_buy,
+            result.lead_obj.time_from_attestate,
+        )
+        for result in results
+    ]
+
+
+def measure(function: Callable[[], object], repeat: int) -> tuple[float, object]:
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started_at)
+    return min(timings), result
+
+
+def join_pairs(results: list[AmoResult]) -> list[tuple[int, int | None]]:
+    return [(result.lead_obj.lead_id, result.customer_obj.customer_id) for result in results]
+
+
+def run_join(account: SimulatedAmoAccount, repeat: int) -> dict[str, float]:
+    leads, customers = analytics_records(account)
+    nested_time, nested = measure(lambda: join_nested(leads, customers), 1)
+    indexed_time, indexed = measure(lambda: join_indexed(leads, customers), repeat)
+    assert join_pairs(nested) == join_pairs(indexed)
+    return {"вложенные циклы": nested_time, "индекс contact_id": indexed_time}
+
+
+def run_metrics(account: SimulatedAmoAccount, repeat: int) -> dict[str, float]:
+    leads, customers = analytics_records(account)
+    matched = join_indexed(leads, customers)
+    quadratic_time, quadratic = measure(lambda: compute_metrics_quadratic(matched), 1)
+    expected = metrics_snapshot(quadratic)
+    one_pass_time, one_pass = measure(lambda: compute_amo_result_metrics(matched), repeat)
+    assert metrics_snapshot(one_pass) == expected
+    return {"пересборка списков": quadratic_time, "один проход": one_pass_time}
+
+
+def run_customers(account: SimulatedAmoAccount, repeat: int) -> dict[str, float]:
+    leads, customers = analytics_records(account)
+    sample = customers[:BASELINE_CUSTOMERS]
+    nested_time, nested = measure(lambda: group_customers_nested(leads, sample), 1)
+    nested_time *= len(customers) / max(len(sample), 1)
+    grouped_time, grouped = measure(lambda: build_amo_results_analize_customers(leads, customers), repeat)
+    assert customer_groups(nested) == customer_groups(grouped[:len(sample)])
+    label = "перебор сделок" if len(sample) == len(customers) else "перебор (оценка)"
+    return {label: nested_time, "группы по контакту": grouped_time}
+
+
+def records_memory(account: SimulatedAmoAccount, lead_type: type, customer_type: type, result_type: type) -> int:
+    """Сколько байт занимают записи сделок, покупателей и результаты join по данным tracemalloc."""
+    tracemalloc.start()
+    try:
+        leads, customers = analytics_records(account, lead_type, customer_type)
+        by_contact: dict[int, list] = {}
+        for customer in customers:
+            for contact_id in customer.contacts_id:
+                by_contact.setdefault(contact_id, []).append(customer)
+        results = [
+            result_type(lead_obj=lead, customer_obj=customer)
+            for lead in leads
+            for customer in by_contact.get(lead.contact_id, ())
+        ]
+        del by_contact
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del leads, customers, results
+    return current
+
+
+def run_memory(account: SimulatedAmoAccount, repeat: int) -> dict[str, float]:
+    return {
+        "dataclass + list": records_memory(account, LegacyAmoLead, LegacyAmoCustomers, LegacyAmoResult),
+        "slots + array": records_memory(account, AmoLead, AmoCustomers, AmoResult),
+    }
+
+
+CASES: dict[str, Callable[[SimulatedAmoAccount, int], dict[str, float]]] = {
+    "join": run_join,
+    "metrics": run_metrics,
+    "customers": run_customers,
+}
+# случаи, которые меряют память в байтах, а не время
+MEMORY_CASES: dict[str, Callable[[SimulatedAmoAccount, int], dict[str, float]]] = {
+    "memory": run_memory,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--leads", type=int, default=10_000)
+    parser.add_argument("--customers", type=int, default=3_000)
+    parser.add_argument("--case", choices=(*CASES, *MEMORY_CASES, "all"), default="all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    account = SimulatedAmoAccount.generate(args.leads, args.customers, seed=args.seed)
+    print(f"{len(account.leads)} сделок, {len(account.customers)} покупателей")
+    all_cases = {**CASES, **MEMORY_CASES}
+    cases = all_cases if args.case == "all" else {args.case: all_cases[args.case]}
+    for name, run_case in cases.items():
+        values = run_case(account, args.repeat)
+        baseline = next(iter(values.values()))
+        for variant, value in values.items():
+            if name in MEMORY_CASES:
+                print(f"{name:<10} {variant:<20} {value / 2**20:10.1f} MiB x{baseline / value:7.1f}")
+            else:
+                print(f"{name:<10} {variant:<20} {value * 1000:10.1f} ms  x{baseline / value:7.1f}")
+
+
+if __name__ == "__main__":
+    main()
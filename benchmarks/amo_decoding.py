@@ -0,0 +1,142 @@
+"""
+Микробенчмарк разбора страниц сделок amoCRM.
+
+Сравнивает прежний путь (``httpx.Response.json()``: байты → строка →
+``json.loads``) с новым (``orjson`` прямо из байтов). В обоих случаях
+элементы страницы сразу превращаются в ``AmoLead``, как в ``_iter_pages``.
+
+Запуск::
+
+    python -m benchmarks.amo_decoding --pages 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from collections.abc import Callable
+
+import orjson
+
+from settings.amo_decoding import decode_embedded
+from settings.async_amo_api import AmoCRMWrapperAsync
+
+PAGE_SIZE = 250
+EXTRA_FIELDS = 25
+
+
+def make_leads_page(page: int, rng: random.Random) -> bytes:
+    """Страница /api/v4/leads, похожая на боевую: десятки доп. полей и вложения."""
+    leads = []
+    for index in range(PAGE_SIZE):
+        lead_id = page * PAGE_SIZE + index
+        custom_fields = [
+            {
+                "field_id": 900000 + field,
+                "field_name": f"Поле {field}",
+                "field_code": None,
+                "field_type": "text",
+                "values": [{"value": f"Значение {rng.randint(0, 10_000)}"}],
+            }
+            for field in range(EXTRA_FIELDS)
+        ]
+        custom_fields += [
+            {"field_id": 935651, "field_name": "Дата отгрузки", "field_type": "date", "values": [{"value": 1_700_000_000 + lead_id}]},
+            {"field_id": 1104770, "field_name": "Дата оплаты", "field_type": "date", "values": [{"value": 1_700_000_000 + lead_id}]},
+            {"field_id": 938609, "field_name": "Проект", "field_type": "select", "values": [{"value": "Розница", "enum_id": 1}]},
+        ]
+        rng.shuffle(custom_fields)
+        leads.append(
+            {
+                "id": lead_id,
+                "name": f"Сделка #{lead_id}",
+                "price": rng.randint(1_000, 500_000),
+                "responsible_user_id": 6390936,
+                "group_id": 0,
+                "status_id": 142,
+                "pipeline_id": 1628622,
+                "created_by": 0,
+                "updated_by": 0,
+                "created_at": 1_690_000_000 + lead_id,
+                "updated_at": 1_700_000_000 + lead_id,
+                "closed_at": 1_700_000_000 + lead_id,
+                "is_deleted": False,
+                "custom_fields_values": custom_fields,
+                "account_id": 1,
+                "_links": {"self": {"href": f"https://example.amocrm.ru/api/v4/leads/{lead_id}"}},
+                "_embedded": {
+                    "tags": [{"id": 1, "name": "Розница"}],
+                    "contacts": [
+                        {"id": lead_id + 10_000_000, "is_main": True, "_links": {"self": {"href": "https://example.amocrm.ru/api/v4/contacts/1"}}},
+                    ],
+                },
+            }
+        )
+    return json.dumps({"_page": page, "_embedded": {"leads": leads}}, ensure_ascii=False).encode()
+
+
+def decode_baseline(pages: list[bytes]) -> list:
+    """Прежний путь: строка из байтов и json.loads."""
+    leads = []
+    for content in pages:
+        payload = json.loads(content.decode("utf-8"))
+        leads.extend(
+            AmoCRMWrapperAsync._lead_from_payload(lead)
+            for lead in payload.get("_embedded", {}).get("leads", [])
+        )
+    return leads
+
+
+def decode_slim(pages: list[bytes]) -> list:
+    """Новый путь: orjson из байтов без промежуточной строки."""
+    leads = []
+    for content in pages:
+        leads.extend(AmoCRMWrapperAsync._lead_from_payload(lead) for lead in decode_embedded(content, "leads"))
+    return leads
+
+
+def measure(decode: Callable[[list[bytes]], list], pages: list[bytes], repeat: int) -> tuple[float, int]:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        decode(pages)
+        timings.append(time.perf_counter() - started_at)
+
+    tracemalloc.start()
+    decode(pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+
+def run(pages_count: int = 40, repeat: int = 3, seed: int = 1) -> dict[str, tuple[float, int]]:
+    rng = random.Random(seed)
+    pages = [make_leads_page(page, rng) for page in range(pages_count)]
+    assert decode_baseline(pages[:1]) == decode_slim(pages[:1])
+    return {
+        "json.loads": measure(decode_baseline, pages, repeat),
+        "orjson": measure(decode_slim, pages, repeat),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=40, help="страниц по 250 сделок")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.pages, args.repeat)
+    print(f"orjson {orjson.__version__}, {args.pages * PAGE_SIZE} сделок")
+    baseline_time, baseline_peak = next(iter(results.values()))
+    for name, (elapsed, peak) in results.items():
+        print(
+            f"{name:<12} {elapsed * 1000:8.1f} ms  x{baseline_time / elapsed:4.1f}"
+            f"  peak {peak / 2**20:7.1f} MiB  x{baseline_peak / peak:4.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
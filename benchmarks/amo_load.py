@@ -0,0 +1,250 @@
+"""
+Нагрузочный прогон клиента amoCRM на имитированном аккаунте.
+
+Аналитика (``analyze_and_send_to_sheets``) и поток КП идут через настоящий
+``AmoCRMWrapperAsync`` с ограничителем, кэшами и повторами, но вместо сети —
+``SimulatedAmoTransport`` с задержкой ответа и лимитом запросов в секунду.
+Для каждого сценария печатаются время, число запросов по видам и ответам,
+пиковая память (tracemalloc) и задержка цикла событий: насколько позже срока
+просыпается задача, которая спит по 10 мс.
+
+Запуск::
+
+    python -m benchmarks.amo_load --leads 100000 --customers 30000
+    python -m benchmarks.amo_load --scenario analytics --analytics-workers 1
+    python -m benchmarks.amo_load --scenario kp --kp-requests 200 --mirror
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+
+import jwt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.amo_simulator import CATALOG_ID, SimulatedAmoAccount, SimulatedAmoTransport
+from models import Base
+from services.amo_catalog import get_priced_catalog_elements
+from settings.amo_decoding import custom_field_values
+from settings.async_amo_api import (
+    ENTITY_FIELD_IDS,
+    LEAD_DISCOUNT_FIELD_ID,
+    AmoCRMWrapperAsync,
+)
+from utils.analytics import analyze_and_send_to_sheets
+from utils.analytics_pool import AnalyticsPool
+from utils.loop_lag import LoopLagMonitor
+from utils.utils import build_kp_items, get_catalog_elements_from_lead, get_items_to_kp
+
+SCENARIOS = ("analytics", "kp")
+LOOP_LAG_INTERVAL = 0.01
+
+
+class FakeGoogleSheets:
+    """Вебхук Google Sheets, который только считает строки."""
+
+    def __init__(self) -> None:
+        self.rows = 0
+
+    def send_json(self, payload, token, request_id, chunk=None, last=None):
+        self.rows += len(payload)
+        return SimpleNamespace(status_code=200, text="ok")
+
+
+@dataclass
+class LoadResult:
+    scenario: str
+    elapsed: float
+    peak_memory: int
+    requests: int
+    by_endpoint: dict[str, int] = field(default_factory=dict)
+    statuses: dict[int, int] = field(default_factory=dict)
+    details: str = ""
+    max_loop_lag: float = 0.0
+    mean_loop_lag: float = 0.0
+
+
+def make_client(transport: SimulatedAmoTransport, client_rps: float, env_path: Path) -> AmoCRMWrapperAsync:
+    token = jwt.encode({"exp": int(time.time() + 24 * 3600)}, "simulated", algorithm="HS256")
+    return AmoCRMWrapperAsync(
+        path=str(env_path),
+        amocrm_subdomain="simulated",
+        amocrm_client_id="client-id",
+        amocrm_client_secret="client-secret",
+        amocrm_redirect_url="https://example.test/oauth",
+        amocrm_access_token=token,
+        amocrm_refresh_token="refresh-token",
+        amocrm_secret_code="secret-code",
+        requests_per_second=client_rps,
+        burst=max(1, int(client_rps)),
+        max_concurrency=max(1, int(client_rps)),
+        transport=transport,
+    )
+
+
+async def run_analytics(amo_api: AmoCRMWrapperAsync, session_factory, analytics_pool: AnalyticsPool | None) -> str:
+    sheets = FakeGoogleSheets()
+    await analyze_and_send_to_sheets(
+        amo_api=amo_api,
+        google_sheets=sheets,
+        token="simulated",
+        request_id="load",
+        session_factory=session_factory,
+        analytics_pool=analytics_pool,
+    )
+    return f"rows={sheets.rows}"
+
+
+async def build_kp(amo_api: AmoCRMWrapperAsync, session_factory, lead_id: int) -> list[dict]:
+    """Обращения к amoCRM и расчёт строк, как в маршруте /kp, без рендеринга HTML."""
+    lead_response = await amo_api.get_lead_with_catalog_elements(lead_id=lead_id)
+    lead_catalog_elements = get_catalog_elements_from_lead(lead_response)
+    discount = int(custom_field_values(lead_response, ENTITY_FIELD_IDS["leads"]).get(LEAD_DISCOUNT_FIELD_ID, 0))
+    await amo_api.get_responsible_user_by_id(lead_response.get("responsible_user_id"))
+    if session_factory is not None:
+        priced_elements = await get_priced_catalog_elements(
+            amo_api, session_factory, CATALOG_ID, lead_catalog_elements.keys()
+        )
+        return build_kp_items(priced_elements, lead_catalog_elements, discount=discount)
+    catalogs_elements_response = await amo_api.get_catalogs_elements(
+        catalog_id=CATALOG_ID,
+        elements=lead_catalog_elements,
+    )
+    return get_items_to_kp(catalogs_elements_response, lead_catalog_elements, discount=discount)
+
+
+async def run_kp(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory,
+    account: SimulatedAmoAccount,
+    requests_count: int,
+    concurrency: int,
+    seed: int,
+) -> str:
+    rng = random.Random(seed)
+    lead_ids = [rng.choice(account.leads).lead_id for _ in range(requests_count)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one(lead_id: int) -> int:
+        async with semaphore:
+            started_at = time.perf_counter()
+            items = await build_kp(amo_api, session_factory, lead_id)
+            latencies.append(time.perf_counter() - started_at)
+            return len(items)
+
+    items = await asyncio.gather(*(one(lead_id) for lead_id in lead_ids))
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    return f"kp={len(items)}, lines={sum(items)}, p50={latencies[len(latencies) // 2] * 1000:.0f} ms, p95={p95 * 1000:.0f} ms"
+
+
+async def run_scenario(scenario: str, account: SimulatedAmoAccount, args: argparse.Namespace) -> LoadResult:
+    transport = SimulatedAmoTransport(
+        account,
+        requests_per_second=args.rps,
+        latency=args.latency,
+        jitter=args.jitter,
+        seed=args.seed,
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        session_factory = None
+        engine = None
+        if args.mirror:
+            engine = create_engine(f"sqlite:///{(Path(temp_dir) / 'mirror.db').as_posix()}")
+            Base.metadata.create_all(engine)
+            session_factory = sessionmaker(bind=engine, expire_on_commit=False)
+
+        analytics_pool = AnalyticsPool(args.analytics_workers) if args.analytics_workers > 0 else None
+        loop_lag = LoopLagMonitor(interval=LOOP_LAG_INTERVAL, warning=0)
+        loop_lag_task = asyncio.create_task(loop_lag.run())
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        try:
+            async with make_client(transport, args.client_rps, Path(temp_dir) / "amo.env") as amo_api:
+                if scenario == "analytics":
+                    details = await run_analytics(amo_api, session_factory, analytics_pool)
+                else:
+                    details = await run_kp(
+                        amo_api, session_factory, account, args.kp_requests, args.kp_concurrency, args.seed
+                    )
+            elapsed = time.perf_counter() - started_at
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            loop_lag_task.cancel()
+            if analytics_pool is not None:
+                analytics_pool.shutdown()
+            if engine is not None:
+                engine.dispose()
+
+    stats = transport.stats()
+    return LoadResult(
+        scenario=scenario,
+        elapsed=elapsed,
+        peak_memory=peak,
+        requests=stats["requests"],
+        by_endpoint=stats["by_endpoint"],
+        statuses=stats["statuses"],
+        details=details,
+        max_loop_lag=loop_lag.max_lag,
+        mean_loop_lag=loop_lag.stats()["mean_lag"],
+    )
+
+
+def print_result(result: LoadResult) -> None:
+    print(
+        f"{result.scenario:<10} {result.elapsed:8.2f} s  requests {result.requests:6d}"
+        f"  peak {result.peak_memory / 2**20:7.1f} MiB  {result.details}"
+    )
+    print(
+        f"{'':<10} задержка цикла событий: max {result.max_loop_lag * 1000:.0f} ms,"
+        f" в среднем {result.mean_loop_lag * 1000:.1f} ms"
+    )
+    print(f"{'':<10} статусы: {dict(sorted(result.statuses.items()))}")
+    for endpoint, count in sorted(result.by_endpoint.items(), key=lambda item: -item[1]):
+        print(f"{'':<10} {count:6d}  {endpoint}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--leads", type=int, default=100_000)
+    parser.add_argument("--customers", type=int, default=30_000)
+    parser.add_argument("--scenario", choices=(*SCENARIOS, "all"), default="all")
+    parser.add_argument("--rps", type=int, default=7, help="лимит запросов в секунду на стороне amoCRM")
+    parser.add_argument("--client-rps", type=float, default=7.0, help="ограничитель клиента")
+    parser.add_argument("--latency", type=float, default=0.08, help="задержка ответа, секунд")
+    parser.add_argument("--jitter", type=float, default=0.04, help="случайная добавка к задержке, секунд")
+    parser.add_argument("--kp-requests", type=int, default=100)
+    parser.add_argument("--kp-concurrency", type=int, default=10)
+    parser.add_argument("--mirror", action="store_true", help="читать через локальное зеркало во временной SQLite")
+    parser.add_argument(
+        "--analytics-workers",
+        type=int,
+        default=0,
+        help="процессов для расчёта аналитики; 0 — в цикле событий",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    account = SimulatedAmoAccount.generate(args.leads, args.customers, seed=args.seed)
+    print(
+        f"Аккаунт: {len(account.leads)} сделок, {len(account.customers)} покупателей; "
+        f"amoCRM {args.rps} rps, клиент {args.client_rps} rps, задержка {args.latency * 1000:.0f} ms"
+    )
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    for scenario in scenarios:
+        print_result(asyncio.run(run_scenario(scenario, account, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+Имитация аккаунта amoCRM для нагрузочных прогонов клиента без сети.
+
+``SimulatedAmoAccount`` генерирует воспроизводимый по seed аккаунт: сделки
+воронки аналитики, покупателей с контактами, каталог товаров и пользователей.
+Страницы собираются по запросу из компактных записей, поэтому даже 100k
+сделок занимают в памяти мало места.
+
+``SimulatedAmoTransport`` — ``httpx.AsyncBaseTransport``, который отвечает
+как amoCRM: пагинация ``limit``/``page``, фильтры ``filter[id][]`` и
+``filter[updated_at][from]``, 204 на пустой странице, задержка ответа и
+ограничение запросов в секунду с ответом 429 и ``Retry-After``, как у
+настоящего API.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import random
+from collections import Counter, deque
+from dataclasses import dataclass, field
+
+import httpx
+import orjson
+
+from settings.async_amo_api import (
+    AMO_WRITE_ENDPOINTS,
+    ANALYTICS_PIPELINE_ID,
+    ANALYTICS_STATUS_IDS,
+    CUSTOMER_STATUS_FIELD_ID,
+    LEAD_DELIVERY_FIELD_ID,
+    LEAD_DISCOUNT_FIELD_ID,
+    LEAD_PAID_AT_FIELD_ID,
+    LEAD_PROJECT_FIELD_ID,
+    LEAD_SHIPMENT_AT_FIELD_ID,
+)
+
+CONTACT_ID_OFFSET = 10_000_000
+CATALOG_ID = 1682
+MANAGER_IDS = (6390936, 10353813, 11047749)
+PROJECTS = ("Розница", "Опт", "Крупные заказы")
+# у боевых сделок десятки доп. полей, которые аналитике не нужны
+EXTRA_FIELDS = 25
+BASE_TIME = 1_690_000_000
+WRITE_EMBEDDED_KEYS = {endpoint: embedded_key for endpoint, embedded_key in AMO_WRITE_ENDPOINTS.values()}
+
+
+@dataclass(slots=True)
+class SimulatedLead:
+    lead_id: int
+    contact_id: int
+    price: int
+    status_id: int
+    created_at: int
+    shipment_at: int
+    paid_at: int
+    project: str
+    catalog_elements: tuple[tuple[int, int], ...]
+
+
+@dataclass(slots=True)
+class SimulatedCustomer:
+    customer_id: int
+    created_at: int
+    contact_ids: tuple[int, ...]
+
+
+@dataclass
+class SimulatedAmoAccount:
+    leads: list[SimulatedLead]
+    customers: list[SimulatedCustomer]
+    catalog_prices: dict[int, int]
+    updated_at: int = BASE_TIME + 50_000_000
+    leads_by_id: dict[int, SimulatedLead] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.leads_by_id = {lead.lead_id: lead for lead in self.leads}
+
+    @classmethod
+    def generate(
+        cls,
+        leads: int = 100_000,
+        customers: int = 30_000,
+        *,
+        catalog_size: int = 2_000,
+        seed: int = 1,
+    ) -> "SimulatedAmoAccount":
+        """
+        Аккаунт из leads сделок и customers покупателей. У покупателя один-два
+        контакта; около 70% сделок оформлены на контакты покупателей, остальные —
+        на случайных контактов без покупателя.
+        """
+        rng = random.Random(seed)
+        generated_customers = []
+        contact_id = CONTACT_ID_OFFSET
+        for customer_id in range(1, customers + 1):
+            contacts_count = 1 if rng.random() < 0.8 else 2
+            generated_customers.append(
+                SimulatedCustomer(
+                    customer_id=customer_id,
+                    created_at=BASE_TIME + rng.randint(0, 40_000_000),
+                    contact_ids=tuple(range(contact_id, contact_id + contacts_count)),
+                )
+            )
+            contact_id += contacts_count
+        customer_contacts = contact_id - CONTACT_ID_OFFSET
+
+        generated_leads = []
+        for lead_id in range(1, leads + 1):
+            if customer_contacts and rng.random() < 0.7:
+                lead_contact_id = CONTACT_ID_OFFSET + rng.randrange(customer_contacts)
+            else:
+                lead_contact_id = contact_id + rng.randrange(max(leads, 1))
+            created_at = BASE_TIME + rng.randint(0, 45_000_000)
+            generated_leads.append(
+                SimulatedLead(
+                    lead_id=lead_id,
+                    contact_id=lead_contact_id,
+                    price=rng.randint(1_000, 500_000),
+                    status_id=rng.choice(ANALYTICS_STATUS_IDS),
+                    created_at=created_at,
+                    shipment_at=created_at + rng.randint(86_400, 30 * 86_400),
+                    paid_at=created_at + rng.randint(0, 10 * 86_400),
+                    project=rng.choices(PROJECTS, weights=(70, 25, 5))[0],
+                    catalog_elements=tuple(
+                        (rng.randint(1, catalog_size), rng.randint(1, 20)) for _ in range(rng.randint(1, 8))
+                    ),
+                )
+            )
+
+        catalog_prices = {element_id: rng.randint(100, 50_000) for element_id in range(1, catalog_size + 1)}
+        return cls(leads=generated_leads, customers=generated_customers, catalog_prices=catalog_prices)
+
+    # ---------- сущности в формате amoCRM ----------
+
+    def lead_payload(self, lead: SimulatedLead, *, with_catalog: bool = False) -> dict:
+        custom_fields = [
+            {"field_id": 900000 + index, "field_type": "text", "values": [{"value": f"Значение {index}"}]}
+            for index in range(EXTRA_FIELDS)
+        ]
+        custom_fields += [
+            {"field_id": LEAD_SHIPMENT_AT_FIELD_ID, "field_type": "date", "values": [{"value": lead.shipment_at}]},
+            {"field_id": LEAD_PAID_AT_FIELD_ID, "field_type": "date", "values": [{"value": lead.paid_at}]},
+            {"field_id": LEAD_PROJECT_FIELD_ID, "field_type": "select", "values": [{"value": lead.project}]},
+            {"field_id": LEAD_DISCOUNT_FIELD_ID, "field_type": "numeric", "values": [{"value": lead.lead_id % 15}]},
+            {"field_id": LEAD_DELIVERY_FIELD_ID, "field_type": "numeric", "values": [{"value": 500}]},
+        ]
+        embedded: dict = {"contacts": [{"id": lead.contact_id, "is_main": True}]}
+        if with_catalog:
+            embedded["catalog_elements"] = [
+                {"id": element_id, "metadata": {"quantity": quantity, "catalog_id": CATALOG_ID}}
+                for element_id, quantity in lead.catalog_elements
+            ]
+        return {
+            "id": lead.lead_id,
+            "name": f"Сделка #{lead.lead_id}",
+            "price": lead.price,
+            "responsible_user_id": MANAGER_IDS[lead.lead_id % len(MANAGER_IDS)],
+            "status_id": lead.status_id,
+            "pipeline_id": ANALYTICS_PIPELINE_ID,
+            "created_at": lead.created_at,
+            "updated_at": self.updated_at,
+            "closed_at": lead.shipment_at,
+            "custom_fields_values": custom_fields,
+            "_embedded": embedded,
+        }
+
+    def customer_payload(self, customer: SimulatedCustomer) -> dict:
+        return {
+            "id": customer.customer_id,
+            "created_at": customer.created_at,
+            "updated_at": self.updated_at,
+            "custom_fields_values": [
+                {"field_id": CUSTOMER_STATUS_FIELD_ID, "values": [{"value": "Активный"}]},
+            ],
+            "_embedded": {"contacts": [{"id": contact_id} for contact_id in customer.contact_ids]},
+        }
+
+    def catalog_element_payload(self, element_id: int) -> dict:
+        return {
+            "id": element_id,
+            "name": f"Товар {element_id}",
+            "updated_at": self.updated_at,
+            "custom_fields_values": [
+                {"field_code": "PRICE", "values": [{"value": self.catalog_prices[element_id]}]},
+            ],
+        }
+
+
+class SimulatedAmoTransport(httpx.AsyncBaseTransport):
+    """
+    Отвечает на запросы клиента amoCRM данными SimulatedAmoAccount.
+
+    requests_per_second — ограничение сервера: запросы сверх него за
+    скользящую секунду получают 429. latency и jitter задают задержку ответа
+    в секундах. В requests и statuses копится статистика прогона.
+    """
+
+    def __init__(
+        self,
+        account: SimulatedAmoAccount,
+        *,
+        requests_per_second: int = 7,
+        latency: float = 0.08,
+        jitter: float = 0.04,
+        seed: int = 1,
+    ) -> None:
+        self.account = account
+        self.requests_per_second = int(requests_per_second)
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.requests: Counter[str] = Counter()
+        self.statuses: Counter[int] = Counter()
+        self._rng = random.Random(seed)
+        self._recent: deque[float] = deque()
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "requests": sum(self.requests.values()),
+            "by_endpoint": dict(self.requests),
+            "statuses": dict(self.statuses),
+        }
+
+    def _over_limit(self) -> bool:
+        if self.requests_per_second <= 0:
+            return False
+        now = asyncio.get_running_loop().time()
+        while self._recent and now - self._recent[0] >= 1.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.requests_per_second:
+            return True
+        self._recent.append(now)
+        return False
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self._endpoint_name(request)
+        self.requests[endpoint] += 1
+        delay = self.latency + self._rng.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self._over_limit():
+            response = httpx.Response(429, headers={"Retry-After": "1"}, json={"title": "Too Many Requests"})
+        else:
+            response = self._route(request)
+        self.statuses[response.status_code] += 1
+        return response
+
+    @staticmethod
+    def _endpoint_name(request: httpx.Request) -> str:
+        parts = request.url.path.strip("/").split("/")
+        # /api/v4/leads/123 и /api/v4/catalogs/1682/elements считаются одним видом запроса
+        return request.method + " /" + "/".join("{id}" if part.isdigit() else part for part in parts)
+
+    def _route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        params = request.url.params
+        if request.method in ("POST", "PATCH"):
+            return self._write(request)
+
+        if path == "/api/v4/leads":
+            items = self._filter(self.account.leads, params, lambda lead: lead.lead_id)
+            return self._page(params, "leads", items, self.account.lead_payload)
+        if path == "/api/v4/customers":
+            items = self._filter(self.account.customers, params, lambda customer: customer.customer_id)
+            return self._page(params, "customers", items, self.account.customer_payload)
+        if path.startswith("/api/v4/leads/"):
+            lead = self.account.leads_by_id.get(int(path.rsplit("/", 1)[-1]))
+            if lead is None:
+                return httpx.Response(404, json={"title": "Not Found"})
+            with_catalog = "catalog_elements" in params.get("with", "")
+            return self._json(self.account.lead_payload(lead, with_catalog=with_catalog))
+        if path.startswith("/api/v4/users/"):
+            user_id = int(path.rsplit("/", 1)[-1])
+            return self._json({"id": user_id, "name": f"Менеджер {user_id}"})
+        if path == f"/api/v4/catalogs/{CATALOG_ID}/elements":
+            prices = self.account.catalog_prices
+            ids = [int(value) for value in params.get_list("filter[id][]")] or list(prices)
+            ids = [element_id for element_id in ids if element_id in prices]
+            return self._page(params, "elements", ids, self.account.catalog_element_payload)
+        # контакты, события и прочее в имитации пусты
+        return httpx.Response(204)
+
+    def _filter(self, items: list, params: httpx.QueryParams, get_id) -> list:
+        ids = params.get_list("filter[id][]")
+        if ids:
+            wanted = {int(value) for value in ids}
+            items = [item for item in items if get_id(item) in wanted]
+        updated_from = params.get("filter[updated_at][from]")
+        if updated_from is not None and int(updated_from) > self.account.updated_at:
+            return []
+        return items
+
+    def _page(self, params: httpx.QueryParams, embedded_key: str, items: list, to_payload) -> httpx.Response:
+        limit = int(params.get("limit", 50))
+        page = int(params.get("page", 1))
+        page_items = items[(page - 1) * limit:page * limit]
+        if not page_items:
+            return httpx.Response(204)
+        return self._json({"_page": page, "_embedded": {embedded_key: [to_payload(item) for item in page_items]}})
+
+    def _write(self, request: httpx.Request) -> httpx.Response:
+        entities = orjson.loads(request.content)
+        if request.url.path == "/api/v4/leads/complex":
+            return self._json([{"id": index + 1, "contact_id": index + 1} for index in range(len(entities))])
+        created = [
+            {"id": entity.get("id", index + 1), "request_id": str(index)}
+            for index, entity in enumerate(entities)
+        ]
+        embedded_key = WRITE_EMBEDDED_KEYS.get(request.url.path, request.url.path.rsplit("/", 1)[-1])
+        return self._json({"_embedded": {embedded_key: created}})
+
+    @staticmethod
+    def _json(payload: object) -> httpx.Response:
+        return httpx.Response(
+            200,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/hal+json"},
+        )
@@ -17,19 +17,43 @@ from sqlalchemy.orm import sessionmaker
 from starlette.background import BackgroundTask
 
 from models import EducationVisit
+from services.amo_catalog import get_priced_catalog_elements, run_amo_catalog_sync
+from services.amo_events import run_amo_events_consumer
+from services.amo_mirror import run_amo_mirror_sync
+from services.amo_phones import (
+    CONTACT_LOOKUP_ERRORS,
+    get_contact_by_phone,
+    reconcile_created_contact,
+    remember_contact_phones,
+    resolve_contact_id_by_phone,
+)
+from services.amo_webhooks import AmoWebhookQueue, parse_amo_webhook
+from services.amo_writes import AmoWriteQueue
 from services.moy_sklad_sync import (
     MoySkladDataError,
     MoySkladWebhookPayloadError,
     process_processing_order_webhook,
 )
 from services.test_kp_to_pdf import render_template_to_pdf
-from settings.async_amo_api import AmoCRMWrapperAsync
+from settings.amo_cache import AsyncTTLCache
+from settings.amo_tokens import create_token_store
+from settings.amo_decoding import custom_field_values
+from settings.async_amo_api import (
+    ENTITY_FIELD_IDS,
+    LEAD_DELIVERY_FIELD_ID,
+    LEAD_DISCOUNT_FIELD_ID,
+    LEAD_PROJECT_FIELD_ID,
+    AmoCRMWrapperAsync,
+)
 from settings.google_sheets import GoogleSheetsIntegration
 from settings.moy_sklad import MoySkladAPIError, MoySkladClient
 from settings.settings import load_config
 from utils.analytics import analyze_and_send_to_sheets, analyze_customers_and_send_to_sheets
+from utils.analytics_pool import AnalyticsPool
+from utils.budget_periods import parse_budget_periods
 from utils.files import cleanup_generated_file
 from utils.formatting import format_grouped_number
+from utils.loop_lag import LoopLagMonitor
 from utils.tracking import (
     get_cookie_value,
     get_tracking_value,
@@ -39,6 +63,7 @@ from utils.tracking import (
 from utils.utils import (
     Order,
     correct_phone,
+    build_kp_items,
     get_catalog_elements_from_lead,
     get_items_to_kp,
 )
@@ -76,6 +101,12 @@ app.include_router(
     )
 )
 
+amo_token_store = create_token_store(
+    config.amo_config.token_store,
+    env_path=config.amo_config.path_to_env,
+    file_path=config.amo_config.token_file,
+    session_factory=SessionLocal,
+)
 amo_api = AmoCRMWrapperAsync(
     path=config.amo_config.path_to_env,
     amocrm_subdomain=config.amo_config.amocrm_subdomain,
@@ -85,6 +116,18 @@ amo_api = AmoCRMWrapperAsync(
     amocrm_secret_code=config.amo_config.amocrm_secret_code,
     amocrm_access_token=config.amo_config.amocrm_access_token,
     amocrm_refresh_token=config.amo_config.amocrm_refresh_token,
+    requests_per_second=config.amo_config.requests_per_second,
+    burst=config.amo_config.burst,
+    max_concurrency=config.amo_config.max_concurrency,
+    page_prefetch=config.amo_config.page_prefetch,
+    token_refresh_margin=config.amo_config.token_refresh_margin,
+    token_store=amo_token_store,
+    users_cache_size=config.amo_config.users_cache_size,
+    users_cache_ttl=config.amo_config.users_cache_ttl,
+    catalog_cache_size=config.amo_config.catalog_cache_size,
+    catalog_cache_ttl=config.amo_config.catalog_cache_ttl,
+    get_reuse_ttl=config.amo_config.get_reuse_ttl,
+    get_reuse_size=config.amo_config.get_reuse_size,
 )
 
 google_sheets = (
@@ -99,6 +142,32 @@ google_sheets_customers = (
 
 
 templates.env.filters["grouped_number"] = format_grouped_number
+amo_webhook_queue = AmoWebhookQueue(batch_delay=config.amo_config.webhook_batch_delay)
+amo_write_queue = AmoWriteQueue(
+    batch_delay=config.amo_config.write_batch_delay,
+    max_attempts=config.amo_config.write_max_attempts,
+    retry_delay=config.amo_config.write_retry_delay,
+    dead_letter_limit=config.amo_config.write_dead_letter_limit,
+)
+# контакт покупателя по id заказа Маркета: повторные уведомления по заказу
+# не ищут и не создают контакт заново
+market_order_contacts = AsyncTTLCache(maxsize=1024, ttl=config.amo_config.order_contact_ttl)
+# окна clean_budjet_N аналитики по покупателям; ошибка в настройке видна при старте
+budget_periods = parse_budget_periods(config.analytics_budget_periods)
+# доп. поля сделок для записи метрик аналитики обратно в amoCRM; 0 — не писать
+analytics_field_ids = {
+    "clean_price": config.amo_config.clean_price_field_id,
+    "last_buy": config.amo_config.last_buy_field_id,
+    "time_from_attestate": config.amo_config.time_from_attestate_field_id,
+}
+# расчёт аналитики в отдельных процессах; 0 — в цикле событий, как раньше
+analytics_pool = AnalyticsPool(config.analytics_workers) if config.analytics_workers > 0 else None
+# задержка цикла событий в журнале; 0 — не измерять
+loop_lag_monitor = (
+    LoopLagMonitor(interval=config.loop_lag_interval, warning=config.loop_lag_warning)
+    if config.loop_lag_interval > 0 else None
+)
+background_tasks: list[asyncio.Task] = []
 
 
 @app.on_event("startup")
@@ -106,10 +175,58 @@ async def on_startup() -> None:
     await amo_api.open()
     await moysklad_client.open()
     # Обычно init_oauth2() НЕ вызывают на каждый старт, если токены уже сохранены в .env
+    if config.amo_config.webhook_token is None:
+        logger.warning("AMOCRM_WEBHOOK_TOKEN не задан: POST /amo/webhook отклоняет вебхуки")
+    background_tasks.append(asyncio.create_task(amo_webhook_queue.run(amo_api, SessionLocal)))
+    background_tasks.append(asyncio.create_task(amo_write_queue.run(amo_api, SessionLocal)))
+    if loop_lag_monitor is not None:
+        background_tasks.append(asyncio.create_task(loop_lag_monitor.run()))
+    if config.amo_config.events_poll_interval > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_amo_events_consumer(
+                    amo_api,
+                    SessionLocal,
+                    config.amo_config.events_poll_interval,
+                )
+            )
+        )
+    if config.amo_config.contacts_sync_interval > 0:
+        # контакты с телефонами для индекса телефон → контакт
+        background_tasks.append(
+            asyncio.create_task(
+                run_amo_mirror_sync(
+                    amo_api,
+                    SessionLocal,
+                    ("contacts",),
+                    config.amo_config.contacts_sync_interval,
+                )
+            )
+        )
+    if config.amo_config.catalog_sync_interval > 0:
+        background_tasks.append(
+            asyncio.create_task(
+                run_amo_catalog_sync(
+                    amo_api,
+                    SessionLocal,
+                    config.amo_config.kp_catalog_id,
+                    config.amo_config.catalog_sync_interval,
+                )
+            )
+        )
 
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # отложенные изменения amoCRM (включая отправляемую пачку и повторы)
+    # дописываем до закрытия клиента
+    await amo_write_queue.drain(amo_api, SessionLocal)
+    if analytics_pool is not None:
+        analytics_pool.shutdown()
     await amo_api.close()
     await moysklad_client.close()
 
@@ -129,6 +246,10 @@ async def analyze(background_tasks: BackgroundTasks, token: str, request_id: str
         google_sheets=google_sheets,
         token=token,
         request_id=request_id,
+        session_factory=SessionLocal,
+        chunk_size=config.google_sheets_chunk_size,
+        writeback_field_ids=analytics_field_ids,
+        analytics_pool=analytics_pool,
     )
     return {"status": "accepted", "request_id": request_id}
 
@@ -148,6 +269,9 @@ async def analyze(background_tasks: BackgroundTasks, token: str, request_id: str
         google_sheets_customers=google_sheets_customers,
         token=token,
         request_id=request_id,
+        session_factory=SessionLocal,
+        budget_periods=budget_periods,
+        analytics_pool=analytics_pool,
     )
     return {"status": "accepted", "request_id": request_id}
 
@@ -165,7 +289,7 @@ async def new_column_in_sheet(req: Request):
     description = payload.get("description")
     materials = payload.get("materialsLink", "")
 
-    ok, contact_data = await amo_api.get_contact_by_phone(phone)
+    ok, contact_data = await get_contact_by_phone(amo_api, SessionLocal, phone)
     if ok:
         contact_id = contact_data.get("id")
     else:
@@ -179,13 +303,14 @@ async def new_column_in_sheet(req: Request):
         )
         raise ValueError("Не получилось найти id контакта.")
 
-    resp = await amo_api.add_new_task(
+    tasks = amo_api.new_task_payloads(
         contact_id=contact_id,
         descr=description,
         url_materials=materials,
         time_value=ts,
     )
-    logger.info(resp.status_code)
+    amo_write_queue.submit_many("tasks", tasks)
+    logger.info("Задачи по обращению поставлены в очередь записи amoCRM: %s", len(tasks))
     return {"status": "ok"}
 
 
@@ -197,13 +322,14 @@ async def sheets_marketplace(req: Request):
     items = payload.get("data", {}).get("items", [])
     items = filter(lambda x: float(x.get("quantity")) >= 1, items)
 
-    result = await amo_api.add_catalog_elements_to_lead(lead_id=lead_id, elements=items)
-    logger.info(result)
+    links = amo_api.catalog_link_payloads(lead_id=lead_id, elements=items)
+    amo_write_queue.submit_many("lead_links", links)
+    logger.info("Товары сделки %s поставлены в очередь записи amoCRM: %s", lead_id, len(links))
     return {"status": "ok"}
 
 
 @app.post("/market/new_order/notification")
-async def new_order_from_yandex(req: Request):
+async def new_order_from_yandex(req: Request, background_tasks: BackgroundTasks):
     payload = await req.json()
     try:
         order_id = payload.get("orderId")
@@ -233,22 +359,52 @@ async def new_order_from_yandex(req: Request):
 
         buyer_info = (buyer_json or {}).get("result") or {}
         buyer_phone = buyer_info.get("phone")
+        phone = correct_phone(buyer_phone or "")
 
-        contact_id = await amo_api.create_new_contact(
-            first_name=order_data.buyer_firstname,
-            last_name=order_data.buyer_lastname,
-            phone=buyer_phone,
-        )
-        logger.info(f"Создан контакт id {contact_id}")
-
-        new_lead = await amo_api.send_lead_to_amo(contact_id=contact_id, order_id=order_id)
-        lead_id = (new_lead.get("_embedded") or {}).get("leads", [{}])[0].get("id")
-        logger.info(f"Создана новая сделка: {lead_id}")
-
-        await amo_api.add_new_note_to_lead(
-            lead_id=lead_id,
-            text=order_data.order_items + order_data.address,
-            order_id=order_id,
+        lookup_failed = False
+        try:
+            contact_id = await market_order_contacts.get_or_load(
+                order_id,
+                lambda: resolve_contact_id_by_phone(amo_api, SessionLocal, phone),
+                store=lambda contact_id: contact_id is not None,
+            )
+        except CONTACT_LOOKUP_ERRORS:
+            # заказ важнее возможного дубля: контакт создаётся без проверки и
+            # сверяется позже в reconcile_created_contact
+            logger.exception("Поиск контакта с телефоном %s не удался", phone)
+            contact_id = None
+            lookup_failed = True
+        if contact_id is not None:
+            lead_id = await amo_api.create_lead(amo_api.market_lead_payload(contact_id, order_id))
+            logger.info(f"Создана новая сделка: {lead_id}, существующий контакт id {contact_id}")
+        else:
+            # контакт и сделка создаются одним запросом: без полусозданных сделок при сбое
+            lead_id, contact_id = await amo_api.create_lead_with_contact_complex(
+                lead=amo_api.market_lead_payload(contact_id=None, order_id=order_id),
+                contact=amo_api.new_contact_payload(
+                    first_name=order_data.buyer_firstname,
+                    last_name=order_data.buyer_lastname,
+                    phone=buyer_phone,
+                ),
+            )
+            market_order_contacts.set(order_id, contact_id)
+            if phone:
+                await asyncio.to_thread(remember_contact_phones, SessionLocal, contact_id, (phone,))
+            if lookup_failed and phone:
+                background_tasks.add_task(
+                    reconcile_created_contact,
+                    amo_api,
+                    SessionLocal,
+                    amo_write_queue,
+                    phone,
+                    contact_id,
+                    lead_id,
+                )
+            logger.info(f"Создана новая сделка: {lead_id}, контакт id {contact_id}")
+
+        amo_write_queue.submit(
+            "lead_notes",
+            amo_api.lead_note_payload(lead_id, order_data.order_items + order_data.address),
         )
 
     except Exception as error:
@@ -413,6 +569,20 @@ async def proceed_webhook_tp(req: Request):
     return {'status': 'ok'}
 
 
+@app.post("/amo/webhook")
+async def amo_webhook(req: Request, token: str | None = None):
+    webhook_token = config.amo_config.webhook_token
+    # без токена любой мог бы заставлять сервис перечитывать сущности amoCRM
+    if webhook_token is None:
+        raise HTTPException(status_code=503, detail="AMOCRM_WEBHOOK_TOKEN is not configured")
+    if token != webhook_token:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    changes = parse_amo_webhook(await req.body())
+    queued = amo_webhook_queue.submit(changes)
+    return {"status": "ok", "changes": len(changes) if queued else 0}
+
+
 @app.post("/moysklad/processingorder")
 async def moysklad_processingorder(payload: dict):
     logger.info("MoySklad processingorder webhook payload=%s", payload)
@@ -545,17 +715,15 @@ async def get_kp_montage_image() -> FileResponse:
 
 @app.get("/kp")
 async def get_kp(request: Request, lead_id: int):
-    project_field_id = 938609
-    discount_field_id = 972024
-    delivery_field_id = 972028
     lead_response = await amo_api.get_lead_with_catalog_elements(lead_id=lead_id)
     lead_catalog_elements = get_catalog_elements_from_lead(lead_response)
-    project = amo_api._get_custom_field_value(lead_response, project_field_id)
-    discount = int(amo_api._get_custom_field_value(lead_response, discount_field_id))
+    lead_fields = custom_field_values(lead_response, ENTITY_FIELD_IDS["leads"])
+    project = lead_fields.get(LEAD_PROJECT_FIELD_ID, 0)
+    discount = int(lead_fields.get(LEAD_DISCOUNT_FIELD_ID, 0))
     responsible_manager_id = lead_response.get("responsible_user_id")
     responsible_manager = await amo_api.get_responsible_user_by_id(responsible_manager_id)
     responsible_manager_name = responsible_manager.get('name')
-    delivery = int(amo_api._get_custom_field_value(lead_response, delivery_field_id))
+    delivery = int(lead_fields.get(LEAD_DELIVERY_FIELD_ID, 0))
 
     if not lead_catalog_elements:
         raise HTTPException(status_code=404, detail="В сделке нет элементов каталога")
@@ -572,11 +740,21 @@ async def get_kp(request: Request, lead_id: int):
     if catalog_id is None:
         raise HTTPException(status_code=400, detail="Не найден catalog_id в элементах сделки")
 
-    catalogs_elements_response = await amo_api.get_catalogs_elements(
-        catalog_id=catalog_id,
-        elements=lead_catalog_elements,
-    )
-    products = get_items_to_kp(catalogs_elements_response, lead_catalog_elements, discount=discount)
+    if catalog_id == config.amo_config.kp_catalog_id:
+        # цены товаров основного каталога берём из локальной копии, без запроса к amoCRM
+        priced_elements = await get_priced_catalog_elements(
+            amo_api,
+            SessionLocal,
+            catalog_id,
+            lead_catalog_elements.keys(),
+        )
+        products = build_kp_items(priced_elements, lead_catalog_elements, discount=discount)
+    else:
+        catalogs_elements_response = await amo_api.get_catalogs_elements(
+            catalog_id=catalog_id,
+            elements=lead_catalog_elements,
+        )
+        products = get_items_to_kp(catalogs_elements_response, lead_catalog_elements, discount=discount)
     if delivery > 0:
         products.append({
             "name": 'Доставка',
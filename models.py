@@ -5,6 +5,7 @@ from decimal import Decimal
 from typing import Any
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Date,
     DateTime,
@@ -162,3 +163,102 @@ class OrderSuborder(Base):
     planned_date: Mapped[date] = mapped_column(Date)
 
     order: Mapped[MoySkladOrder] = relationship(back_populates="suborders")
+
+
+class AmoLeadRecord(Base):
+    __tablename__ = "amo_leads"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    pipeline_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    status_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    price: Mapped[int | None] = mapped_column(BigInteger)
+    contact_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    shipment_at: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    paid_at: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    project: Mapped[str | None] = mapped_column(String(255))
+    amo_created_at: Mapped[int | None] = mapped_column(BigInteger)
+    amo_closed_at: Mapped[int | None] = mapped_column(BigInteger)
+    amo_updated_at: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoCustomerRecord(Base):
+    __tablename__ = "amo_customers"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    status: Mapped[str | None] = mapped_column(String(255))
+    contact_ids: Mapped[list[int]] = mapped_column(JSON)
+    amo_created_at: Mapped[int | None] = mapped_column(BigInteger)
+    amo_updated_at: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoContactRecord(Base):
+    __tablename__ = "amo_contacts"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    customer_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    attestate_at: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    amo_updated_at: Mapped[int | None] = mapped_column(BigInteger, index=True)
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoCatalogElementRecord(Base):
+    __tablename__ = "amo_catalog_elements"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    catalog_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    name: Mapped[str] = mapped_column(Text)
+    price: Mapped[Decimal] = mapped_column(
+        Numeric(14, 2),
+        default=Decimal("0"),
+        server_default="0",
+    )
+    amo_updated_at: Mapped[int | None] = mapped_column(BigInteger)
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoContactPhone(Base):
+    __tablename__ = "amo_contact_phones"
+
+    phone: Mapped[str] = mapped_column(String(32), primary_key=True)
+    contact_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False, index=True)
+
+
+class AmoAnalyticsWriteback(Base):
+    __tablename__ = "amo_analytics_writeback"
+
+    lead_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    field_values: Mapped[dict[str, Any]] = mapped_column(JSON)
+    written_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoSyncState(Base):
+    __tablename__ = "amo_sync_state"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    updated_from: Mapped[int | None] = mapped_column(BigInteger)
+    lag_seconds: Mapped[int | None] = mapped_column()
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoOAuthToken(Base):
+    __tablename__ = "amo_oauth_tokens"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    access_token: Mapped[str | None] = mapped_column(Text)
+    refresh_token: Mapped[str | None] = mapped_column(Text)
+    refresh_owner: Mapped[str | None] = mapped_column(String(64))
+    refresh_lease_until: Mapped[float | None] = mapped_column()
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AmoWriteDeadLetter(Base):
+    __tablename__ = "amo_write_dead_letters"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(64))
+    payload: Mapped[dict[str, Any]] = mapped_column(JSON)
+    attempts: Mapped[int] = mapped_column()
+    error: Mapped[str | None] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable, Iterable, Mapping
+from datetime import datetime
+from decimal import Decimal
+from typing import Any
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import AmoAnalyticsWriteback
+from services.amo_mirror import upsert_rows
+from settings.async_amo_api import AMO_WRITE_BATCH_LIMIT, AMO_WRITE_ENDPOINTS, AmoCRMWrapperAsync, AmoLead
+
+
+logger = logging.getLogger(__name__)
+
+# метрики сделки, которые можно записать в её доп. поля
+ANALYTICS_FIELDS = ("clean_price", "last_buy", "time_from_attestate")
+# сколько id сделок передавать в одном IN (...) при чтении прошлых записей
+WRITTEN_VALUES_CHUNK = 1000
+
+
+def _days(seconds: Any) -> int | None:
+    # так же, как conver_timestamp_to_days для таблицы: целые дни, 0 — пусто
+    if not seconds:
+        return None
+    return int(seconds / 86400)
+
+
+def _number(value: Any) -> int | float:
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value or 0
+
+
+def lead_analytics_values(lead: AmoLead, fields: Iterable[str]) -> dict[str, int | float | None]:
+    values = {
+        "clean_price": lambda: _number(lead.clean_price),
+        "last_buy": lambda: _days(lead.last_buy),
+        "time_from_attestate": lambda: _days(lead.time_from_attestate),
+    }
+    return {field: values[field]() for field in fields}
+
+
+def lead_analytics_payload(
+    lead_id: int,
+    values: Mapping[str, int | float | None],
+    field_ids: Mapping[str, int],
+) -> dict[str, Any]:
+    """Изменение сделки для PATCH /api/v4/leads; None очищает поле."""
+    return {
+        "id": int(lead_id),
+        "custom_fields_values": [
+            {
+                "field_id": field_ids[field],
+                "values": None if value is None else [{"value": value}],
+            }
+            for field, value in values.items()
+        ],
+    }
+
+
+def load_written_values(
+    session_factory: Callable[[], Session],
+    lead_ids: Iterable[int] | None = None,
+) -> dict[int, dict[str, Any]]:
+    """Значения прошлой записи по сделкам lead_ids; без lead_ids — по всем."""
+    query = select(AmoAnalyticsWriteback.lead_id, AmoAnalyticsWriteback.field_values)
+    with session_factory() as session:
+        if lead_ids is None:
+            return {lead_id: field_values for lead_id, field_values in session.execute(query)}
+        ids = sorted({int(lead_id) for lead_id in lead_ids})
+        written: dict[int, dict[str, Any]] = {}
+        for index in range(0, len(ids), WRITTEN_VALUES_CHUNK):
+            chunk = ids[index:index + WRITTEN_VALUES_CHUNK]
+            rows = session.execute(query.where(AmoAnalyticsWriteback.lead_id.in_(chunk)))
+            written.update((lead_id, field_values) for lead_id, field_values in rows)
+        return written
+
+
+def store_written_values(
+    session_factory: Callable[[], Session],
+    values_by_lead: Mapping[int, Mapping[str, Any]],
+) -> None:
+    written_at = datetime.utcnow()
+    with session_factory() as session, session.begin():
+        # ON CONFLICT: одни и те же сделки могут писать два одновременных /analyze
+        upsert_rows(
+            session,
+            AmoAnalyticsWriteback,
+            [
+                {"lead_id": int(lead_id), "field_values": dict(values), "written_at": written_at}
+                for lead_id, values in values_by_lead.items()
+            ],
+        )
+
+
+async def write_back_analytics(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    amo_results: Iterable[Any],
+    field_ids: Mapping[str, int],
+    *,
+    batch_size: int = AMO_WRITE_BATCH_LIMIT,
+) -> int:
+    """
+    Записывает чистый выкуп, дни с прошлой покупки и дни с аттестации в доп.
+    поля сделок amoCRM пачками PATCH по batch_size сделок. Отправляются только
+    сделки, значения которых изменились с прошлой записи; поля с id 0 не
+    пишутся. Неудачная пачка повторится при следующем запуске аналитики.
+    Возвращает число обновлённых сделок.
+    """
+    field_ids = active_field_ids(field_ids)
+    if not field_ids:
+        return 0
+    return await write_back_analytics_values(
+        amo_api,
+        session_factory,
+        collect_analytics_values(amo_results, field_ids),
+        field_ids,
+        batch_size=batch_size,
+    )
+
+
+def active_field_ids(field_ids: Mapping[str, int]) -> dict[str, int]:
+    """Поля с id 0 не пишутся."""
+    return {field: field_id for field, field_id in field_ids.items() if field_id}
+
+
+def collect_analytics_values(
+    amo_results: Iterable[Any],
+    fields: Iterable[str],
+) -> dict[int, dict[str, int | float | None]]:
+    fields = tuple(fields)
+    return {result.lead_obj.lead_id: lead_analytics_values(result.lead_obj, fields) for result in amo_results}
+
+
+async def write_back_analytics_values(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    current: Mapping[int, Mapping[str, int | float | None]],
+    field_ids: Mapping[str, int],
+    *,
+    batch_size: int = AMO_WRITE_BATCH_LIMIT,
+) -> int:
+    """
+    То же, что write_back_analytics, но по уже посчитанным значениям
+    collect_analytics_values: их возвращает процесс расчёта аналитики.
+    """
+    field_ids = active_field_ids(field_ids)
+    if not field_ids:
+        return 0
+    if not 1 <= batch_size <= AMO_WRITE_BATCH_LIMIT:
+        raise ValueError(f"batch_size must be between 1 and {AMO_WRITE_BATCH_LIMIT}")
+
+    written = await asyncio.to_thread(load_written_values, session_factory, current.keys())
+    changed = sorted(lead_id for lead_id, values in current.items() if written.get(lead_id) != values)
+
+    endpoint = AMO_WRITE_ENDPOINTS["leads"][0]
+    updated = 0
+    for index in range(0, len(changed), batch_size):
+        chunk = changed[index:index + batch_size]
+        resp = await amo_api.patch_entities(
+            endpoint,
+            [lead_analytics_payload(lead_id, current[lead_id], field_ids) for lead_id in chunk],
+        )
+        if resp.status_code != 200:
+            logger.warning(
+                "amoCRM отклонил запись аналитики в сделки: status_code=%s, size=%s, body=%s",
+                resp.status_code,
+                len(chunk),
+                resp.text,
+            )
+            continue
+        await asyncio.to_thread(
+            store_written_values, session_factory, {lead_id: current[lead_id] for lead_id in chunk}
+        )
+        updated += len(chunk)
+
+    logger.info(
+        "Analytics write-back finished: leads=%s, changed=%s, updated=%s",
+        len(current),
+        len(changed),
+        updated,
+    )
+    return updated
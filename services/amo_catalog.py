@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable, Iterable, Sequence
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from models import AmoCatalogElementRecord
+from services.amo_mirror import save_sync_state, upsert_rows
+from settings.async_amo_api import AmoCRMWrapperAsync
+from utils.utils import get_catalog_element_price
+
+
+logger = logging.getLogger(__name__)
+
+# каталог товаров, из которого собираются КП
+KP_CATALOG_ID = 1682
+
+
+@dataclass(frozen=True)
+class CatalogElement:
+    element_id: int
+    name: str
+    price: int | float
+    updated_at: int | None = None
+
+
+@dataclass(frozen=True)
+class CatalogSyncResult:
+    catalog_id: int
+    elements_count: int
+    removed_count: int
+
+
+def catalog_state_key(catalog_id: int) -> str:
+    return f"catalog_{int(catalog_id)}"
+
+
+def catalog_element_from_payload(element: dict) -> CatalogElement | None:
+    name = element.get("name")
+    try:
+        element_id = int(element.get("id"))
+    except (TypeError, ValueError):
+        logger.warning("Некорректный id элемента каталога: %s", element)
+        return None
+    if not name:
+        return None
+    return CatalogElement(
+        element_id=element_id,
+        name=name,
+        price=get_catalog_element_price(element),
+        updated_at=element.get("updated_at"),
+    )
+
+
+def _price_from_record(price: Decimal | None) -> int | float:
+    if price is None:
+        return 0
+    return int(price) if price == price.to_integral_value() else float(price)
+
+
+def store_catalog_elements(
+    session_factory: Callable[[], Session],
+    catalog_id: int,
+    elements: Sequence[CatalogElement],
+    *,
+    full: bool = False,
+) -> int:
+    """
+    Записывает элементы каталога в локальную таблицу. При полной выгрузке
+    (full=True) строки каталога, которых больше нет в amoCRM, удаляются,
+    а в amo_sync_state отмечается время синхронизации. Возвращает число
+    удалённых строк.
+    """
+    catalog_id = int(catalog_id)
+    by_id = {element.element_id: element for element in elements}
+    removed_count = 0
+    with session_factory() as session, session.begin():
+        # ON CONFLICT: тот же новый элемент одновременно пишут промахи /kp и sync_catalog
+        now = datetime.utcnow()
+        upsert_rows(
+            session,
+            AmoCatalogElementRecord,
+            [
+                {
+                    "id": element_id,
+                    "catalog_id": catalog_id,
+                    "name": element.name,
+                    "price": Decimal(str(element.price)),
+                    "amo_updated_at": element.updated_at,
+                    "synced_at": now,
+                }
+                for element_id, element in by_id.items()
+            ],
+        )
+
+        if full:
+            query = delete(AmoCatalogElementRecord).where(AmoCatalogElementRecord.catalog_id == catalog_id)
+            if by_id:
+                query = query.where(AmoCatalogElementRecord.id.not_in(by_id.keys()))
+            removed_count = session.execute(query).rowcount or 0
+
+    if full:
+        updated_at_values = [element.updated_at for element in by_id.values() if element.updated_at]
+        save_sync_state(
+            session_factory,
+            catalog_state_key(catalog_id),
+            max(updated_at_values) if updated_at_values else None,
+        )
+    return removed_count
+
+
+def load_catalog_elements(
+    session_factory: Callable[[], Session],
+    catalog_id: int,
+    element_ids: Iterable[int],
+) -> dict[int, CatalogElement]:
+    """Элементы каталога из локальной таблицы по id (поиск по первичному ключу)."""
+    ids = sorted({int(element_id) for element_id in element_ids})
+    if not ids:
+        return {}
+    with session_factory() as session:
+        rows = session.execute(
+            select(
+                AmoCatalogElementRecord.id,
+                AmoCatalogElementRecord.name,
+                AmoCatalogElementRecord.price,
+                AmoCatalogElementRecord.amo_updated_at,
+            ).where(
+                AmoCatalogElementRecord.id.in_(ids),
+                AmoCatalogElementRecord.catalog_id == int(catalog_id),
+            )
+        )
+        return {
+            row.id: CatalogElement(
+                element_id=row.id,
+                name=row.name,
+                price=_price_from_record(row.price),
+                updated_at=row.amo_updated_at,
+            )
+            for row in rows
+        }
+
+
+async def refresh_amo_catalog(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    catalog_id: int = KP_CATALOG_ID,
+) -> CatalogSyncResult:
+    """
+    Полностью перечитывает каталог из amoCRM в локальную таблицу. Лишние
+    строки удаляются только по полному списку: если страница не получена,
+    AmoAPIError прерывает синхронизацию до записи в таблицу и amo_sync_state.
+    """
+    elements: list[CatalogElement] = []
+    async for page in amo_api.iter_catalog_elements(catalog_id):
+        for payload in page:
+            element = catalog_element_from_payload(payload)
+            if element is not None:
+                elements.append(element)
+
+    removed_count = await asyncio.to_thread(
+        store_catalog_elements,
+        session_factory,
+        catalog_id,
+        elements,
+        full=True,
+    )
+    # цены в таблице свежее кэша клиента, устаревшие записи кэша не нужны
+    amo_api.invalidate_catalog_elements(catalog_id)
+    logger.info(
+        "Каталог amoCRM синхронизирован: catalog_id=%s, elements=%s, removed=%s",
+        catalog_id,
+        len(elements),
+        removed_count,
+    )
+    return CatalogSyncResult(
+        catalog_id=int(catalog_id),
+        elements_count=len(elements),
+        removed_count=removed_count,
+    )
+
+
+async def run_amo_catalog_sync(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    catalog_id: int,
+    interval: float,
+) -> None:
+    while True:
+        try:
+            await refresh_amo_catalog(amo_api, session_factory, catalog_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Не удалось синхронизировать каталог amoCRM %s", catalog_id)
+        await asyncio.sleep(interval)
+
+
+async def get_priced_catalog_elements(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    catalog_id: int,
+    element_ids: Iterable[int],
+) -> list[tuple[int, str, int | float]]:
+    """
+    Цены строк КП из локальной таблицы каталога в порядке id элементов.
+    Элементы, которых ещё нет в таблице (добавлены после синхронизации),
+    запрашиваются из amoCRM и сразу сохраняются.
+    """
+    ids = sorted({int(element_id) for element_id in element_ids})
+    found = await asyncio.to_thread(load_catalog_elements, session_factory, catalog_id, ids)
+
+    missing = [element_id for element_id in ids if element_id not in found]
+    if missing:
+        response = await amo_api.get_catalogs_elements(catalog_id, dict.fromkeys(missing, 0))
+        fetched = [
+            element
+            for element in map(catalog_element_from_payload, response.get("_embedded", {}).get("elements", []))
+            if element is not None
+        ]
+        if fetched:
+            await asyncio.to_thread(store_catalog_elements, session_factory, catalog_id, fetched)
+        found.update((element.element_id, element) for element in fetched)
+
+    return [
+        (element_id, found[element_id].name, found[element_id].price)
+        for element_id in ids
+        if element_id in found
+    ]
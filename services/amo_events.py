@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Callable, Iterable, Mapping
+from dataclasses import dataclass
+from typing import Any
+
+from sqlalchemy.orm import Session
+
+from services.amo_mirror import AmoChanges, apply_amo_changes, get_updated_from, save_sync_state
+from settings.async_amo_api import AmoCRMWrapperAsync
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS_STATE_KEY = "events"
+EVENT_ENTITIES = {"lead": "leads", "contact": "contacts", "customer": "customers"}
+
+
+@dataclass(frozen=True)
+class EventsPollResult:
+    events_count: int
+    changes_count: int
+    cursor: int
+    lag_seconds: int
+
+
+def changes_from_events(events: Iterable[Mapping[str, Any]]) -> AmoChanges:
+    """
+    Сворачивает события в набор изменений. События применяются по порядку,
+    поэтому удаление и последующее восстановление дают перечитывание сущности.
+    """
+    changes = AmoChanges()
+    ordered = sorted(events, key=lambda event: event.get("created_at") or 0)
+    for event in ordered:
+        entity = EVENT_ENTITIES.get(event.get("entity_type"))
+        entity_id = event.get("entity_id")
+        if entity is None or entity_id is None:
+            continue
+        if str(event.get("type", "")).endswith("_deleted"):
+            changes.mark_deleted(entity, int(entity_id))
+        else:
+            changes.mark_changed(entity, int(entity_id))
+    return changes
+
+
+async def poll_amo_events(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+) -> EventsPollResult:
+    """
+    Читает ленту событий amoCRM с сохранённого курсора и применяет изменения
+    сделок, контактов и покупателей к локальному зеркалу одной пачкой.
+
+    lag_seconds — возраст самого старого применённого события, то есть на
+    сколько зеркало отставало от amoCRM к моменту обработки.
+    """
+    now = int(time.time())
+    cursor = await asyncio.to_thread(get_updated_from, session_factory, EVENTS_STATE_KEY)
+    if cursor is None:
+        # история уже в зеркале после полной выгрузки, ленту читаем с текущего момента
+        await asyncio.to_thread(save_sync_state, session_factory, EVENTS_STATE_KEY, now, 0)
+        return EventsPollResult(events_count=0, changes_count=0, cursor=now, lag_seconds=0)
+
+    events_by_id: dict[str, Mapping[str, Any]] = {}
+    async for page_items in amo_api.iter_events(cursor):
+        for event in page_items:
+            events_by_id[str(event.get("id"))] = event
+
+    events = list(events_by_id.values())
+    changes = changes_from_events(events)
+    if changes:
+        await apply_amo_changes(amo_api, session_factory, changes)
+
+    created_at_values = [int(event["created_at"]) for event in events if event.get("created_at")]
+    new_cursor = max([cursor, *created_at_values])
+    lag_seconds = max(0, int(time.time()) - min(created_at_values)) if created_at_values else 0
+    await asyncio.to_thread(
+        save_sync_state,
+        session_factory,
+        EVENTS_STATE_KEY,
+        new_cursor,
+        lag_seconds,
+    )
+
+    if events:
+        logger.info(
+            "События amoCRM применены: events=%s, changes=%s, cursor=%s, lag_seconds=%s",
+            len(events),
+            len(changes),
+            new_cursor,
+            lag_seconds,
+        )
+    return EventsPollResult(
+        events_count=len(events),
+        changes_count=len(changes),
+        cursor=new_cursor,
+        lag_seconds=lag_seconds,
+    )
+
+
+async def run_amo_events_consumer(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    interval: float,
+) -> None:
+    while True:
+        try:
+            await poll_amo_events(amo_api, session_factory)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Не удалось обработать ленту событий amoCRM")
+        await asyncio.sleep(interval)
@@ -0,0 +1,487 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import AmoContactPhone, AmoContactRecord, AmoCustomerRecord, AmoLeadRecord, AmoSyncState
+from settings.async_amo_api import (
+    ANALYTICS_PIPELINE_ID,
+    ANALYTICS_STATUS_IDS,
+    AmoContact,
+    AmoCRMWrapperAsync,
+    AmoCustomers,
+    AmoLead,
+)
+
+
+logger = logging.getLogger(__name__)
+
+MIRROR_ENTITIES = ("leads", "customers", "contacts")
+CHANGES_BATCH_SIZE = 250
+# на сколько секунд раньше курсора перечитывать изменения при следующем обновлении
+MIRROR_CURSOR_OVERLAP = 300
+
+
+@dataclass(frozen=True)
+class MirrorRefreshResult:
+    entity: str
+    updated_count: int
+    updated_from: int | None
+
+
+@dataclass
+class AmoChanges:
+    """Накопленные изменения сущностей amoCRM: какие id перечитать, какие удалить."""
+
+    changed: dict[str, set[int]] = field(
+        default_factory=lambda: {entity: set() for entity in MIRROR_ENTITIES}
+    )
+    deleted: dict[str, set[int]] = field(
+        default_factory=lambda: {entity: set() for entity in MIRROR_ENTITIES}
+    )
+
+    def mark_changed(self, entity: str, entity_id: int) -> None:
+        self.deleted[entity].discard(entity_id)
+        self.changed[entity].add(entity_id)
+
+    def mark_deleted(self, entity: str, entity_id: int) -> None:
+        self.changed[entity].discard(entity_id)
+        self.deleted[entity].add(entity_id)
+
+    def merge(self, other: AmoChanges) -> None:
+        for entity in MIRROR_ENTITIES:
+            for entity_id in other.changed[entity]:
+                self.mark_changed(entity, entity_id)
+            for entity_id in other.deleted[entity]:
+                self.mark_deleted(entity, entity_id)
+
+    def __bool__(self) -> bool:
+        return any(self.changed.values()) or any(self.deleted.values())
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self.changed.values()) + sum(
+            len(ids) for ids in self.deleted.values()
+        )
+
+
+def _int_value(value: Any) -> int:
+    """Значение даты из доп. поля amoCRM; 0 — как у клиента при пустом поле."""
+    if value in (None, "") or isinstance(value, bool):
+        return 0
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        logger.warning("Некорректное числовое значение поля amoCRM: %s", value)
+        return 0
+
+
+def _optional_int(value: Any) -> int | None:
+    if value in (None, "") or isinstance(value, bool):
+        return None
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _optional_string(value: Any) -> str | None:
+    if value in (None, 0, ""):
+        return None
+    return str(value)
+
+
+def _lead_values(lead: AmoLead) -> dict[str, Any]:
+    return {
+        "pipeline_id": lead.pipeline_id,
+        "status_id": lead.status_id,
+        "price": _optional_int(lead.lead_price),
+        "contact_id": lead.contact_id,
+        "shipment_at": _int_value(lead.shipment_at),
+        "paid_at": _int_value(lead.paid_at),
+        "project": _optional_string(lead.project),
+        "amo_created_at": lead.created_at,
+        "amo_closed_at": lead.close_at,
+        "amo_updated_at": lead.updated_at,
+    }
+
+
+def _customer_values(customer: AmoCustomers) -> dict[str, Any]:
+    return {
+        "status": _optional_string(customer.status),
+        "contact_ids": list(customer.contacts_id),
+        "amo_created_at": customer.created_at,
+        "amo_updated_at": customer.updated_at,
+    }
+
+
+def _contact_values(contact: AmoContact) -> dict[str, Any]:
+    return {
+        "customer_id": contact.customer_id,
+        "attestate_at": _int_value(contact.attestate_at),
+        "amo_updated_at": contact.updated_at,
+    }
+
+
+_MIRROR_MODELS: dict[str, tuple[type, Callable[[Any], int | None], Callable[[Any], dict[str, Any]]]] = {
+    "leads": (AmoLeadRecord, lambda lead: lead.lead_id, _lead_values),
+    "customers": (AmoCustomerRecord, lambda customer: customer.customer_id, _customer_values),
+    "contacts": (AmoContactRecord, lambda contact: contact.contact_id, _contact_values),
+}
+
+_DIALECT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def upsert_rows(session: Session, model: type, rows: Sequence[dict[str, Any]]) -> None:
+    """
+    INSERT ... ON CONFLICT по первичному ключу: зеркало одновременно пишут
+    обновления аналитики, синхронизация контактов, лента событий и вебхуки,
+    и новый id, вставленный одним из них, другой просто обновляет. Строки
+    без неключевых колонок при конфликте не меняются. На других СУБД —
+    session.merge без такой защиты.
+    """
+    if not rows:
+        return
+    insert = _DIALECT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is None:
+        for row in rows:
+            session.merge(model(**row))
+        return
+
+    key_columns = [column.name for column in model.__table__.primary_key.columns]
+    statement = insert(model)
+    updated_columns = [name for name in rows[0] if name not in key_columns]
+    if updated_columns:
+        statement = statement.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={name: statement.excluded[name] for name in updated_columns},
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=key_columns)
+    session.execute(statement, list(rows))
+
+
+def replace_contact_phones(session: Session, phones_by_contact: dict[int, Sequence[str]]) -> None:
+    """Переписывает телефоны контактов в индексе телефон → контакт."""
+    if not phones_by_contact:
+        return
+    session.execute(
+        delete(AmoContactPhone).where(AmoContactPhone.contact_id.in_(phones_by_contact.keys()))
+    )
+    upsert_rows(
+        session,
+        AmoContactPhone,
+        [
+            {"phone": phone, "contact_id": contact_id}
+            for contact_id, phones in phones_by_contact.items()
+            for phone in dict.fromkeys(phones)
+        ],
+    )
+
+
+def upsert_mirror_records(
+    session: Session,
+    entity: str,
+    records: Sequence[AmoLead | AmoCustomers | AmoContact],
+) -> int | None:
+    """
+    Обновляет строки зеркала одной пачкой и возвращает максимальный updated_at.
+    """
+    model, get_id, values = _MIRROR_MODELS[entity]
+    by_id = {}
+    for record in records:
+        record_id = get_id(record)
+        if record_id is not None:
+            by_id[int(record_id)] = record
+    if not by_id:
+        return None
+
+    synced_at = datetime.utcnow()
+    upsert_rows(
+        session,
+        model,
+        [{"id": record_id, **values(record), "synced_at": synced_at} for record_id, record in by_id.items()],
+    )
+    updated_at_values = [record.updated_at for record in by_id.values() if record.updated_at is not None]
+    if entity == "contacts":
+        replace_contact_phones(session, {record_id: record.phones for record_id, record in by_id.items()})
+    return max(updated_at_values) if updated_at_values else None
+
+
+def replace_mirror_records(
+    session_factory: Callable[[], Session],
+    entity: str,
+    requested_ids: Sequence[int],
+    records: Sequence[AmoLead | AmoCustomers | AmoContact],
+    deleted_ids: Sequence[int] = (),
+) -> None:
+    """
+    Записывает перечитанные из amoCRM сущности. Запрошенные, но не вернувшиеся
+    id удалены в amoCRM; сделки вне воронки аналитики в зеркале не хранятся.
+    records должны быть полным ответом amoCRM на requested_ids: при сбое
+    get_records_by_ids поднимает AmoAPIError, и сюда пачка не доходит.
+    """
+    model, get_id, _ = _MIRROR_MODELS[entity]
+    if entity == "leads":
+        records = [lead for lead in records if lead.pipeline_id == ANALYTICS_PIPELINE_ID]
+    kept_ids = {int(get_id(record)) for record in records if get_id(record) is not None}
+    removed_ids = (set(requested_ids) - kept_ids) | set(deleted_ids)
+
+    with session_factory() as session, session.begin():
+        upsert_mirror_records(session, entity, records)
+        if removed_ids:
+            session.execute(delete(model).where(model.id.in_(removed_ids)))
+            if entity == "contacts":
+                session.execute(
+                    delete(AmoContactPhone).where(AmoContactPhone.contact_id.in_(removed_ids))
+                )
+
+
+async def apply_amo_changes(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    changes: AmoChanges,
+    batch_size: int = CHANGES_BATCH_SIZE,
+) -> None:
+    """
+    Применяет накопленные изменения к зеркалу пачками по batch_size id.
+    Если пачку не удалось перечитать, AmoAPIError прерывает применение:
+    курсор событий остаётся на месте, и изменения применятся повторно.
+    """
+    for entity in MIRROR_ENTITIES:
+        deleted_ids = sorted(changes.deleted[entity])
+        if deleted_ids:
+            await asyncio.to_thread(
+                replace_mirror_records,
+                session_factory,
+                entity,
+                (),
+                (),
+                deleted_ids,
+            )
+
+        changed_ids = sorted(changes.changed[entity])
+        for index in range(0, len(changed_ids), batch_size):
+            chunk = changed_ids[index:index + batch_size]
+            records = await amo_api.get_records_by_ids(entity, chunk, limit=batch_size)
+            await asyncio.to_thread(
+                replace_mirror_records,
+                session_factory,
+                entity,
+                chunk,
+                records,
+            )
+
+
+def get_updated_from(session_factory: Callable[[], Session], entity: str) -> int | None:
+    with session_factory() as session:
+        state = session.get(AmoSyncState, entity)
+        return state.updated_from if state is not None else None
+
+
+def _sync_state_for_update(session: Session, key: str) -> AmoSyncState:
+    # строку курсора может одновременно создавать другой обработчик
+    upsert_rows(session, AmoSyncState, [{"key": key}])
+    return session.get(AmoSyncState, key)
+
+
+def save_sync_state(
+    session_factory: Callable[[], Session],
+    key: str,
+    updated_from: int | None,
+    lag_seconds: int | None = None,
+) -> None:
+    with session_factory() as session, session.begin():
+        state = _sync_state_for_update(session, key)
+        state.updated_from = updated_from
+        state.lag_seconds = lag_seconds
+        state.synced_at = datetime.utcnow()
+
+
+def store_mirror_page(
+    session_factory: Callable[[], Session],
+    entity: str,
+    records: Sequence[AmoLead | AmoCustomers | AmoContact],
+) -> int | None:
+    """
+    Сохраняет страницу обновления зеркала и возвращает её максимальный
+    updated_at. Курсор не сдвигается: его сохраняет refresh_amo_mirror
+    после полного прохода.
+    """
+    with session_factory() as session, session.begin():
+        return upsert_mirror_records(session, entity, records)
+
+
+async def refresh_amo_mirror(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    entities: Sequence[str] = MIRROR_ENTITIES,
+    overlap: int = MIRROR_CURSOR_OVERLAP,
+) -> list[MirrorRefreshResult]:
+    """
+    Догружает в зеркало сделки, покупателей и контакты, изменённые после
+    последнего обновления (с запасом overlap секунд). Первый запуск
+    выгружает всё.
+
+    amoCRM отдаёт изменения страницами по смещению в порядке updated_at.
+    Сущность, изменённая во время обхода, переезжает в конец списка, и
+    следующая за ней пропускается. Поэтому курсор сохраняется только после
+    полного прохода, а если сущность встретилась в проходе дважды, курсор
+    ставится на её прежний updated_at: пропущенные за ней записи будут
+    перечитаны в следующий раз.
+
+    Сделки читаются только из воронки аналитики: сделку, ушедшую из неё,
+    обновление не увидит. Такие переходы доходят до зеркала через ленту
+    событий (run_amo_events_consumer) и вебхуки amoCRM.
+    """
+
+    async def refresh_entity(entity: str) -> MirrorRefreshResult:
+        _, get_id, _ = _MIRROR_MODELS[entity]
+        updated_from = await asyncio.to_thread(get_updated_from, session_factory, entity)
+        read_from = max(updated_from - overlap, 0) if updated_from else None
+        updated_count = 0
+        max_updated_at: int | None = None
+        first_seen: dict[int, int | None] = {}
+        moved_from: int | None = None
+        async for records in amo_api.iter_updated_pages(entity, updated_from=read_from):
+            page_updated_at = await asyncio.to_thread(store_mirror_page, session_factory, entity, records)
+            if page_updated_at is not None and (max_updated_at is None or page_updated_at > max_updated_at):
+                max_updated_at = page_updated_at
+            for record in records:
+                record_id = get_id(record)
+                if record_id not in first_seen:
+                    first_seen[record_id] = record.updated_at
+                elif first_seen[record_id] is not None:
+                    previous = first_seen[record_id]
+                    moved_from = previous if moved_from is None else min(moved_from, previous)
+            updated_count += len(records)
+
+        cursor = max_updated_at if max_updated_at is not None else updated_from
+        if moved_from is not None:
+            logger.warning(
+                "Зеркало amoCRM: %s изменились во время обхода, курсор остаётся на %s",
+                entity,
+                moved_from,
+            )
+            cursor = moved_from
+        if cursor is not None:
+            await asyncio.to_thread(save_sync_state, session_factory, entity, cursor)
+        logger.info(
+            "Зеркало amoCRM обновлено: entity=%s, updated=%s, updated_from=%s",
+            entity,
+            updated_count,
+            updated_from,
+        )
+        return MirrorRefreshResult(
+            entity=entity,
+            updated_count=updated_count,
+            updated_from=updated_from,
+        )
+
+    return list(await asyncio.gather(*(refresh_entity(entity) for entity in entities)))
+
+
+async def run_amo_mirror_sync(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    entities: Sequence[str],
+    interval: float,
+) -> None:
+    """Периодически догружает в зеркало изменённые сущности."""
+    while True:
+        try:
+            await refresh_amo_mirror(amo_api, session_factory, entities=entities)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Не удалось обновить зеркало amoCRM: entities=%s", entities)
+        await asyncio.sleep(interval)
+
+
+def load_analytics_leads(
+    session_factory: Callable[[], Session],
+    after_id: int | None = None,
+    limit: int | None = None,
+) -> list[AmoLead]:
+    """
+    Сделки для аналитики по возрастанию id. after_id и limit позволяют читать
+    их страницами (keyset), не поднимая всю таблицу в память.
+    """
+    with session_factory() as session:
+        query = (
+            select(
+                AmoLeadRecord.id,
+                AmoLeadRecord.price,
+                AmoLeadRecord.amo_created_at,
+                AmoLeadRecord.amo_closed_at,
+                AmoLeadRecord.contact_id,
+                AmoLeadRecord.shipment_at,
+                AmoLeadRecord.paid_at,
+                AmoLeadRecord.project,
+                AmoLeadRecord.pipeline_id,
+                AmoLeadRecord.status_id,
+                AmoLeadRecord.amo_updated_at,
+            )
+            .where(
+                AmoLeadRecord.pipeline_id == ANALYTICS_PIPELINE_ID,
+                AmoLeadRecord.status_id.in_(ANALYTICS_STATUS_IDS),
+            )
+            .order_by(AmoLeadRecord.id)
+        )
+        if after_id is not None:
+            query = query.where(AmoLeadRecord.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = session.execute(query)
+        return [
+            AmoLead(
+                lead_id=row.id,
+                lead_price=row.price,
+                created_at=row.amo_created_at,
+                close_at=row.amo_closed_at,
+                contact_id=row.contact_id,
+                shipment_at=row.shipment_at,
+                paid_at=row.paid_at,
+                project=row.project if row.project is not None else 0,
+                pipeline_id=row.pipeline_id,
+                status_id=row.status_id,
+                updated_at=row.amo_updated_at,
+            )
+            for row in rows
+        ]
+
+
+def load_analytics_customers(session_factory: Callable[[], Session]) -> list[AmoCustomers]:
+    with session_factory() as session:
+        rows = session.execute(
+            select(
+                AmoCustomerRecord.id,
+                AmoCustomerRecord.amo_created_at,
+                AmoCustomerRecord.contact_ids,
+                AmoCustomerRecord.status,
+                AmoCustomerRecord.amo_updated_at,
+            ).order_by(AmoCustomerRecord.id)
+        )
+        return [
+            AmoCustomers(
+                customer_id=row.id,
+                created_at=row.amo_created_at,
+                contacts_id=list(row.contact_ids or []),
+                status=row.status if row.status is not None else 0,
+                updated_at=row.amo_updated_at,
+            )
+            for row in rows
+        ]
+
+
+def load_analytics_data(
+    session_factory: Callable[[], Session],
+) -> tuple[list[AmoLead], list[AmoCustomers]]:
+    return load_analytics_leads(session_factory), load_analytics_customers(session_factory)
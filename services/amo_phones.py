@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable
+from typing import Any
+
+import httpx
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import AmoContactPhone
+from services.amo_mirror import replace_contact_phones
+from services.amo_writes import AmoWriteQueue
+from settings.async_amo_api import AmoAPIError, AmoCRMWrapperAsync, contact_phones
+
+
+logger = logging.getLogger(__name__)
+
+# сбои поиска контакта: amoCRM ответил ошибкой или запрос не дошёл
+CONTACT_LOOKUP_ERRORS = (AmoAPIError, httpx.HTTPError)
+# паузы перед повторными поисками контакта, созданного без проверки на дубли
+CONTACT_RECONCILE_DELAYS = (30.0, 120.0, 600.0)
+
+DUPLICATE_PHONE_MESSAGE = (
+    "Найдено более одного контакта с номером телефона\n"
+    "Обратитесь к менеджеру отдела продаж!"
+)
+
+
+def find_contact_ids_by_phone(session_factory: Callable[[], Session], phone: str) -> list[int]:
+    with session_factory() as session:
+        return list(
+            session.scalars(
+                select(AmoContactPhone.contact_id)
+                .where(AmoContactPhone.phone == phone)
+                .order_by(AmoContactPhone.contact_id)
+            )
+        )
+
+
+def remember_contact_phones(
+    session_factory: Callable[[], Session],
+    contact_id: int,
+    phones: tuple[str, ...],
+) -> None:
+    with session_factory() as session, session.begin():
+        replace_contact_phones(session, {int(contact_id): phones})
+
+
+async def get_contact_by_phone(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    phone: str,
+) -> tuple[bool, Any]:
+    """
+    Ищет контакт по телефону сначала в локальном индексе amo_contact_phones,
+    а при промахе — поиском amoCRM по полному номеру, запоминая телефоны
+    найденного контакта. Контакты, у которых номер лишь содержит искомый,
+    не считаются найденными.
+
+    phone ожидается уже нормализованным через correct_phone. Контракт как у
+    AmoCRMWrapperAsync.get_contact_by_phone, но при попадании в индекс
+    возвращается только ``{"id": contact_id}``.
+    """
+    contact_ids = await asyncio.to_thread(find_contact_ids_by_phone, session_factory, phone)
+    if len(contact_ids) == 1:
+        return True, {"id": contact_ids[0]}
+    if len(contact_ids) > 1:
+        return False, DUPLICATE_PHONE_MESSAGE
+
+    ok, contact = await amo_api.get_contact_by_phone(phone)
+    if ok and contact.get("id") is not None:
+        await _remember_found_contacts(session_factory, [contact])
+    return ok, contact
+
+
+async def _remember_found_contacts(session_factory: Callable[[], Session], contacts: list[dict]) -> None:
+    for contact in contacts:
+        phones = contact_phones(contact)
+        if not phones:
+            continue
+        try:
+            await asyncio.to_thread(remember_contact_phones, session_factory, contact["id"], phones)
+        except Exception:
+            logger.exception("Не удалось сохранить телефоны контакта %s в индекс", contact["id"])
+
+
+async def resolve_contact_id_by_phone(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    phone: str,
+) -> int | None:
+    """
+    id существующего контакта с телефоном или None, если такого контакта нет
+    и его нужно создать. При нескольких контактах с одним номером берётся
+    самый старый, чтобы не плодить ещё один дубль.
+    """
+    if not phone:
+        return None
+    contact_ids = await asyncio.to_thread(find_contact_ids_by_phone, session_factory, phone)
+    if len(contact_ids) > 1:
+        logger.warning("Телефон %s есть у нескольких контактов: %s", phone, contact_ids)
+    if contact_ids:
+        return contact_ids[0]
+
+    # ошибка amoCRM (CONTACT_LOOKUP_ERRORS) не превращается в «контакта нет»:
+    # вызывающий сам решает, создавать ли контакт без проверки
+    contacts = await amo_api.search_contacts_by_phone(phone)
+    if not contacts:
+        logger.info("Контакт с телефоном %s не найден в amoCRM", phone)
+        return None
+    if len(contacts) > 1:
+        logger.warning(
+            "Телефон %s есть у нескольких контактов amoCRM: %s",
+            phone,
+            [contact.get("id") for contact in contacts],
+        )
+    await _remember_found_contacts(session_factory, contacts)
+    return int(contacts[0]["id"])
+
+
+async def reconcile_created_contact(
+    amo_api: AmoCRMWrapperAsync,
+    session_factory: Callable[[], Session],
+    write_queue: AmoWriteQueue,
+    phone: str,
+    contact_id: int,
+    lead_id: int,
+    delays: tuple[float, ...] | None = None,
+) -> int | None:
+    """
+    Проверка контакта, созданного без поиска по телефону (поиск amoCRM не
+    ответил): поиск повторяется с паузами delays. Если у номера есть более
+    старый контакт, в сделку пишется примечание для менеджера, а id старого
+    контакта возвращается; иначе None.
+    """
+    for delay in CONTACT_RECONCILE_DELAYS if delays is None else delays:
+        await asyncio.sleep(delay)
+        try:
+            contacts = await amo_api.search_contacts_by_phone(phone)
+        except CONTACT_LOOKUP_ERRORS as error:
+            logger.warning("Повторный поиск контакта с телефоном %s не удался: %s", phone, error)
+            continue
+        await _remember_found_contacts(session_factory, contacts)
+        if not contacts or int(contacts[0]["id"]) == int(contact_id):
+            return None
+        older_id = int(contacts[0]["id"])
+        logger.warning("Контакт %s — дубль контакта %s с телефоном %s", contact_id, older_id, phone)
+        write_queue.submit(
+            "lead_notes",
+            amo_api.lead_note_payload(
+                lead_id,
+                f"Контакт {contact_id} создан без проверки и дублирует контакт {older_id} "
+                f"с телефоном {phone}: объедините контакты.",
+            ),
+        )
+        return older_id
+
+    logger.error("Контакт %s с телефоном %s не проверен на дубли: amoCRM не ответил", contact_id, phone)
+    return None
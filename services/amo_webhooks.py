@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+from collections.abc import Callable
+from urllib.parse import parse_qsl
+
+from sqlalchemy.orm import Session
+
+from services.amo_mirror import CHANGES_BATCH_SIZE, AmoChanges, apply_amo_changes
+from settings.async_amo_api import AmoCRMWrapperAsync
+
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_QUEUE_SIZE = 10_000
+# leads[status][0][id], contacts[update][1][type], customers[delete][0][id]
+_WEBHOOK_FIELD = re.compile(r"^(leads|contacts|customers)\[(\w+)\]\[(\d+)\]\[(id|type)\]$")
+
+
+def parse_amo_webhook(body: bytes | str) -> AmoChanges:
+    """
+    Разбирает form-urlencoded вебхук amoCRM за один проход по парам ключ-значение.
+
+    Учитываются только поля ``[id]`` и ``[type]`` сделок, контактов и
+    покупателей; компании приходят в ``contacts[...]`` с ``type=company`` и
+    в зеркало не попадают.
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+
+    entries: dict[tuple[str, str, str], int] = {}
+    companies: set[tuple[str, str, str]] = set()
+    for key, value in parse_qsl(body):
+        match = _WEBHOOK_FIELD.match(key)
+        if match is None:
+            continue
+        entity, action, index, field_name = match.groups()
+        entry = (entity, action, index)
+        if field_name == "type":
+            if value == "company":
+                companies.add(entry)
+            continue
+        try:
+            entries[entry] = int(value)
+        except ValueError:
+            logger.warning("Некорректный id в вебхуке amoCRM: %s=%s", key, value)
+
+    changes = AmoChanges()
+    for entry, entity_id in entries.items():
+        if entry in companies:
+            continue
+        entity, action, _ = entry
+        if action == "delete":
+            changes.mark_deleted(entity, entity_id)
+        else:
+            changes.mark_changed(entity, entity_id)
+    return changes
+
+
+class AmoWebhookQueue:
+    """
+    Очередь изменений из вебхуков amoCRM.
+
+    Маршрут только кладёт разобранные изменения в очередь; фоновый обработчик
+    собирает их в пачку в течение ``batch_delay`` секунд (или до
+    ``max_batch_size`` сущностей) и применяет к зеркалу одним проходом.
+    """
+
+    def __init__(
+        self,
+        batch_delay: float = 1.0,
+        max_batch_size: int = CHANGES_BATCH_SIZE,
+        maxsize: int = WEBHOOK_QUEUE_SIZE,
+    ) -> None:
+        if batch_delay < 0:
+            raise ValueError("batch_delay must not be negative")
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.batch_delay = float(batch_delay)
+        self.max_batch_size = int(max_batch_size)
+        self._queue: asyncio.Queue[AmoChanges] = asyncio.Queue(maxsize=maxsize)
+
+    def submit(self, changes: AmoChanges) -> bool:
+        """
+        Ставит изменения в очередь без ожидания. При переполнении изменения
+        отбрасываются: их подберёт опрос ленты событий.
+        """
+        if not changes:
+            return False
+        try:
+            self._queue.put_nowait(changes)
+        except asyncio.QueueFull:
+            logger.warning("Очередь вебхуков amoCRM переполнена, изменения пропущены: %s", len(changes))
+            return False
+        return True
+
+    async def next_batch(self) -> AmoChanges:
+        batch = AmoChanges()
+        batch.merge(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_delay
+        while len(batch) < self.max_batch_size:
+            if self._queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    changes = await asyncio.wait_for(self._queue.get(), remaining)
+                except TimeoutError:
+                    break
+            else:
+                changes = self._queue.get_nowait()
+            batch.merge(changes)
+        return batch
+
+    async def run(
+        self,
+        amo_api: AmoCRMWrapperAsync,
+        session_factory: Callable[[], Session],
+    ) -> None:
+        while True:
+            batch = await self.next_batch()
+            try:
+                await apply_amo_changes(amo_api, session_factory, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Не удалось применить вебхуки amoCRM: changes=%s", len(batch))
+            else:
+                logger.info("Вебхуки amoCRM применены к зеркалу: changes=%s", len(batch))
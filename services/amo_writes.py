@@ -0,0 +1,342 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from models import AmoWriteDeadLetter
+from settings.async_amo_api import (
+    AMO_NOT_SENT_ERRORS,
+    AMO_WRITE_BATCH_LIMIT,
+    AMO_WRITE_ENDPOINTS,
+    AmoCRMWrapperAsync,
+    amo_response_not_applied,
+)
+
+
+logger = logging.getLogger(__name__)
+
+WRITE_QUEUE_SIZE = 10_000
+DEAD_LETTER_LIMIT = 1000
+
+
+class AmoWriteError(RuntimeError):
+    """Изменение не удалось записать в amoCRM за все попытки."""
+
+
+@dataclass
+class AmoMutation:
+    kind: str
+    payload: dict[str, Any]
+    future: asyncio.Future = field(repr=False)
+    attempts: int = 0
+    # после неудачи в общей пачке изменение отправляется отдельно,
+    # чтобы одна некорректная сущность не валила остальные
+    solo: bool = False
+    last_error: str | None = None
+    # False, если amoCRM мог уже создать сущность: повтор дал бы дубль
+    retryable: bool = True
+
+
+def store_dead_letters(
+    session_factory: Callable[[], Session],
+    mutations: list[AmoMutation],
+    error: str,
+    limit: int = DEAD_LETTER_LIMIT,
+) -> None:
+    """Сохраняет изменения, от которых отказались; хранятся только последние limit штук."""
+    with session_factory() as session, session.begin():
+        session.add_all(
+            AmoWriteDeadLetter(
+                kind=mutation.kind,
+                payload=mutation.payload,
+                attempts=mutation.attempts,
+                error=error,
+                created_at=datetime.utcnow(),
+            )
+            for mutation in mutations
+        )
+        session.flush()
+        oldest_kept = session.scalar(
+            select(AmoWriteDeadLetter.id)
+            .order_by(AmoWriteDeadLetter.id.desc())
+            .offset(limit - 1)
+            .limit(1)
+        )
+        if oldest_kept is not None:
+            session.execute(delete(AmoWriteDeadLetter).where(AmoWriteDeadLetter.id < oldest_kept))
+
+
+class AmoWriteQueue:
+    """
+    Очередь отложенной записи в amoCRM (write-behind).
+
+    Маршруты кладут изменения в очередь и сразу отвечают; фоновый обработчик
+    в течение ``batch_delay`` секунд (или пока пачка одного вида не наберёт
+    ``max_batch_size`` сущностей) собирает их и отправляет одним запросом на
+    каждый вид. Неудачные изменения повторяются с растущей паузой, а после
+    ``max_attempts`` попыток попадают в таблицу amo_write_dead_letters.
+    Повторяются только запросы, которые amoCRM точно не выполнил: ошибка
+    соединения, 429, 5xx без тела или отказ 4xx. Задачи и примечания не
+    идемпотентны, поэтому после таймаута ответа, обрыва соединения или 5xx
+    с телом изменения сразу уходят в dead-letter.
+    Туда же попадают изменения, не поместившиеся в переполненную очередь.
+    """
+
+    def __init__(
+        self,
+        batch_delay: float = 1.0,
+        max_batch_size: int = AMO_WRITE_BATCH_LIMIT,
+        max_attempts: int = 5,
+        retry_delay: float = 5.0,
+        dead_letter_limit: int = DEAD_LETTER_LIMIT,
+        maxsize: int = WRITE_QUEUE_SIZE,
+    ) -> None:
+        if batch_delay < 0:
+            raise ValueError("batch_delay must not be negative")
+        if not 1 <= max_batch_size <= AMO_WRITE_BATCH_LIMIT:
+            raise ValueError(f"max_batch_size must be between 1 and {AMO_WRITE_BATCH_LIMIT}")
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.batch_delay = float(batch_delay)
+        self.max_batch_size = int(max_batch_size)
+        self.max_attempts = int(max_attempts)
+        self.retry_delay = float(retry_delay)
+        self.dead_letter_limit = int(dead_letter_limit)
+        self._queue: asyncio.Queue[AmoMutation] = asyncio.Queue(maxsize=maxsize)
+        # всё, что вынуто из очереди, но ещё не записано, видно drain:
+        # собираемая пачка, отправляемая пачка и отложенные повторы
+        self._collecting: dict[str, list[AmoMutation]] = {}
+        self._in_flight: asyncio.Future | None = None
+        self._retrying: dict[int, tuple[asyncio.TimerHandle, AmoMutation]] = {}
+        self._overflow: list[AmoMutation] = []
+
+    def submit(self, kind: str, payload: dict[str, Any]) -> asyncio.Future:
+        """
+        Ставит изменение в очередь без ожидания. Возвращает future с созданной
+        сущностью из ответа amoCRM — его можно ждать, а можно и не ждать.
+        Если очередь переполнена, изменение уходит в dead-letter, а future
+        завершается AmoWriteError; маршрут при этом не падает.
+        """
+        if kind not in AMO_WRITE_ENDPOINTS:
+            raise ValueError(f"Unknown amoCRM write kind: {kind}")
+        future = asyncio.get_running_loop().create_future()
+        mutation = AmoMutation(kind=kind, payload=payload, future=future)
+        try:
+            self._queue.put_nowait(mutation)
+        except asyncio.QueueFull:
+            logger.error("Очередь записи amoCRM переполнена, изменение %s уйдёт в dead-letter", kind)
+            mutation.last_error = "write queue is full"
+            self._overflow.append(mutation)
+        return future
+
+    def submit_many(self, kind: str, payloads: list[dict[str, Any]]) -> list[asyncio.Future]:
+        return [self.submit(kind, payload) for payload in payloads]
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def next_batch(self) -> dict[str, list[AmoMutation]]:
+        """Изменения, накопленные за batch_delay, сгруппированные по виду."""
+        batch = self._collecting = {}
+
+        def add(mutation: AmoMutation) -> bool:
+            group = batch.setdefault(mutation.kind, [])
+            group.append(mutation)
+            return len(group) >= self.max_batch_size
+
+        full = add(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_delay
+        while not full:
+            if self._queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    mutation = await asyncio.wait_for(self._queue.get(), remaining)
+                except TimeoutError:
+                    break
+            else:
+                mutation = self._queue.get_nowait()
+            full = add(mutation)
+        self._collecting = {}
+        return batch
+
+    async def send(
+        self,
+        amo_api: AmoCRMWrapperAsync,
+        kind: str,
+        mutations: list[AmoMutation],
+    ) -> list[AmoMutation]:
+        """Отправляет пачку одного вида; возвращает изменения, которые не удалось записать."""
+        endpoint, embedded_key = AMO_WRITE_ENDPOINTS[kind]
+        for mutation in mutations:
+            mutation.attempts += 1
+        try:
+            resp = await amo_api.post_entities(endpoint, [mutation.payload for mutation in mutations])
+        except asyncio.CancelledError:
+            raise
+        except AMO_NOT_SENT_ERRORS as error:
+            logger.warning("Не удалось отправить пачку %s в amoCRM: %r", kind, error)
+            return self._mark_failed(mutations, repr(error))
+        except Exception as error:
+            logger.warning("Пачка %s могла дойти до amoCRM, повтора не будет: %r", kind, error)
+            return self._mark_failed(mutations, f"request may have been applied: {error!r}", retryable=False)
+
+        if resp.status_code != 200:
+            logger.warning(
+                "amoCRM отклонил пачку %s: status_code=%s, size=%s, body=%s",
+                kind,
+                resp.status_code,
+                len(mutations),
+                resp.text,
+            )
+            return self._mark_failed(
+                mutations,
+                f"status_code={resp.status_code}: {resp.text}",
+                retryable=resp.status_code < 500 or amo_response_not_applied(resp),
+            )
+
+        created = (resp.json().get("_embedded") or {}).get(embedded_key) or []
+        for index, mutation in enumerate(mutations):
+            if not mutation.future.done():
+                # amoCRM возвращает сущности в порядке запроса
+                mutation.future.set_result(created[index] if index < len(created) else None)
+        return []
+
+    @staticmethod
+    def _mark_failed(mutations: list[AmoMutation], error: str, retryable: bool = True) -> list[AmoMutation]:
+        for mutation in mutations:
+            mutation.solo = mutation.solo or len(mutations) > 1
+            mutation.last_error = error
+            mutation.retryable = retryable
+        return mutations
+
+    def _retry_later(self, mutation: AmoMutation, delay: float | None = None) -> None:
+        def requeue() -> None:
+            self._retrying.pop(id(mutation), None)
+            try:
+                self._queue.put_nowait(mutation)
+            except asyncio.QueueFull:
+                logger.warning("Очередь записи amoCRM переполнена, повтор %s отложен", mutation.kind)
+                self._retry_later(mutation, self.retry_delay)
+
+        if delay is None:
+            delay = self.retry_delay * mutation.attempts
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retrying[id(mutation)] = (handle, mutation)
+
+    def _take_overflow(self) -> list[AmoMutation]:
+        overflow, self._overflow = self._overflow, []
+        return overflow
+
+    async def _give_up(
+        self,
+        session_factory: Callable[[], Session],
+        mutations: list[AmoMutation],
+    ) -> None:
+        by_error: dict[str, list[AmoMutation]] = {}
+        for mutation in mutations:
+            by_error.setdefault(mutation.last_error or "", []).append(mutation)
+        for error, failed in by_error.items():
+            logger.error(
+                "Изменения amoCRM отправлены в dead-letter: kind=%s, count=%s, error=%s",
+                failed[0].kind,
+                len(failed),
+                error,
+            )
+            try:
+                await asyncio.to_thread(
+                    store_dead_letters, session_factory, failed, error, self.dead_letter_limit
+                )
+            except Exception:
+                logger.exception("Не удалось сохранить dead-letter изменений amoCRM")
+            for mutation in failed:
+                if not mutation.future.done():
+                    mutation.future.set_exception(AmoWriteError(error))
+                    # ошибку получит тот, кто ждёт future; остальным она не нужна в логе
+                    mutation.future.exception()
+
+    async def process(
+        self,
+        amo_api: AmoCRMWrapperAsync,
+        session_factory: Callable[[], Session],
+        batch: dict[str, list[AmoMutation]],
+        *,
+        retry: bool = True,
+    ) -> None:
+        for kind, mutations in batch.items():
+            together = [mutation for mutation in mutations if not mutation.solo]
+            chunks = [
+                together[index:index + self.max_batch_size]
+                for index in range(0, len(together), self.max_batch_size)
+            ]
+            chunks.extend([mutation] for mutation in mutations if mutation.solo)
+
+            exhausted: list[AmoMutation] = []
+            for chunk in chunks:
+                for mutation in await self.send(amo_api, kind, chunk):
+                    if retry and mutation.retryable and mutation.attempts < self.max_attempts:
+                        self._retry_later(mutation)
+                    else:
+                        exhausted.append(mutation)
+            if exhausted:
+                await self._give_up(session_factory, exhausted)
+
+    async def drain(
+        self,
+        amo_api: AmoCRMWrapperAsync,
+        session_factory: Callable[[], Session],
+    ) -> None:
+        """
+        Дописывает всё незаписанное при остановке сервиса, после отмены run:
+        дожидается пачки, которую обработчик уже отправляет, затем одним
+        заходом без повторов отправляет недособранную пачку, очередь и
+        отложенные повторы. Что не удалось записать, уходит в dead-letter.
+        """
+        if self._in_flight is not None:
+            await asyncio.gather(self._in_flight, return_exceptions=True)
+            self._in_flight = None
+
+        batch, self._collecting = self._collecting, {}
+        retrying = list(self._retrying.values())
+        self._retrying.clear()
+        for handle, mutation in retrying:
+            handle.cancel()
+            batch.setdefault(mutation.kind, []).append(mutation)
+        while not self._queue.empty():
+            mutation = self._queue.get_nowait()
+            batch.setdefault(mutation.kind, []).append(mutation)
+        if batch:
+            await self.process(amo_api, session_factory, batch, retry=False)
+        if self._overflow:
+            await self._give_up(session_factory, self._take_overflow())
+
+    async def run(
+        self,
+        amo_api: AmoCRMWrapperAsync,
+        session_factory: Callable[[], Session],
+    ) -> None:
+        while True:
+            batch = await self.next_batch()
+            self._in_flight = asyncio.ensure_future(self.process(amo_api, session_factory, batch))
+            try:
+                # отмена run при остановке не обрывает отправку: пачку дожидается drain
+                await asyncio.shield(self._in_flight)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    "Не удалось обработать пачку записи в amoCRM: %s",
+                    {kind: len(mutations) for kind, mutations in batch.items()},
+                )
+            self._in_flight = None
+            if self._overflow:
+                await self._give_up(session_factory, self._take_overflow())
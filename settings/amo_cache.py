@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable, Iterable
+from typing import Any, Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class AsyncTTLCache(Generic[K, V]):
+    """
+    Асинхронный кэш с ограничением по времени жизни (TTL) и числу записей (LRU).
+
+    Одновременные промахи по одному ключу схлопываются: загрузка идёт один
+    раз отдельной задачей, все вызовы ждут её результат. Ошибки загрузки
+    не кэшируются.
+    ``maxsize=0`` или ``ttl=0`` отключают хранение, но не схлопывание.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        ttl: float = 300.0,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        if ttl < 0:
+            raise ValueError("ttl must not be negative")
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self._clock = clock
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._inflight: dict[K, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.hits = 0
+        self.misses = 0
+        # сколько раз вызов присоединился к уже идущей загрузке того же ключа
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+    def _lookup(self, key: K) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key: K, default: Any = None) -> V | Any:
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def set(self, key: K, value: V) -> None:
+        if self.maxsize == 0 or self.ttl == 0:
+            return
+        self._data[key] = (self._clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, keys: K | Iterable[K] | None = None) -> None:
+        """
+        Сбрасывает один ключ, набор ключей (список/множество) или, без
+        аргумента, весь кэш. Уже идущие загрузки не отменяются.
+        """
+        if keys is None:
+            self._data.clear()
+            return
+        if isinstance(keys, (list, set, frozenset)):
+            for key in keys:
+                self._data.pop(key, None)
+            return
+        self._data.pop(keys, None)
+
+    def invalidate_where(self, predicate: Callable[[K], bool]) -> None:
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def _start_load(
+        self,
+        keys: list[K],
+        loader: Callable[[list[K]], Awaitable[dict[K, V]]],
+        store: Callable[[V], bool] | None,
+    ) -> asyncio.Task:
+        """
+        Запускает загрузку отдельной задачей: отмена одного из ожидающих не
+        прерывает запрос для остальных.
+        """
+
+        async def load() -> dict[K, V]:
+            try:
+                loaded = await loader(keys)
+                for key in keys:
+                    value = loaded.get(key, _MISSING)
+                    if value is not _MISSING and (store is None or store(value)):
+                        self.set(key, value)
+                return loaded
+            finally:
+                for key in keys:
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+
+        task = asyncio.get_running_loop().create_task(load())
+        task.add_done_callback(_retrieve_exception)
+        for key in keys:
+            self._inflight[key] = task
+        return task
+
+    async def _wait(self, task: asyncio.Task) -> dict[K, V]:
+        """
+        Ждёт общую загрузку. Если отменены все ожидающие, загрузка тоже
+        отменяется, чтобы не тратить запрос, результат которого никому не нужен.
+        """
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters[task] == 1:
+                for key in [key for key, running in self._inflight.items() if running is task]:
+                    del self._inflight[key]
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    async def get_or_load(
+        self,
+        key: K,
+        loader: Callable[[], Awaitable[V]],
+        *,
+        store: Callable[[V], bool] | None = None,
+    ) -> V:
+        """
+        Значение из кэша или результат loader. store решает, сохранять ли
+        загруженное значение; одновременные вызовы получают его в любом случае.
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.hits += 1
+            self.coalesced += 1
+        else:
+            self.misses += 1
+
+            async def load_one(keys: list[K]) -> dict[K, V]:
+                return {key: await loader()}
+
+            task = self._start_load([key], load_one, store)
+        return (await self._wait(task))[key]
+
+    async def get_or_load_many(
+        self,
+        keys: Iterable[K],
+        loader: Callable[[list[K]], Awaitable[dict[K, V]]],
+    ) -> dict[K, V]:
+        """
+        Возвращает значения для набора ключей; отсутствующие в кэше загружаются
+        одним вызовом loader. Ключи, которых нет в ответе loader, в результат
+        не попадают и не кэшируются.
+        """
+        result: dict[K, V] = {}
+        waiting: dict[K, asyncio.Task] = {}
+        to_load: list[K] = []
+        for key in dict.fromkeys(keys):
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                result[key] = value
+            elif key in self._inflight:
+                self.hits += 1
+                self.coalesced += 1
+                waiting[key] = self._inflight[key]
+            else:
+                self.misses += 1
+                to_load.append(key)
+
+        if to_load:
+            task = self._start_load(to_load, loader, None)
+            for key in to_load:
+                waiting[key] = task
+
+        for task in dict.fromkeys(waiting.values()):
+            loaded = await self._wait(task)
+            for key, waited_task in waiting.items():
+                if waited_task is task and key in loaded:
+                    result[key] = loaded[key]
+        return result
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    # ошибку получают ожидающие; если их не осталось, не шумим в лог event loop
+    if not task.cancelled():
+        task.exception()
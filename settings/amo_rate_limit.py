@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+
+
+class AmoRateLimiter:
+    """
+    Token bucket для запросов к amoCRM.
+
+    Ограничивает частоту запросов (``requests_per_second`` с запасом ``burst``)
+    и отдельно число одновременных запросов (``max_concurrency``).
+    Ожидание токена не удерживает блокировку, поэтому параллельные запросы
+    проходят в пределах лимита, а не выстраиваются в очередь друг за другом.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 7.0,
+        burst: int = 7,
+        max_concurrency: int = 7,
+    ) -> None:
+        if requests_per_second <= 0:
+            raise ValueError("requests_per_second must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+
+        self.requests_per_second = float(requests_per_second)
+        self.burst = int(burst)
+        self.max_concurrency = int(max_concurrency)
+
+        self._tokens = float(self.burst)
+        self._updated_at: float | None = None
+        self._paused_until = 0.0
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self) -> AmoRateLimiter:
+        await self._semaphore.acquire()
+        try:
+            await self.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._semaphore.release()
+
+    def _refill(self, now: float) -> None:
+        if self._updated_at is None:
+            self._updated_at = now
+            return
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(
+                float(self.burst),
+                self._tokens + elapsed * self.requests_per_second,
+            )
+            self._updated_at = now
+
+    async def acquire(self) -> None:
+        """
+        Резервирует один токен и ждёт, пока он станет доступен.
+
+        Токен списывается сразу (баланс может уйти в минус), поэтому каждый
+        ожидающий получает своё время старта и конкурирующие вызовы не
+        просыпаются одновременно.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._refill(now)
+        self._tokens -= 1.0
+
+        wait_for = max(0.0, -self._tokens / self.requests_per_second)
+        wait_for = max(wait_for, self._paused_until - now)
+        if wait_for > 0:
+            await asyncio.sleep(wait_for)
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов, например после ответа 429."""
+        if seconds <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
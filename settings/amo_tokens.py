@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import IO
+from uuid import uuid4
+
+import dotenv
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import AmoOAuthToken
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+TOKEN_STORE_KINDS = ("env", "file", "db")
+# сколько держится право на обновление, если обновляющий процесс упал
+REFRESH_LEASE_SECONDS = 60.0
+
+
+@dataclass(frozen=True)
+class AmoTokens:
+    access_token: str
+    refresh_token: str
+
+
+class AmoTokenStore(ABC):
+    """
+    Общее хранилище OAuth-токенов amoCRM для нескольких воркеров.
+
+    Токены обновляет только процесс, получивший право на обновление
+    (``try_acquire_refresh``); остальные перечитывают новые токены через
+    ``load``. Методы блокирующие, клиент вызывает их через ``asyncio.to_thread``.
+    """
+
+    @abstractmethod
+    def load(self) -> AmoTokens | None:
+        ...
+
+    @abstractmethod
+    def save(self, tokens: AmoTokens) -> None:
+        ...
+
+    @abstractmethod
+    def try_acquire_refresh(self) -> bool:
+        """Пытается без ожидания стать обновляющим процессом."""
+
+    @abstractmethod
+    def release_refresh(self) -> None:
+        ...
+
+
+class _FlockRefreshMixin:
+    """Выбор обновляющего процесса через flock на соседнем .lock-файле."""
+
+    lock_path: Path
+    _lock_file: IO[str] | None = None
+
+    def try_acquire_refresh(self) -> bool:
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a+")
+        if fcntl is None:
+            # без flock выбор возможен только внутри одного процесса
+            self._lock_file = lock_file
+            return True
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release_refresh(self) -> None:
+        lock_file, self._lock_file = self._lock_file, None
+        if lock_file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+
+class FileTokenStore(_FlockRefreshMixin, AmoTokenStore):
+    """JSON-файл с токенами; запись атомарная через временный файл и os.replace."""
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+
+    def load(self) -> AmoTokens | None:
+        try:
+            payload = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.exception("Не удалось прочитать файл токенов amoCRM: %s", self.path)
+            return None
+        access_token = payload.get("access_token")
+        refresh_token = payload.get("refresh_token")
+        if not access_token or not refresh_token:
+            return None
+        return AmoTokens(access_token=access_token, refresh_token=refresh_token)
+
+    def save(self, tokens: AmoTokens) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
+                json.dump(
+                    {
+                        "access_token": tokens.access_token,
+                        "refresh_token": tokens.refresh_token,
+                        "updated_at": int(time.time()),
+                    },
+                    temp_file,
+                )
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+
+
+class EnvFileTokenStore(_FlockRefreshMixin, AmoTokenStore):
+    """Прежнее поведение: токены хранятся в .env в AMOCRM_ACCESS_TOKEN/AMOCRM_REFRESH_TOKEN."""
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+
+    def load(self) -> AmoTokens | None:
+        values = dotenv.dotenv_values(self.path)
+        access_token = values.get("AMOCRM_ACCESS_TOKEN")
+        refresh_token = values.get("AMOCRM_REFRESH_TOKEN")
+        if not access_token or not refresh_token:
+            return None
+        return AmoTokens(access_token=access_token, refresh_token=refresh_token)
+
+    def save(self, tokens: AmoTokens) -> None:
+        dotenv.set_key(str(self.path), "AMOCRM_ACCESS_TOKEN", tokens.access_token)
+        dotenv.set_key(str(self.path), "AMOCRM_REFRESH_TOKEN", tokens.refresh_token)
+
+
+class DatabaseTokenStore(AmoTokenStore):
+    """
+    Токены в таблице amo_oauth_tokens. Право на обновление — аренда строки
+    на REFRESH_LEASE_SECONDS: её перехватывают, только если владелец не
+    освободил её вовремя.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        key: str = "default",
+        lease_seconds: float = REFRESH_LEASE_SECONDS,
+    ) -> None:
+        self.session_factory = session_factory
+        self.key = key
+        self.lease_seconds = float(lease_seconds)
+        self.owner = f"{os.getpid()}-{uuid4().hex[:12]}"
+
+    def load(self) -> AmoTokens | None:
+        with self.session_factory() as session:
+            row = session.get(AmoOAuthToken, self.key)
+            if row is None or not row.access_token or not row.refresh_token:
+                return None
+            return AmoTokens(access_token=row.access_token, refresh_token=row.refresh_token)
+
+    def save(self, tokens: AmoTokens) -> None:
+        with self.session_factory() as session, session.begin():
+            row = session.get(AmoOAuthToken, self.key)
+            if row is None:
+                row = AmoOAuthToken(key=self.key)
+                session.add(row)
+            row.access_token = tokens.access_token
+            row.refresh_token = tokens.refresh_token
+            row.updated_at = datetime.utcnow()
+
+    def _ensure_row(self) -> None:
+        try:
+            with self.session_factory() as session, session.begin():
+                if session.get(AmoOAuthToken, self.key) is None:
+                    session.add(AmoOAuthToken(key=self.key, updated_at=datetime.utcnow()))
+        except IntegrityError:
+            # строку одновременно создал другой процесс
+            pass
+
+    def try_acquire_refresh(self) -> bool:
+        self._ensure_row()
+        now = time.time()
+        with self.session_factory() as session, session.begin():
+            result = session.execute(
+                update(AmoOAuthToken)
+                .where(
+                    AmoOAuthToken.key == self.key,
+                    or_(
+                        AmoOAuthToken.refresh_lease_until.is_(None),
+                        AmoOAuthToken.refresh_lease_until < now,
+                        AmoOAuthToken.refresh_owner == self.owner,
+                    ),
+                )
+                .values(refresh_owner=self.owner, refresh_lease_until=now + self.lease_seconds)
+            )
+            return result.rowcount == 1
+
+    def release_refresh(self) -> None:
+        with self.session_factory() as session, session.begin():
+            session.execute(
+                update(AmoOAuthToken)
+                .where(AmoOAuthToken.key == self.key, AmoOAuthToken.refresh_owner == self.owner)
+                .values(refresh_owner=None, refresh_lease_until=None)
+            )
+
+
+def create_token_store(
+    kind: str,
+    *,
+    env_path: str,
+    file_path: str,
+    session_factory: Callable[[], Session],
+) -> AmoTokenStore:
+    if kind == "env":
+        return EnvFileTokenStore(env_path)
+    if kind == "file":
+        return FileTokenStore(file_path)
+    if kind == "db":
+        return DatabaseTokenStore(session_factory)
+    raise ValueError(f"Unknown amoCRM token store: {kind!r}, expected one of {TOKEN_STORE_KINDS}")
@@ -1,20 +1,88 @@
 import asyncio
+import heapq
 import json
 import logging
+import time
+from array import array
+from collections.abc import AsyncIterator, Callable, Iterable, Sequence
 from dataclasses import dataclass
 from datetime import datetime
+from email.utils import formatdate
 from typing import Any, Optional
 
-import dotenv
 import httpx
 import jwt
 
+from settings.amo_cache import AsyncTTLCache
+from settings.amo_decoding import custom_field_values, decode_embedded
+from settings.amo_rate_limit import AmoRateLimiter
+from settings.amo_tokens import AmoTokens, AmoTokenStore, EnvFileTokenStore
+from utils.utils import correct_phone
+
 logger = logging.getLogger(__name__)
 
+# Воронка и статусы сделок, попадающих в аналитику
+ANALYTICS_PIPELINE_ID = 1628622
+ANALYTICS_STATUS_IDS = (142, 24709308, 38737875, 64191281, 50957124)
+# Доп. поля amoCRM, которые читает сервис
+LEAD_SHIPMENT_AT_FIELD_ID = 935651
+LEAD_PAID_AT_FIELD_ID = 1104770
+LEAD_PROJECT_FIELD_ID = 938609
+LEAD_DISCOUNT_FIELD_ID = 972024
+LEAD_DELIVERY_FIELD_ID = 972028
+CUSTOMER_STATUS_FIELD_ID = 972634
+CONTACT_ATTESTATE_AT_FIELD_ID = 1096322
+CONTACT_PHONE_FIELD_CODE = "PHONE"
+# какие поля извлекать из сущности каждого типа за один проход
+ENTITY_FIELD_IDS: dict[str, frozenset[int]] = {
+    "leads": frozenset({
+        LEAD_SHIPMENT_AT_FIELD_ID,
+        LEAD_PAID_AT_FIELD_ID,
+        LEAD_PROJECT_FIELD_ID,
+        LEAD_DISCOUNT_FIELD_ID,
+        LEAD_DELIVERY_FIELD_ID,
+    }),
+    "customers": frozenset({CUSTOMER_STATUS_FIELD_ID}),
+    "contacts": frozenset({CONTACT_ATTESTATE_AT_FIELD_ID}),
+}
+# куда отправлять пачки изменений и в каком ключе _embedded amoCRM возвращает результат
+AMO_WRITE_ENDPOINTS: dict[str, tuple[str, str]] = {
+    "tasks": ("/api/v4/tasks", "tasks"),
+    "contacts": ("/api/v4/contacts", "contacts"),
+    "leads": ("/api/v4/leads", "leads"),
+    "lead_notes": ("/api/v4/leads/notes", "notes"),
+    "lead_links": ("/api/v4/leads/link", "links"),
+}
+# amoCRM принимает не больше 250 сущностей в одном запросе на создание
+AMO_WRITE_BATCH_LIMIT = 250
+# запрос не ушёл в amoCRM: повтор безопасен и для POST, создающего сущности
+AMO_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# как часто перечитывать хранилище, пока токены обновляет другой процесс
+TOKEN_STORE_POLL_INTERVAL = 0.5
+TOKEN_STORE_WAIT_TIMEOUT = 30.0
+
+
+def amo_response_not_applied(resp: httpx.Response) -> bool:
+    """
+    amoCRM точно не выполнил запрос: 429 или 5xx без тела (ответ прокси до
+    amoCRM). 5xx с телом может прийти и после того, как сущности созданы.
+    """
+    return resp.status_code == 429 or (resp.status_code >= 500 and not resp.content)
+
 
+class AmoAPIError(RuntimeError):
+    """amoCRM не отдал страницу списка; неполный список нельзя считать полным."""
 
+    def __init__(self, endpoint: str, status_code: int, body: str = "") -> None:
+        super().__init__(f"amoCRM request to {endpoint} failed: status_code={status_code}, body={body[:500]}")
+        self.endpoint = endpoint
+        self.status_code = status_code
 
-@dataclass
+
+# Записи аналитики держатся в памяти сотнями тысяч: __slots__ убирает
+# __dict__ у каждого объекта, а id контактов покупателя хранятся в array
+# без упаковки каждого числа в отдельный int.
+@dataclass(slots=True)
 class AmoLead:
     lead_id: int
     lead_price: int | float | None
@@ -27,7 +95,9 @@ class AmoLead:
     time_from_attestate: int | str | None = None
     paid_at: int | None = None
     project: str | None | int = None
-
+    pipeline_id: int | None = None
+    status_id: int | None = None
+    updated_at: int | None = None
 
     @property
     def price(self) -> int | float | None:
@@ -38,26 +108,33 @@ class AmoLead:
         self.lead_price = value
 
 
-@dataclass
+@dataclass(slots=True)
 class AmoContact:
     contact_id: int
     customer_id: int | None
     attestate_at: str | int | None
+    updated_at: int | None = None
+    phones: tuple[str, ...] = ()
 
-@dataclass
+@dataclass(slots=True)
 class AmoCustomers:
     customer_id: int | None
     created_at:int | None
-    contacts_id: list[int]
+    contacts_id: Sequence[int]
     status: str | int | None = None
+    updated_at: int | None = None
+
+    def __post_init__(self) -> None:
+        if not isinstance(self.contacts_id, array):
+            self.contacts_id = array("q", self.contacts_id)
 
 
-@dataclass
+@dataclass(slots=True)
 class AmoResult:
     lead_obj: AmoLead
     customer_obj: AmoCustomers
 
-@dataclass
+@dataclass(slots=True)
 class AmoResultAnalizeCustomers:
     lead_list: list[AmoLead,]
     customer_obj: AmoCustomers
@@ -71,29 +148,88 @@ def build_amo_results_analize_customers(
     logger.info(f'Количество объектов Покупатель: {len(customers)}')
     result: list[AmoResultAnalizeCustomers] = []
     leads = [lead for lead in leads if lead.project != "Крупные заказы"]
+    # позиции сделок по контакту за один проход; покупатель собирает свои
+    # сделки только из списков своих контактов
+    positions_by_contact: dict[int | None, list[int]] = {}
+    for position, lead_obj in enumerate(leads):
+        positions_by_contact.setdefault(lead_obj.contact_id, []).append(position)
+
     for customer_obj in customers:
-        res = AmoResultAnalizeCustomers(customer_obj=customer_obj, lead_list=[])
-        for lead_obj in leads:
-            if lead_obj.contact_id in customer_obj.contacts_id:
-                res.lead_list.append(lead_obj)
-        result.append(res)
+        groups = [
+            positions_by_contact[contact_id]
+            for contact_id in dict.fromkeys(customer_obj.contacts_id)
+            if contact_id in positions_by_contact
+        ]
+        # у разных контактов позиции не пересекаются, слияние сохраняет порядок сделок
+        positions = groups[0] if len(groups) == 1 else heapq.merge(*groups)
+        result.append(
+            AmoResultAnalizeCustomers(
+                customer_obj=customer_obj,
+                lead_list=[leads[position] for position in positions],
+            )
+        )
 
     return result
 
 
+def contact_phones(contact: dict) -> tuple[str, ...]:
+    """Телефоны контакта amoCRM, нормализованные так же, как correct_phone."""
+    phones: dict[str, None] = {}
+    for field in contact.get("custom_fields_values") or ():
+        if field.get("field_code") != CONTACT_PHONE_FIELD_CODE:
+            continue
+        for value in field.get("values") or ():
+            phone = correct_phone(str(value.get("value") or ""))
+            if phone:
+                phones[phone] = None
+    return tuple(phones)
+
+
+def index_customers_by_contact(
+    customers: Iterable[AmoCustomers],
+    index: dict[int, list[AmoCustomers]] | None = None,
+) -> dict[int, list[AmoCustomers]]:
+    """
+    Строит (или дополняет) индекс contact_id → покупатели в исходном порядке
+    покупателей. Повторы контакта у одного покупателя не дублируют запись.
+    """
+    if index is None:
+        index = {}
+    for customer_obj in customers:
+        for contact_id in dict.fromkeys(customer_obj.contacts_id):
+            index.setdefault(contact_id, []).append(customer_obj)
+    return index
+
+
+def join_leads_with_customers(
+    leads: Iterable[AmoLead],
+    customers_by_contact: dict[int, list[AmoCustomers]],
+) -> list[AmoResult]:
+    """Сопоставляет сделки покупателям по индексу; сделки без покупателя отбрасываются."""
+    return [
+        AmoResult(lead_obj=lead_obj, customer_obj=customer_obj)
+        for lead_obj in leads
+        for customer_obj in customers_by_contact.get(lead_obj.contact_id, ())
+    ]
+
+
 def build_amo_results(
     leads: list[AmoLead],
     customers: list[AmoCustomers],
 ) -> list[AmoResult]:
     logger.info(f'Количество объектов Лид: {len(leads)}')
     logger.info(f'Количество объектов Покупатель: {len(customers)}')
-    result: list[AmoResult] = []
-    for lead_obj in leads:
-        lead_contact_id = lead_obj.contact_id
-        for customer_obj in customers:
-            if lead_contact_id in customer_obj.contacts_id:
-                result.append(AmoResult(lead_obj=lead_obj, customer_obj=customer_obj))
-                continue
+    # индекс contact_id → покупатели вместо перебора всех покупателей на каждую
+    # сделку; порядок записей тот же: сделки по порядку, покупатели по порядку
+    result = join_leads_with_customers(leads, index_customers_by_contact(customers))
+    return compute_amo_result_metrics(result)
+
+
+def compute_amo_result_metrics(result: list[AmoResult]) -> list[AmoResult]:
+    """
+    Считает по сопоставленным сделкам время с аттестации, чистый выкуп и
+    время с прошлой покупки. Возвращает записи, отсортированные по id сделки.
+    """
     # Откидываем лиды с пустым значением даты отгрузки и сортируем список сделок по дате отгрузки
     # result = sorted(filter(lambda x: x.lead_obj.shipment_at != 0, result), key=lambda x: x.lead_obj.shipment_at)
 
@@ -103,6 +239,13 @@ def build_amo_results(
     # Третий вариант, добавляем фильтр по проекту, проект "Крупные заказы - откидываем"
     result = sorted(filter(lambda x: x.lead_obj.project != "Крупные заказы", result), key=lambda x: x.lead_obj.shipment_at)
 
+    # Один проход с накопителями по покупателю вместо пересборки списка прошлых
+    # сделок покупателя на каждой записи. Для покупателя хранятся сумма цен всех
+    # его прошлых сделок, кроме последней, цена последней и её дата отгрузки:
+    # цена добавляется в сумму только когда появляется следующая сделка, поэтому
+    # порядок сложения и поведение на некорректной цене такие же, как у sum()
+    # по прошлым сделкам.
+    previous_by_customer: dict[Any, list] = {}
     for index, record in enumerate(result):
         current_lead = record.lead_obj
         current_customer = record.customer_obj
@@ -118,25 +261,31 @@ def build_amo_results(
             logger.error(error)
 
         # Считаем поле "Чистый выкуп до текущей покупки и дату прошлой покупки
+        previous = previous_by_customer.get(current_customer.customer_id)
         if index != 0:
-            records_by_customer = list(filter(lambda x: x.customer_obj.customer_id == current_customer.customer_id, result[:index]))
-            if records_by_customer:
-                clean_price = sum(record.lead_obj.price for record in records_by_customer)
-                current_lead.clean_price = clean_price
+            if previous is not None:
+                total_before_last, last_price, last_shipment_at = previous
+                current_lead.clean_price = total_before_last + last_price
                 try:
-                    if current_lead.shipment_at and records_by_customer[-1].lead_obj.shipment_at:
-                        current_lead.last_buy = current_lead.shipment_at - records_by_customer[-1].lead_obj.shipment_at
+                    if current_lead.shipment_at and last_shipment_at:
+                        current_lead.last_buy = current_lead.shipment_at - last_shipment_at
                     else:
                         current_lead.last_buy = 0
                 except BaseException as error:
                     current_lead.last_buy = 0
                     logger.error(error)
-                    logger.error(current_lead.shipment_at, records_by_customer[-1].lead_obj.shipment_at)
-
+                    logger.error("%s %s", current_lead.shipment_at, last_shipment_at)
             else:
                 current_lead.clean_price = 0
                 current_lead.last_buy = 0
 
+        if previous is None:
+            previous_by_customer[current_customer.customer_id] = [0, current_lead.price, current_lead.shipment_at]
+        else:
+            previous[0] = previous[0] + previous[1]
+            previous[1] = current_lead.price
+            previous[2] = current_lead.shipment_at
+
     result = sorted(result, key=lambda x: x.lead_obj.lead_id)
 
     return result
@@ -166,8 +315,20 @@ class AmoCRMWrapperAsync:
         amocrm_secret_code: str,
         *,
         timeout: float = 30.0,
-        min_delay_seconds: float = 0.5,  # как у тебя в коде
+        requests_per_second: float = 7.0,
+        burst: int = 7,
+        max_concurrency: int = 7,
         max_retries: int = 2,
+        page_prefetch: int = 4,
+        token_refresh_margin: float = 300.0,
+        token_store: AmoTokenStore | None = None,
+        users_cache_size: int = 256,
+        users_cache_ttl: float = 3600.0,
+        catalog_cache_size: int = 4096,
+        catalog_cache_ttl: float = 600.0,
+        get_reuse_ttl: float = 0.0,
+        get_reuse_size: int = 256,
+        transport: httpx.AsyncBaseTransport | None = None,
     ):
         self.path_to_env = path
         self.amocrm_subdomain = amocrm_subdomain
@@ -177,17 +338,43 @@ class AmoCRMWrapperAsync:
         self.amocrm_access_token = amocrm_access_token
         self.amocrm_refresh_token = amocrm_refresh_token
         self.amocrm_secret_code = amocrm_secret_code
+        # exp access token декодируется один раз при смене токена, а не на каждый запрос
+        self._token_expires_at = self._token_expiry(amocrm_access_token)
+        self._token_store = token_store if token_store is not None else EnvFileTokenStore(path)
 
         self._base_url = f"https://{self.amocrm_subdomain}.amocrm.ru"
         self._timeout = httpx.Timeout(timeout)
+        self._transport = transport
         self._client: Optional[httpx.AsyncClient] = None
 
         self._token_lock = asyncio.Lock()
-        self._rate_lock = asyncio.Lock()
-        self._min_delay_seconds = float(min_delay_seconds)
-        self._last_request_ts: float = 0.0
+        if token_refresh_margin < 0:
+            raise ValueError("token_refresh_margin must not be negative")
+        self._token_refresh_margin = float(token_refresh_margin)
+        self._token_refresh_task: asyncio.Task | None = None
+        self._tokens_changed = asyncio.Event()
+        # amoCRM допускает 7 запросов в секунду на интеграцию
+        self._rate_limiter = AmoRateLimiter(
+            requests_per_second=requests_per_second,
+            burst=burst,
+            max_concurrency=max_concurrency,
+        )
 
         self._max_retries = int(max_retries)
+        if page_prefetch < 1:
+            raise ValueError("page_prefetch must be at least 1")
+        self._page_prefetch = int(page_prefetch)
+
+        # пользователи и товары каталога меняются редко, а нужны на каждое КП
+        self.users_cache: AsyncTTLCache[int, dict] = AsyncTTLCache(users_cache_size, users_cache_ttl)
+        self.catalog_elements_cache: AsyncTTLCache[tuple[int, int], dict] = AsyncTTLCache(
+            catalog_cache_size, catalog_cache_ttl
+        )
+        # одинаковые одновременные GET делят один запрос; get_reuse_ttl > 0
+        # дополнительно отдаёт успешный ответ повторно в течение этого времени
+        self._get_requests: AsyncTTLCache[tuple, httpx.Response] = AsyncTTLCache(
+            get_reuse_size, get_reuse_ttl
+        )
 
     async def __aenter__(self) -> "AmoCRMWrapperAsync":
         await self.open()
@@ -202,13 +389,25 @@ class AmoCRMWrapperAsync:
         Можно вызывать несколько раз — повторно клиент не создастся.
         """
         if self._client is None:
-            self._client = httpx.AsyncClient(base_url=self._base_url, timeout=self._timeout)
+            self._client = httpx.AsyncClient(
+                base_url=self._base_url,
+                timeout=self._timeout,
+                transport=self._transport,
+            )
+        if self._token_refresh_task is None:
+            # другой воркер мог обновить токены, пока процесс не работал
+            await self._adopt_stored_tokens(margin=0.0)
+            self._token_refresh_task = asyncio.create_task(self._token_refresh_loop())
 
     async def close(self) -> None:
         """
         Явно закрывает httpx. AsyncClient.
         Безопасно при повторных вызовах.
         """
+        if self._token_refresh_task is not None:
+            self._token_refresh_task.cancel()
+            await asyncio.gather(self._token_refresh_task, return_exceptions=True)
+            self._token_refresh_task = None
         if self._client is not None:
             await self._client.aclose()
             self._client = None
@@ -216,37 +415,51 @@ class AmoCRMWrapperAsync:
     # ---------- token helpers ----------
 
     @staticmethod
-    def _is_expire(token: str) -> bool:
+    def _token_expiry(token: str | None) -> float:
+        """Возвращает exp из JWT; битый или пустой токен считается истёкшим."""
+        if not token:
+            return 0.0
         try:
             token_data = jwt.decode(token, options={"verify_signature": False})
-            exp = datetime.utcfromtimestamp(token_data["exp"])
-            return datetime.utcnow() >= exp
+            return float(token_data["exp"])
         except Exception:
-            # если токен битый/пустой — считаем истёкшим
-            return True
+            return 0.0
 
-    def _save_tokens(self, access_token: str, refresh_token: str) -> None:
-        dotenv.set_key(self.path_to_env, "AMOCRM_ACCESS_TOKEN", access_token)
-        dotenv.set_key(self.path_to_env, "AMOCRM_REFRESH_TOKEN", refresh_token)
+    def _is_token_expired(self) -> bool:
+        return time.time() >= self._token_expires_at
+
+    def _use_tokens(self, access_token: str, refresh_token: str) -> None:
         self.amocrm_access_token = access_token
         self.amocrm_refresh_token = refresh_token
+        self._token_expires_at = self._token_expiry(access_token)
+        self._tokens_changed.set()
+
+    async def _save_tokens(self, access_token: str, refresh_token: str) -> None:
+        self._use_tokens(access_token, refresh_token)
+        await asyncio.to_thread(
+            self._token_store.save,
+            AmoTokens(access_token=access_token, refresh_token=refresh_token),
+        )
+
+    async def _adopt_stored_tokens(self, margin: float) -> bool:
+        """
+        Подхватывает токены, сохранённые другим процессом, если они свежее
+        текущих и проживут дольше margin секунд.
+        """
+        stored = await asyncio.to_thread(self._token_store.load)
+        if stored is None or stored.access_token == self.amocrm_access_token:
+            return False
+        expires_at = self._token_expiry(stored.access_token)
+        if expires_at <= max(time.time() + margin, self._token_expires_at):
+            return False
+        self._use_tokens(stored.access_token, stored.refresh_token)
+        return True
 
     def _get_access_token(self) -> str:
         if not self.amocrm_access_token:
             raise RuntimeError("AMOCRM_ACCESS_TOKEN is empty")
         return self.amocrm_access_token
 
-    async def _throttle(self) -> None:
-        """
-        Гарантирует min_delay_seconds между запросами (не блокирует event loop).
-        """
-        async with self._rate_lock:
-            now = asyncio.get_running_loop().time()
-            wait_for = (self._last_request_ts + self._min_delay_seconds) - now
-            if wait_for > 0:
-                await asyncio.sleep(wait_for)
-            self._last_request_ts = asyncio.get_running_loop().time()
-
     async def _get_new_tokens(self) -> bool:
         if not self.amocrm_refresh_token:
             logger.error("AMOCRM_REFRESH_TOKEN is empty")
@@ -262,8 +475,8 @@ class AmoCRMWrapperAsync:
             "redirect_uri": self.amocrm_redirect_url,
         }
 
-        await self._throttle()
-        resp = await self._client.post("/oauth2/access_token", json=data)
+        async with self._rate_limiter:
+            resp = await self._client.post("/oauth2/access_token", json=data)
 
         try:
             payload = resp.json()
@@ -277,26 +490,81 @@ class AmoCRMWrapperAsync:
             logger.error("Ошибка обновления токенов: %s", payload)
             return False
 
-        self._save_tokens(access_token, refresh_token)
+        await self._save_tokens(access_token, refresh_token)
         return True
 
     async def _ensure_token(self) -> None:
-        token = self.amocrm_access_token
-        if not token:
+        """
+        Проверяет закэшированный срок жизни токена. Обычно токен заранее
+        обновляет фоновая задача, и запрос здесь не ждёт; синхронное
+        обновление остаётся запасным путём, если токен всё же истёк.
+        """
+        if not self.amocrm_access_token:
             raise RuntimeError("Access token is not set. Call init_oauth2() or provide token.")
 
-        if not self._is_expire(token):
+        if not self._is_token_expired():
             return
 
+        if not await self._refresh_tokens(margin=0.0):
+            raise RuntimeError("Failed to refresh AmoCRM tokens")
+
+    async def _refresh_tokens(self, margin: float) -> bool:
+        """
+        Обновляет токены, если они проживут меньше margin секунд. Из всех
+        процессов OAuth-запрос делает только получивший право в хранилище
+        токенов, остальные дожидаются и подхватывают его результат.
+        """
         async with self._token_lock:
-            # double-check после ожидания lock
-            token2 = self.amocrm_access_token
-            if token2 and not self._is_expire(token2):
-                return
+            # double-check после ожидания lock: токен мог обновить другой вызов
+            if time.time() + margin < self._token_expires_at:
+                return True
+            if await self._adopt_stored_tokens(margin):
+                return True
+
+            deadline = time.time() + TOKEN_STORE_WAIT_TIMEOUT
+            while not await asyncio.to_thread(self._token_store.try_acquire_refresh):
+                if time.time() >= deadline:
+                    logger.error("Не дождались обновления токенов amoCRM другим процессом")
+                    return False
+                await asyncio.sleep(TOKEN_STORE_POLL_INTERVAL)
+                if await self._adopt_stored_tokens(margin):
+                    return True
 
-            ok = await self._get_new_tokens()
-            if not ok:
-                raise RuntimeError("Failed to refresh AmoCRM tokens")
+            try:
+                # пока ждали право на обновление, токены мог сохранить другой процесс
+                if await self._adopt_stored_tokens(margin):
+                    return True
+                return await self._get_new_tokens()
+            finally:
+                await asyncio.to_thread(self._token_store.release_refresh)
+
+    async def _token_refresh_loop(self) -> None:
+        """Обновляет токен за token_refresh_margin секунд до истечения."""
+        retry_delay = 30.0
+        while True:
+            self._tokens_changed.clear()
+            if not self.amocrm_refresh_token:
+                # ждём init_oauth2() или ручной установки токенов
+                await self._tokens_changed.wait()
+                continue
+
+            delay = self._token_expires_at - self._token_refresh_margin - time.time()
+            if delay <= 0:
+                try:
+                    refreshed = await self._refresh_tokens(margin=self._token_refresh_margin)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Фоновое обновление токенов amoCRM завершилось ошибкой")
+                    refreshed = False
+                delay = self._token_expires_at - self._token_refresh_margin - time.time()
+                if not refreshed or delay <= 0:
+                    delay = retry_delay
+
+            try:
+                await asyncio.wait_for(self._tokens_changed.wait(), timeout=delay)
+            except TimeoutError:
+                pass
 
     async def init_oauth2(self) -> dict[str, Any]:
         """
@@ -312,13 +580,13 @@ class AmoCRMWrapperAsync:
             "redirect_uri": self.amocrm_redirect_url,
         }
 
-        await self._throttle()
-        resp = await self._client.post("/oauth2/access_token", json=data)
+        async with self._rate_limiter:
+            resp = await self._client.post("/oauth2/access_token", json=data)
         payload = resp.json()
 
         access_token = payload["access_token"]
         refresh_token = payload["refresh_token"]
-        self._save_tokens(access_token, refresh_token)
+        await self._save_tokens(access_token, refresh_token)
         return payload
 
     # ---------- request core ----------
@@ -334,26 +602,37 @@ class AmoCRMWrapperAsync:
         assert self._client is not None, "Client is not initialized. Use 'async with'."
 
         last_exc: Exception | None = None
+        # POST создаёт сущности: повтор после таймаута ответа или 5xx с телом
+        # может создать их второй раз
+        idempotent = method != "POST"
 
         for attempt in range(self._max_retries + 1):
             try:
-                await self._throttle()
-                resp = await self._client.request(method, url, headers=headers, json=json_data)
+                async with self._rate_limiter:
+                    resp = await self._client.request(method, url, headers=headers, json=json_data)
 
                 # простой retry на 429/5xx
-                if resp.status_code in (429, 500, 502, 503, 504) and attempt < self._max_retries:
+                if (
+                    resp.status_code in (429, 500, 502, 503, 504)
+                    and attempt < self._max_retries
+                    and (idempotent or amo_response_not_applied(resp))
+                ):
                     retry_after = resp.headers.get("Retry-After")
                     if retry_after and retry_after.isdigit():
-                        await asyncio.sleep(int(retry_after))
+                        delay = int(retry_after)
                     else:
-                        await asyncio.sleep(0.5 * (attempt + 1))
+                        delay = 0.5 * (attempt + 1)
+                    if resp.status_code == 429:
+                        # притормаживаем все параллельные запросы, а не только текущий
+                        self._rate_limiter.pause(delay)
+                    await asyncio.sleep(delay)
                     continue
 
                 return resp
 
-            except (httpx.ConnectError, httpx.ReadTimeout, httpx.RemoteProtocolError) as exc:
+            except (*AMO_NOT_SENT_ERRORS, httpx.ReadTimeout, httpx.RemoteProtocolError) as exc:
                 last_exc = exc
-                if attempt < self._max_retries:
+                if attempt < self._max_retries and (idempotent or isinstance(exc, AMO_NOT_SENT_ERRORS)):
                     await asyncio.sleep(0.5 * (attempt + 1))
                     continue
                 raise
@@ -361,15 +640,30 @@ class AmoCRMWrapperAsync:
         # формально недостижимо
         raise RuntimeError(f"Request failed: {last_exc!r}")
 
+    async def _coalesced_get(
+        self,
+        url: str,
+        headers: dict[str, str],
+        extra_headers: dict[str, str] | None,
+    ) -> httpx.Response:
+        """GET через слой схлопывания: ключ — метод, URL с параметрами и доп. заголовки."""
+        key = ("GET", url, tuple(sorted((extra_headers or {}).items())))
+        return await self._get_requests.get_or_load(
+            key,
+            lambda: self._request_with_retries("GET", url, headers=headers),
+            store=lambda resp: resp.status_code == 200,
+        )
+
     async def _base_request(self, **kwargs) -> httpx.Response:
         """
         Совместимо с твоей сигнатурой: type, endpoint, parameters, data.
+        Дополнительные заголовки можно передать в headers.
         Возвращает httpx.Response.
         """
         await self._ensure_token()
 
         access_token = "Bearer " + self._get_access_token()
-        headers = {"Authorization": access_token}
+        headers = {**(kwargs.get("headers") or {}), "Authorization": access_token}
 
         req_type = kwargs.get("type")
         endpoint = kwargs.get("endpoint")
@@ -379,44 +673,141 @@ class AmoCRMWrapperAsync:
         if not endpoint:
             raise ValueError("endpoint is required")
 
-        if req_type == "get":
-            return await self._request_with_retries("GET", endpoint, headers=headers)
+        if req_type in ("get", "get_param"):
+            url = f"{endpoint}?{parameters}" if req_type == "get_param" and parameters else endpoint
+            return await self._coalesced_get(url, headers, kwargs.get("headers"))
 
-        if req_type == "get_param":
-            url = f"{endpoint}?{parameters}" if parameters else endpoint
-            return await self._request_with_retries("GET", url, headers=headers)
+        if req_type in ("post", "patch"):
+            # после изменения данных повторно отданный GET мог бы устареть
+            self._get_requests.invalidate()
+            return await self._request_with_retries(
+                req_type.upper(), endpoint, headers=headers, json_data=data
+            )
+
+        raise ValueError(f"Unknown request type: {req_type}")
 
-        if req_type == "post":
-            return await self._request_with_retries("POST", endpoint, headers=headers, json_data=data)
+    async def _iter_pages(
+        self,
+        endpoint: str,
+        query: str,
+        *,
+        embedded_key: str,
+        limit: int = 250,
+        headers: dict[str, str] | None = None,
+        parse: Callable[[dict], Any] | None = None,
+        strict: bool = False,
+    ) -> AsyncIterator[list]:
+        """
+        Постранично обходит список amoCRM, держа в полёте до page_prefetch запросов.
+
+        Страницы отдаются строго по порядку. Обход заканчивается на первой
+        пустой, неполной или 204-странице; лишние запросы из окна отменяются.
+        Если передан parse, элементы страницы сразу превращаются в записи,
+        и сырые словари не переживают свою страницу. Ответ с ошибкой тоже
+        завершает обход, а со strict — поднимает AmoAPIError: так вызывающий
+        не примет оборванный список за полный.
+        """
+        pending: dict[int, asyncio.Task] = {}
+        next_page = 1
+        page = 1
 
-        if req_type == "patch":
-            return await self._request_with_retries("PATCH", endpoint, headers=headers, json_data=data)
+        def schedule() -> None:
+            nonlocal next_page
+            while len(pending) < self._page_prefetch:
+                parameters = f"limit={limit}&page={next_page}"
+                if query:
+                    parameters = f"{query}&{parameters}"
+                pending[next_page] = asyncio.create_task(
+                    self._base_request(
+                        endpoint=endpoint,
+                        type="get_param",
+                        parameters=parameters,
+                        headers=headers,
+                    )
+                )
+                next_page += 1
 
-        raise ValueError(f"Unknown request type: {req_type}")
+        try:
+            while True:
+                schedule()
+                resp = await pending.pop(page)
+
+                # 304 приходит на If-Modified-Since, если изменений нет
+                if resp.status_code in (204, 304):
+                    break
+
+                if resp.status_code != 200:
+                    if strict:
+                        raise AmoAPIError(endpoint, resp.status_code, resp.text)
+                    logger.error(
+                        "Не удалось получить %s: status_code=%s, page=%s, body=%s",
+                        embedded_key,
+                        resp.status_code,
+                        page,
+                        resp.text,
+                    )
+                    break
+
+                page_items = decode_embedded(resp.content, embedded_key)
+                page_size = len(page_items)
+                if not page_size:
+                    break
+                if parse is not None:
+                    page_items = [parse(item) for item in page_items]
+
+                yield page_items
+
+                if page_size < limit:
+                    break
+
+                page += 1
+        finally:
+            for task in pending.values():
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending.values(), return_exceptions=True)
 
     # ---------- бизнес-методы (async) ----------
 
-    async def get_contact_by_phone(self, phone_number, with_customer: bool = False) -> tuple[bool, Any]:
-        phone_number = str(phone_number)[2:]
+    async def search_contacts_by_phone(self, phone: str, with_customer: bool = False) -> list[dict]:
+        """
+        Контакты amoCRM с телефоном phone (нормализованным через correct_phone),
+        от самого старого к новому. Поиск query= находит и номера, которые лишь
+        содержат запрос, поэтому в ответе остаются только точные совпадения.
+        Ошибка amoCRM поднимает AmoAPIError.
+        """
+        phone = str(phone)
         url = "/api/v4/contacts"
-        query = f"query={phone_number}&with=customers" if with_customer else f"query={phone_number}"
+        query = f"query={phone}&with=customers" if with_customer else f"query={phone}"
 
         resp = await self._base_request(endpoint=url, type="get_param", parameters=query)
+        if resp.status_code == 204:
+            return []
+        if resp.status_code != 200:
+            raise AmoAPIError(url, resp.status_code, resp.text)
+
+        contacts = [
+            contact
+            for contact in self._get_contacts_embedded_list(resp.json())
+            if phone in contact_phones(contact)
+        ]
+        return sorted(contacts, key=lambda contact: (contact.get("created_at") or 0, contact.get("id") or 0))
 
-        if resp.status_code == 200:
-            contacts_list = resp.json()["_embedded"]["contacts"]
-            if len(contacts_list) > 1:
-                return False, (
-                    "Найдено более одного контакта с номером телефона\n"
-                    "Обратитесь к менеджеру отдела продаж!"
-                )
-            return True, contacts_list[0]
+    async def get_contact_by_phone(self, phone_number, with_customer: bool = False) -> tuple[bool, Any]:
+        try:
+            contacts_list = await self.search_contacts_by_phone(phone_number, with_customer=with_customer)
+        except AmoAPIError as error:
+            logger.error("AMO_API error: %s", error)
+            return False, "Произошла ошибка на сервере!"
 
-        if resp.status_code == 204:
+        if not contacts_list:
             return False, "Контакт не найден"
-
-        logger.error("AMO_API error: %s %s", resp.status_code, resp.text)
-        return False, "Произошла ошибка на сервере!"
+        if len(contacts_list) > 1:
+            return False, (
+                "Найдено более одного контакта с номером телефона\n"
+                "Обратитесь к менеджеру отдела продаж!"
+            )
+        return True, contacts_list[0]
 
     @staticmethod
     def _get_customer_id_from_contact(contact_data: dict) -> int | None:
@@ -450,109 +841,182 @@ class AmoCRMWrapperAsync:
                 contact_ids.append(contact_id)
         return contact_ids
 
-    async def get_customers_with_contacts(self, limit: int = 250) -> list[AmoCustomers]:
-        url = "/api/v4/customers"
-        page = 1
-        all_customers: list[AmoCustomers] = []
-
-        while True:
-            query = f"with=contacts&limit={limit}&page={page}"
-            resp = await self._base_request(endpoint=url, type="get_param", parameters=query)
-
-            if resp.status_code == 204:
-                break
-
-            if resp.status_code != 200:
-                logger.error(
-                    "Не удалось получить покупателей: status_code=%s, page=%s, body=%s",
-                    resp.status_code,
-                    page,
-                    resp.text,
-                )
-                break
-
-            page_items = self._get_customers_embedded_list(resp.json())
-            if not page_items:
-                break
-
-            for customer in page_items:
-                all_customers.append(
-                    AmoCustomers(
-                        customer_id=customer.get("id"),
-                        created_at=customer.get("created_at"),
-                        contacts_id=self._get_customer_contacts_ids(customer),
-                        status=self._get_customer_custom_field_value(customer, 972634)
-                    )
-                )
+    @classmethod
+    def _customer_from_payload(cls, customer: dict) -> AmoCustomers:
+        fields = custom_field_values(customer, ENTITY_FIELD_IDS["customers"])
+        status = fields.get(CUSTOMER_STATUS_FIELD_ID)
+        return AmoCustomers(
+            customer_id=customer.get("id"),
+            created_at=customer.get("created_at"),
+            contacts_id=cls._get_customer_contacts_ids(customer),
+            status=status if status is not None else 0,
+            updated_at=customer.get("updated_at"),
+        )
 
-            if len(page_items) < limit:
-                break
+    @classmethod
+    def _contact_from_payload(cls, contact: dict) -> AmoContact:
+        fields = custom_field_values(contact, ENTITY_FIELD_IDS["contacts"])
+        return AmoContact(
+            contact_id=contact.get("id"),
+            customer_id=cls._get_customer_id_from_contact(contact),
+            attestate_at=fields.get(CONTACT_ATTESTATE_AT_FIELD_ID, 0),
+            updated_at=contact.get("updated_at"),
+            phones=contact_phones(contact),
+        )
 
-            page += 1
+    async def iter_customers(self, limit: int = 250) -> AsyncIterator[list[AmoCustomers]]:
+        """Постранично отдаёт покупателей с их контактами."""
+        async for customers in self._iter_pages(
+            "/api/v4/customers",
+            "with=contacts",
+            embedded_key="customers",
+            limit=limit,
+            parse=self._customer_from_payload,
+        ):
+            yield customers
 
-        return all_customers
+    async def get_customers_with_contacts(self, limit: int = 250) -> list[AmoCustomers]:
+        return [customer async for customers in self.iter_customers(limit) for customer in customers]
 
     async def get_contacts_with_customer(self, limit: int = 250) -> list[AmoContact]:
         url = "/api/v4/contacts"
-        page = 1
         all_contacts: list[AmoContact] = []
-        attestate_field_id = 1096322
 
-        while True:
-            query = f"with=customers&limit={limit}&page={page}"
-            resp = await self._base_request(endpoint=url, type="get_param", parameters=query)
-
-            if resp.status_code == 204:
-                break
-
-            if resp.status_code != 200:
-                logger.error(
-                    "Не удалось получить контакты: status_code=%s, page=%s, body=%s",
-                    resp.status_code,
-                    page,
-                    resp.text,
-                )
-                break
-
-            page_items = self._get_contacts_embedded_list(resp.json())
-            if not page_items:
-                break
-
-            for contact in page_items:
-                all_contacts.append(
-                    AmoContact(
-                        contact_id=contact.get("id"),
-                        customer_id=self._get_customer_id_from_contact(contact),
-                        attestate_at=self._get_custom_field_value(contact, attestate_field_id),
-                    )
-                )
+        async for contacts in self._iter_pages(
+            url,
+            "with=customers",
+            embedded_key="contacts",
+            limit=limit,
+            parse=self._contact_from_payload,
+        ):
+            all_contacts.extend(contacts)
 
-            if len(page_items) < limit:
-                break
+        return all_contacts
 
-            page += 1
+    def _entity_source(self, entity: str) -> tuple[str, str, Callable[[dict], Any]]:
+        sources = {
+            "leads": ("/api/v4/leads", "with=contacts", self._lead_from_payload),
+            "customers": ("/api/v4/customers", "with=contacts", self._customer_from_payload),
+            "contacts": ("/api/v4/contacts", "with=customers", self._contact_from_payload),
+        }
+        if entity not in sources:
+            raise ValueError(f"Unknown amoCRM entity: {entity}")
+        return sources[entity]
 
-        return all_contacts
+    async def iter_updated_pages(
+        self,
+        entity: str,
+        updated_from: int | None = None,
+        limit: int = 250,
+    ) -> AsyncIterator[list[AmoLead] | list[AmoCustomers] | list[AmoContact]]:
+        """
+        Отдаёт страницы сделок воронки аналитики, покупателей или контактов,
+        изменённых начиная с updated_from, в порядке возрастания updated_at.
 
-    async def add_new_task(self, contact_id, descr, url_materials, time_value) -> httpx.Response:
-        url = "/api/v4/tasks"
-        data = [
-            {
-                "text": f"Обращение по ошибке чат-бота:\n{descr} {url_materials}",
-                "complete_till": int(time_value),
-                "entity_id": contact_id,
-                "entity_type": "contacts",
-                "responsible_user_id": 6390936,
-            },
+        Для инкрементального обновления локального зеркала: amoCRM фильтрует
+        по filter[updated_at][from] и отвечает 304 на If-Modified-Since,
+        если с этого момента ничего не менялось.
+        """
+        url, query, parse = self._entity_source(entity)
+        if entity == "leads":
+            query = f"filter[pipeline_id][]={ANALYTICS_PIPELINE_ID}&{query}"
+
+        headers: dict[str, str] | None = None
+        query = f"{query}&order[updated_at]=asc"
+        if updated_from:
+            query = f"{query}&filter[updated_at][from]={int(updated_from)}"
+            headers = {"If-Modified-Since": formatdate(int(updated_from), usegmt=True)}
+
+        async for records in self._iter_pages(
+            url,
+            query,
+            embedded_key=entity,
+            limit=limit,
+            headers=headers,
+            parse=parse,
+        ):
+            yield records
+
+    async def get_records_by_ids(
+        self,
+        entity: str,
+        ids: Sequence[int],
+        limit: int = 250,
+    ) -> list[AmoLead] | list[AmoCustomers] | list[AmoContact]:
+        """
+        Загружает сделки, покупателей или контактов по списку id пачками до limit штук.
+        Удалённые сущности amoCRM просто не возвращает. Если какая-то страница
+        не получена, поднимается AmoAPIError: отсутствие id в ответе должно
+        означать удаление, а не сбой.
+        """
+        url, query, parse = self._entity_source(entity)
+        unique_ids = sorted({int(entity_id) for entity_id in ids})
+        chunks = [unique_ids[index:index + limit] for index in range(0, len(unique_ids), limit)]
+
+        async def fetch(chunk: list[int]) -> list:
+            id_filter = "&".join(f"filter[id][]={entity_id}" for entity_id in chunk)
+            return [
+                record
+                async for records in self._iter_pages(
+                    url,
+                    f"{id_filter}&{query}",
+                    embedded_key=entity,
+                    limit=limit,
+                    parse=parse,
+                    strict=True,
+                )
+                for record in records
+            ]
+
+        pages = await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+        return [record for page in pages for record in page]
+
+    async def iter_events(
+        self,
+        created_from: int,
+        entity_types: Sequence[str] = ("lead", "contact", "customer"),
+        limit: int = 100,
+    ) -> AsyncIterator[list[dict]]:
+        """
+        Страницы ленты событий /api/v4/events начиная с created_from. Сбой
+        страницы поднимает AmoAPIError, чтобы курсор не ушёл за пропущенные события.
+        """
+        entity_filter = "&".join(f"filter[entity][]={entity_type}" for entity_type in entity_types)
+        query = f"filter[created_at][from]={int(created_from)}&{entity_filter}"
+        async for page_items in self._iter_pages(
+            "/api/v4/events",
+            query,
+            embedded_key="events",
+            limit=limit,
+            strict=True,
+        ):
+            yield page_items
+
+    @staticmethod
+    def new_task_payloads(contact_id, descr, url_materials, time_value) -> list[dict]:
+        """Задачи по обращению из чат-бота: по одной на каждого ответственного."""
+        return [
             {
                 "text": f"Обращение по ошибке чат-бота:\n{descr} {url_materials}",
                 "complete_till": int(time_value),
                 "entity_id": contact_id,
                 "entity_type": "contacts",
-                "responsible_user_id": 10353813,
-            },
+                "responsible_user_id": responsible_user_id,
+            }
+            for responsible_user_id in (6390936, 10353813)
         ]
-        return await self._base_request(type="post", endpoint=url, data=data)
+
+    async def add_new_task(self, contact_id, descr, url_materials, time_value) -> httpx.Response:
+        data = self.new_task_payloads(contact_id, descr, url_materials, time_value)
+        return await self.post_entities(AMO_WRITE_ENDPOINTS["tasks"][0], data)
+
+    async def post_entities(self, endpoint: str, entities: list[dict]) -> httpx.Response:
+        """Создаёт пачку сущностей одним POST (amoCRM принимает до 250 за запрос)."""
+        return await self._base_request(type="post", endpoint=endpoint, data=entities)
+
+    async def patch_entities(self, endpoint: str, entities: list[dict]) -> httpx.Response:
+        """Обновляет пачку сущностей одним PATCH (до 250 за запрос, у каждой — id)."""
+        return await self._base_request(type="patch", endpoint=endpoint, data=entities)
 
     @staticmethod
     def _get_main_contact_id(lead_data: dict) -> int | None:
@@ -566,27 +1030,13 @@ class AmoCRMWrapperAsync:
 
     @staticmethod
     def _get_custom_field_value(lead_data: dict, field_id: int):
-        custom_fields = lead_data.get("custom_fields_values", [])
-        if custom_fields is not None:
-            for field in custom_fields:
-                if field.get("field_id") == field_id:
-                    values = field.get("values", [])
-                    if values:
-                        return values[0].get("value")
-        return 0
+        # для нескольких полей сразу используйте custom_field_values
+        return custom_field_values(lead_data, (field_id,)).get(field_id, 0)
 
     @staticmethod
     def _get_customer_custom_field_value(customer_data: dict, field_id: int) -> int | str:
-        custom_fields = customer_data.get("custom_fields_values", [])
-        if custom_fields is not None:
-            for field in custom_fields:
-                if field.get("field_id") == field_id:
-                    values = field.get("values", [])
-                    if values:
-                        value = values[0].get("value")
-                        if value is not None:
-                            return value
-        return 0
+        value = custom_field_values(customer_data, (field_id,)).get(field_id)
+        return value if value is not None else 0
 
     @staticmethod
     def _convert_unix_to_sheets_datetime(timestamp_value):
@@ -604,144 +1054,156 @@ class AmoCRMWrapperAsync:
             return timestamp_value
         return dt_value.strftime("%d-%m-%Y %H:%M:%S")
 
-    async def get_pipeline_1628622_status_142_leads(self, limit: int = 250) -> list[AmoLead]:
-        url = "/api/v4/leads"
-        page = 1
-        all_leads: list[AmoLead] = []
-        shipment_field_id = 935651
-        paid_at_field_id = 1104770
-        project_field_id = 938609
-
-        while True:
-            # query = (
-            #     "filter[pipeline_id][]=1628622&"
-            #     "filter[statuses][0][pipeline_id]=1628622&"
-            #     "filter[statuses][0][status_id]=142&"
-            #     "with=contacts&"
-            #     f"limit={limit}&"
-            #     f"page={page}"
-            # )
-
-            query = (
-                "filter[pipeline_id][]=1628622&"
-                "filter[statuses][0][pipeline_id]=1628622&"
-                "filter[statuses][0][status_id]=142&"
-                "filter[statuses][1][pipeline_id]=1628622&"
-                "filter[statuses][1][status_id]=24709308&"
-                "filter[statuses][2][pipeline_id]=1628622&"
-                "filter[statuses][2][status_id]=38737875&"
-                "filter[statuses][3][pipeline_id]=1628622&"
-                "filter[statuses][3][status_id]=64191281&"
-                "filter[statuses][4][pipeline_id]=1628622&"
-                "filter[statuses][4][status_id]=50957124&"
-                "with=contacts&"
-                f"limit={limit}&"
-                f"page={page}"
-            )
-
-
-
-            resp = await self._base_request(endpoint=url, type="get_param", parameters=query)
-
-            if resp.status_code == 204:
-                break
-
-            if resp.status_code != 200:
-                logger.error(
-                    "Не удалось получить сделки: status_code=%s, page=%s, body=%s",
-                    resp.status_code,
-                    page,
-                    resp.text,
-                )
-                break
-
-            page_items = resp.json().get("_embedded", {}).get("leads", []) or []
-            if not page_items:
-                break
-
-            for lead in page_items:
-                all_leads.append(
-                    AmoLead(
-                        lead_id=lead.get("id"),
-                        lead_price=lead.get("price"),
-                        created_at=lead.get("created_at"),
-                        close_at=lead.get("closed_at"),
-                        contact_id=self._get_main_contact_id(lead),
-                        shipment_at=self._get_custom_field_value(lead, shipment_field_id),
-                        paid_at=self._get_custom_field_value(lead, paid_at_field_id),
-                        project=self._get_custom_field_value(lead, project_field_id)
-                    )
-                )
+    @classmethod
+    def _lead_from_payload(cls, lead: dict) -> AmoLead:
+        fields = custom_field_values(lead, ENTITY_FIELD_IDS["leads"])
+        return AmoLead(
+            lead_id=lead.get("id"),
+            lead_price=lead.get("price"),
+            created_at=lead.get("created_at"),
+            close_at=lead.get("closed_at"),
+            contact_id=cls._get_main_contact_id(lead),
+            shipment_at=fields.get(LEAD_SHIPMENT_AT_FIELD_ID, 0),
+            paid_at=fields.get(LEAD_PAID_AT_FIELD_ID, 0),
+            project=fields.get(LEAD_PROJECT_FIELD_ID, 0),
+            pipeline_id=lead.get("pipeline_id"),
+            status_id=lead.get("status_id"),
+            updated_at=lead.get("updated_at"),
+        )
 
-            if len(page_items) < limit:
-                break
+    async def iter_leads(self, limit: int = 250) -> AsyncIterator[list[AmoLead]]:
+        """Постранично отдаёт сделки воронки аналитики в статусах ANALYTICS_STATUS_IDS."""
+        # query = (
+        #     "filter[pipeline_id][]=1628622&"
+        #     "filter[statuses][0][pipeline_id]=1628622&"
+        #     "filter[statuses][0][status_id]=142&"
+        #     "with=contacts"
+        # )
+
+        statuses = "&".join(
+            f"filter[statuses][{index}][pipeline_id]={ANALYTICS_PIPELINE_ID}&"
+            f"filter[statuses][{index}][status_id]={status_id}"
+            for index, status_id in enumerate(ANALYTICS_STATUS_IDS)
+        )
+        query = f"filter[pipeline_id][]={ANALYTICS_PIPELINE_ID}&{statuses}&with=contacts"
 
-            page += 1
+        async for leads in self._iter_pages(
+            "/api/v4/leads",
+            query,
+            embedded_key="leads",
+            limit=limit,
+            parse=self._lead_from_payload,
+        ):
+            yield leads
 
-        return all_leads
+    async def get_pipeline_1628622_status_142_leads(self, limit: int = 250) -> list[AmoLead]:
+        return [lead async for leads in self.iter_leads(limit) for lead in leads]
 
-    async def add_catalog_elements_to_lead(self, lead_id, elements) -> dict:
-        url = f"/api/v4/leads/{lead_id}/link"
+    @staticmethod
+    def catalog_link_payloads(lead_id, elements) -> list[dict]:
+        """Привязки элементов каталога к сделке для массового /api/v4/leads/link."""
         data = []
         for element in elements:
             element_id = int(element.get("id"))
             quantity = int(float(element.get("quantity")))
             data.append(
                 {
+                    "entity_id": int(lead_id),
                     "to_entity_id": element_id,
                     "to_entity_type": "catalog_elements",
                     "metadata": {"quantity": quantity, "catalog_id": 1682},
                 }
             )
-        resp = await self._base_request(type="post", endpoint=url, data=data)
+        return data
+
+    async def add_catalog_elements_to_lead(self, lead_id, elements) -> dict:
+        data = self.catalog_link_payloads(lead_id, elements)
+        resp = await self.post_entities(AMO_WRITE_ENDPOINTS["lead_links"][0], data)
         return resp.json()
 
+    @staticmethod
+    def new_contact_payload(first_name: str, last_name: str, phone: str) -> dict:
+        return {
+            "first_name": first_name,
+            "last_name": last_name,
+            "responsible_user_id": 11047749,
+            "custom_fields_values": [
+                {
+                    "field_id": 671750,
+                    "values": [{"enum_code": "WORK", "value": str(phone)}],
+                }
+            ],
+        }
+
     async def create_new_contact(self, first_name: str, last_name: str, phone: str) -> int:
-        url = "/api/v4/contacts"
-        data = [
-            {
-                "first_name": first_name,
-                "last_name": last_name,
-                "responsible_user_id": 11047749,
-                "custom_fields_values": [
-                    {
-                        "field_id": 671750,
-                        "values": [{"enum_code": "WORK", "value": str(phone)}],
-                    }
-                ],
-            }
-        ]
-        resp = await self._base_request(type="post", endpoint=url, data=data)
+        data = [self.new_contact_payload(first_name, last_name, phone)]
+        resp = await self.post_entities(AMO_WRITE_ENDPOINTS["contacts"][0], data)
         contact_id = resp.json().get("_embedded", {}).get("contacts", [{}])[0].get("id")
         return int(contact_id)
 
+    @staticmethod
+    def market_lead_payload(contact_id: int | None, order_id: str) -> dict:
+        """Сделка по заказу Яндекс Маркета в воронке маркетплейса."""
+        embedded: dict[str, list[dict]] = {"tags": [{"id": 563936}]}
+        if contact_id is not None:
+            embedded["contacts"] = [{"id": contact_id}]
+        return {
+            "name": "Заказ с маркета",
+            "pipeline_id": 25020,
+            "created_by": 0,
+            "status_id": 17566048,
+            "responsible_user_id": 11047749,
+            "custom_fields_values": [
+                {"field_id": 1101072, "values": [{"value": str(order_id)}]}
+            ],
+            "_embedded": embedded,
+        }
+
+    async def create_lead_with_contact_complex(self, lead: dict, contact: dict) -> tuple[int, int]:
+        """
+        Создаёт сделку вместе с новым контактом одним запросом /api/v4/leads/complex.
+        amoCRM создаёт обе сущности или ни одной. Возвращает (id сделки, id контакта).
+        """
+        payload = {**lead, "_embedded": {**(lead.get("_embedded") or {}), "contacts": [contact]}}
+        resp = await self.post_entities("/api/v4/leads/complex", [payload])
+        if resp.status_code != 200:
+            logger.error(
+                "Не удалось создать сделку с контактом: status_code=%s, body=%s",
+                resp.status_code,
+                resp.text,
+            )
+            raise RuntimeError(f"Failed to create complex lead: status_code={resp.status_code}")
+
+        created = resp.json()[0]
+        return int(created["id"]), int(created["contact_id"])
+
+    async def create_lead(self, lead: dict) -> int:
+        """Создаёт одну сделку и возвращает её id."""
+        resp = await self.post_entities(AMO_WRITE_ENDPOINTS["leads"][0], [lead])
+        if resp.status_code != 200:
+            logger.error(
+                "Не удалось создать сделку: status_code=%s, body=%s",
+                resp.status_code,
+                resp.text,
+            )
+            raise RuntimeError(f"Failed to create lead: status_code={resp.status_code}")
+
+        return int(resp.json()["_embedded"]["leads"][0]["id"])
+
     async def send_lead_to_amo(self, contact_id: int, order_id: str) -> dict:
-        url = "/api/v4/leads"
-        data = [
-            {
-                "name": "Заказ с маркета",
-                "pipeline_id": 25020,
-                "created_by": 0,
-                "status_id": 17566048,
-                "responsible_user_id": 11047749,
-                "custom_fields_values": [
-                    {"field_id": 1101072, "values": [{"value": str(order_id)}]}
-                ],
-                "_embedded": {
-                    "tags": [{"id": 563936}],
-                    "contacts": [{"id": contact_id}],
-                },
-            }
-        ]
-        resp = await self._base_request(type="post", endpoint=url, data=data)
+        data = [self.market_lead_payload(contact_id, order_id)]
+        resp = await self.post_entities(AMO_WRITE_ENDPOINTS["leads"][0], data)
         return resp.json()
 
+    @staticmethod
+    def lead_note_payload(lead_id, text) -> dict:
+        return {"entity_id": int(lead_id), "note_type": "common", "params": {"text": text}}
+
     async def add_new_note_to_lead(self, lead_id, text, order_id) -> dict:
-        url = f"/api/v4/leads/{lead_id}/notes"
         market_order_url = f"https://partner.market.yandex.ru/order/{order_id}?partnerId=182087723"
         _ = market_order_url  # оставлено для совместимости (в твоём коде не использовалось)
-        data = [{"note_type": "common", "params": {"text": text}}]
-        resp = await self._base_request(type="post", endpoint=url, data=data)
+        data = [self.lead_note_payload(lead_id, text)]
+        resp = await self.post_entities(AMO_WRITE_ENDPOINTS["lead_notes"][0], data)
         return resp.json()
 
     async def get_lead_by_id(self, lead_id) -> dict:
@@ -763,9 +1225,62 @@ class AmoCRMWrapperAsync:
         )
         return resp.json()
 
-    async def get_catalogs_elements(self, catalog_id, elements: dict) -> dict[str, Any]:
+    async def iter_catalog_elements(self, catalog_id, limit: int = 250) -> AsyncIterator[list[dict]]:
+        """
+        Постранично отдаёт все элементы каталога amoCRM. Сбой страницы
+        поднимает AmoAPIError: по оборванному списку нельзя удалять строки.
+        """
+        async for elements in self._iter_pages(
+            f"/api/v4/catalogs/{int(catalog_id)}/elements",
+            "",
+            embedded_key="elements",
+            limit=limit,
+            strict=True,
+        ):
+            yield elements
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            "users": self.users_cache.stats(),
+            "catalog_elements": self.catalog_elements_cache.stats(),
+            "get_requests": self._get_requests.stats(),
+        }
+
+    def invalidate_caches(self) -> None:
+        self.users_cache.invalidate()
+        self.catalog_elements_cache.invalidate()
+        self._get_requests.invalidate()
+
+    def invalidate_catalog_elements(self, catalog_id, element_ids: Iterable[int] | None = None) -> None:
+        catalog_id = int(catalog_id)
+        if element_ids is None:
+            self.catalog_elements_cache.invalidate_where(lambda key: key[0] == catalog_id)
+        else:
+            self.catalog_elements_cache.invalidate([(catalog_id, int(element_id)) for element_id in element_ids])
+
+    async def _fetch_catalog_elements(self, catalog_id: int, element_ids: list[int]) -> dict[int, dict]:
         url = f"/api/v4/catalogs/{catalog_id}/elements"
+        query = "&".join(f"filter[id][]={element_id}" for element_id in element_ids)
+        resp = await self._base_request(type="get_param", endpoint=url, parameters=query)
+        if resp.status_code == 204:
+            return {}
+        if resp.status_code != 200:
+            logger.error(
+                "Не удалось получить элементы каталога %s: status_code=%s, body=%s",
+                catalog_id,
+                resp.status_code,
+                resp.text,
+            )
+            return {}
+        return {element["id"]: element for element in decode_embedded(resp.content, "elements")}
 
+    async def get_catalogs_elements(self, catalog_id, elements: dict) -> dict[str, Any]:
+        """
+        Возвращает элементы каталога в формате ответа amoCRM
+        (``{"_embedded": {"elements": [...]}}``). Элементы берутся из кэша,
+        отсутствующие запрашиваются одним запросом.
+        """
+        catalog_id = int(catalog_id)
         element_ids: list[int] = []
         for element_id in (elements or {}).keys():
             try:
@@ -776,11 +1291,16 @@ class AmoCRMWrapperAsync:
         if not element_ids:
             return {}
 
-        query = "&".join(f"filter[id][]={element_id}" for element_id in sorted(set(element_ids)))
-        resp = await self._base_request(type="get_param", endpoint=url, parameters=query)
-        return resp.json()
+        keys = [(catalog_id, element_id) for element_id in sorted(set(element_ids))]
 
-    async def get_responsible_user_by_id(self, manager_id: int):
+        async def load(missing: list[tuple[int, int]]) -> dict[tuple[int, int], dict]:
+            fetched = await self._fetch_catalog_elements(catalog_id, [element_id for _, element_id in missing])
+            return {(catalog_id, element_id): element for element_id, element in fetched.items()}
+
+        found = await self.catalog_elements_cache.get_or_load_many(keys, load)
+        return {"_embedded": {"elements": [found[key] for key in keys if key in found]}}
+
+    async def _fetch_responsible_user(self, manager_id: int) -> dict:
         url = f'/api/v4/users/{manager_id}'
 
         responsible_manager = await self._base_request(endpoint=url, type='get')
@@ -798,6 +1318,12 @@ class AmoCRMWrapperAsync:
             f"status_code={responsible_manager.status_code}"
         )
 
+    async def get_responsible_user_by_id(self, manager_id: int):
+        manager_id = int(manager_id)
+        return await self.users_cache.get_or_load(
+            manager_id, lambda: self._fetch_responsible_user(manager_id)
+        )
+
 
 # ====== пример запуска ======
 # if __name__ == "__main__":
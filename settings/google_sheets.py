@@ -11,10 +11,22 @@ class GoogleSheetsIntegration:
     def __init__(self, webhook_url: str):
         self.webhook_url = webhook_url
 
-    def send_json(self, payload: list[dict[str, Any]], token: str, request_id: str) -> requests.Response:
+    def send_json(
+        self,
+        payload: list[dict[str, Any]],
+        token: str,
+        request_id: str,
+        chunk: int | None = None,
+        last: bool | None = None,
+    ) -> requests.Response:
+        params = {'token': token, 'request_id': request_id}
+        # при отправке частями обработчик получает номер части и признак последней
+        if chunk is not None:
+            params['chunk'] = chunk
+            params['last'] = int(bool(last))
         response = requests.post(
             self.webhook_url,
-            params={'token': token, 'request_id': request_id},
+            params=params,
             json=payload,
             timeout=30
         )
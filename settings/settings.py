@@ -25,6 +25,33 @@ class AmoConfig:
     amocrm_refresh_token: str | None
     amocrm_secret_code: str
     path_to_env: str
+    requests_per_second: float = 7.0
+    burst: int = 7
+    max_concurrency: int = 7
+    page_prefetch: int = 4
+    token_refresh_margin: float = 300.0
+    token_store: str = "env"
+    token_file: str = "amo_tokens.json"
+    events_poll_interval: float = 60.0
+    webhook_token: str | None = None
+    webhook_batch_delay: float = 1.0
+    users_cache_size: int = 256
+    users_cache_ttl: float = 3600.0
+    catalog_cache_size: int = 4096
+    catalog_cache_ttl: float = 600.0
+    kp_catalog_id: int = 1682
+    catalog_sync_interval: float = 3600.0
+    contacts_sync_interval: float = 3600.0
+    order_contact_ttl: float = 1209600.0
+    get_reuse_ttl: float = 0.0
+    get_reuse_size: int = 256
+    write_batch_delay: float = 1.0
+    write_max_attempts: int = 5
+    write_retry_delay: float = 5.0
+    write_dead_letter_limit: int = 1000
+    clean_price_field_id: int = 0
+    last_buy_field_id: int = 0
+    time_from_attestate_field_id: int = 0
 
 
 # Класс с объектом TGBot
@@ -38,6 +65,7 @@ class Config:
     google_sheets_webhook_url: str | None
     google_sheets_customers_webhook_url: str | None
     google_sheets_token: str | None
+    google_sheets_chunk_size: int
     database_url: str
     telegram_bot_url: str
     max_bot_url: str
@@ -45,6 +73,10 @@ class Config:
     moysklad_token: str | None
     web_session_secret: str | None
     web_session_cookie_secure: bool
+    analytics_budget_periods: str | None = None
+    analytics_workers: int = 1
+    loop_lag_interval: float = 1.0
+    loop_lag_warning: float = 0.5
 
 
 # Функция создания экземпляра класса config
@@ -64,7 +96,34 @@ def load_config(path: str | None = os.path.abspath('./.env')):
             amocrm_redirect_url=env("AMOCRM_REDIRECT_URL"),
             amocrm_access_token=env("AMOCRM_ACCESS_TOKEN"),
             amocrm_refresh_token=env("AMOCRM_REFRESH_TOKEN"),
-            amocrm_secret_code=env("AMOCRM_SECRET")
+            amocrm_secret_code=env("AMOCRM_SECRET"),
+            requests_per_second=env.float("AMOCRM_REQUESTS_PER_SECOND", default=7.0),
+            burst=env.int("AMOCRM_BURST", default=7),
+            max_concurrency=env.int("AMOCRM_MAX_CONCURRENCY", default=7),
+            page_prefetch=env.int("AMOCRM_PAGE_PREFETCH", default=4),
+            token_refresh_margin=env.float("AMOCRM_TOKEN_REFRESH_MARGIN", default=300.0),
+            token_store=env("AMOCRM_TOKEN_STORE", default="env"),
+            token_file=env("AMOCRM_TOKEN_FILE", default="amo_tokens.json"),
+            events_poll_interval=env.float("AMOCRM_EVENTS_POLL_INTERVAL", default=60.0),
+            webhook_token=env("AMOCRM_WEBHOOK_TOKEN", default=None),
+            webhook_batch_delay=env.float("AMOCRM_WEBHOOK_BATCH_DELAY", default=1.0),
+            users_cache_size=env.int("AMOCRM_USERS_CACHE_SIZE", default=256),
+            users_cache_ttl=env.float("AMOCRM_USERS_CACHE_TTL", default=3600.0),
+            catalog_cache_size=env.int("AMOCRM_CATALOG_CACHE_SIZE", default=4096),
+            catalog_cache_ttl=env.float("AMOCRM_CATALOG_CACHE_TTL", default=600.0),
+            kp_catalog_id=env.int("AMOCRM_KP_CATALOG_ID", default=1682),
+            catalog_sync_interval=env.float("AMOCRM_CATALOG_SYNC_INTERVAL", default=3600.0),
+            contacts_sync_interval=env.float("AMOCRM_CONTACTS_SYNC_INTERVAL", default=3600.0),
+            order_contact_ttl=env.float("AMOCRM_ORDER_CONTACT_TTL", default=1209600.0),
+            get_reuse_ttl=env.float("AMOCRM_GET_REUSE_TTL", default=0.0),
+            get_reuse_size=env.int("AMOCRM_GET_REUSE_SIZE", default=256),
+            write_batch_delay=env.float("AMOCRM_WRITE_BATCH_DELAY", default=1.0),
+            write_max_attempts=env.int("AMOCRM_WRITE_MAX_ATTEMPTS", default=5),
+            write_retry_delay=env.float("AMOCRM_WRITE_RETRY_DELAY", default=5.0),
+            write_dead_letter_limit=env.int("AMOCRM_WRITE_DEAD_LETTER_LIMIT", default=1000),
+            clean_price_field_id=env.int("AMOCRM_CLEAN_PRICE_FIELD_ID", default=0),
+            last_buy_field_id=env.int("AMOCRM_LAST_BUY_FIELD_ID", default=0),
+            time_from_attestate_field_id=env.int("AMOCRM_TIME_FROM_ATTESTATE_FIELD_ID", default=0),
         ),
         admin_chat_id=str(env('ADMIN_ID')),
         yandex_api_key=env('YANDEX_API'),
@@ -72,6 +131,7 @@ def load_config(path: str | None = os.path.abspath('./.env')):
         google_sheets_webhook_url=env('GOOGLE_SHEETS_WEBHOOK_URL', default=None),
         google_sheets_customers_webhook_url=env('GOOGLE_SHEETS_CUSTOMERS_WEBHOOK_URL', default=None),
         google_sheets_token=env('GOOGLE_SHEETS_TOKEN', default=None),
+        google_sheets_chunk_size=env.int('GOOGLE_SHEETS_CHUNK_SIZE', default=0),
         database_url=env('DATABASE_URL', default='sqlite:///./amowebhook.db'),
         telegram_bot_url=env('TELEGRAM_BOT_URL', default='https://t.me/your_bot'),
         max_bot_url=env('MAX_BOT_URL'),
@@ -79,4 +139,8 @@ def load_config(path: str | None = os.path.abspath('./.env')):
         moysklad_token=env('MOYSKLAD_TOKEN', default=None),
         web_session_secret=env('WEB_SESSION_SECRET', default=None),
         web_session_cookie_secure=env.bool('WEB_SESSION_COOKIE_SECURE', default=True),
+        analytics_budget_periods=env('ANALYTICS_BUDGET_PERIODS', default=None),
+        analytics_workers=env.int('ANALYTICS_WORKERS', default=1),
+        loop_lag_interval=env.float('LOOP_LAG_INTERVAL', default=1.0),
+        loop_lag_warning=env.float('LOOP_LAG_WARNING', default=0.5),
     )
@@ -0,0 +1,129 @@
+import json
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base
+from services.amo_analytics_writeback import load_written_values, store_written_values, write_back_analytics
+from settings.async_amo_api import AmoCustomers, AmoLead, AmoResult
+from tests.test_async_amo_api import make_amo
+
+FIELD_IDS = {"clean_price": 111, "last_buy": 222, "time_from_attestate": 0}
+
+
+def make_result(lead_id: int, clean_price: int, last_buy: int | None = None) -> AmoResult:
+    lead = AmoLead(
+        lead_id=lead_id,
+        lead_price=100,
+        created_at=1,
+        close_at=2,
+        contact_id=10,
+        shipment_at=3,
+        clean_price=clean_price,
+        last_buy=last_buy,
+        time_from_attestate=5 * 86400,
+    )
+    return AmoResult(lead_obj=lead, customer_obj=AmoCustomers(customer_id=1, created_at=0, contacts_id=[10]))
+
+
+class AnalyticsWritebackTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{(Path(self.temp_dir.name) / 'test.db').as_posix()}")
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.batches: list[list[dict]] = []
+        self.status = 200
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.assertEqual((request.method, request.url.path), ("PATCH", "/api/v4/leads"))
+        self.batches.append(json.loads(request.content))
+        return httpx.Response(self.status, json={"_embedded": {"leads": []}})
+
+    async def write_back(self, results: list[AmoResult], **kwargs) -> int:
+        async with make_amo(self.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            return await write_back_analytics(amo, self.Session, results, FIELD_IDS, **kwargs)
+
+    async def test_patches_leads_in_batches_with_configured_fields(self):
+        results = [make_result(lead_id, clean_price=lead_id * 10, last_buy=3 * 86400) for lead_id in range(1, 6)]
+
+        updated = await self.write_back(results, batch_size=2)
+
+        self.assertEqual(updated, 5)
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
+        self.assertEqual(
+            self.batches[0][0],
+            {
+                "id": 1,
+                "custom_fields_values": [
+                    {"field_id": 111, "values": [{"value": 10}]},
+                    {"field_id": 222, "values": [{"value": 3}]},
+                ],
+            },
+        )
+
+    async def test_sends_only_changed_leads(self):
+        await self.write_back([make_result(1, 10), make_result(2, 20, last_buy=86400)])
+        self.batches.clear()
+
+        updated = await self.write_back([make_result(1, 10), make_result(2, 20), make_result(3, 30)])
+
+        self.assertEqual(updated, 2)
+        self.assertEqual([[lead["id"] for lead in batch] for batch in self.batches], [[2, 3]])
+        # пропавшее значение очищает поле
+        self.assertEqual(self.batches[0][0]["custom_fields_values"][1], {"field_id": 222, "values": None})
+
+    async def test_rejected_batch_is_retried_next_run(self):
+        self.status = 400
+        with self.assertLogs("services.amo_analytics_writeback", level="WARNING"):
+            self.assertEqual(await self.write_back([make_result(1, 10)]), 0)
+        self.assertEqual(load_written_values(self.Session), {})
+
+        self.status = 200
+        self.assertEqual(await self.write_back([make_result(1, 10)]), 1)
+        self.assertEqual(load_written_values(self.Session), {1: {"clean_price": 10, "last_buy": None}})
+
+    def test_loads_only_requested_leads(self):
+        store_written_values(self.Session, {lead_id: {"clean_price": lead_id} for lead_id in range(1, 6)})
+
+        self.assertEqual(load_written_values(self.Session, [4, 2, 9]), {2: {"clean_price": 2}, 4: {"clean_price": 4}})
+        self.assertEqual(load_written_values(self.Session, []), {})
+        self.assertEqual(len(load_written_values(self.Session)), 5)
+
+    def test_concurrent_runs_store_same_leads(self):
+        # два одновременных /analyze записывают одни и те же новые сделки
+        writers = 4
+        for round_number in range(5):
+            barrier = threading.Barrier(writers)
+            lead_ids = range(round_number * 100, round_number * 100 + 50)
+
+            def store(writer: int) -> None:
+                barrier.wait()
+                store_written_values(self.Session, {lead_id: {"clean_price": writer} for lead_id in lead_ids})
+
+            with ThreadPoolExecutor(max_workers=writers) as executor:
+                for future in [executor.submit(store, writer) for writer in range(writers)]:
+                    future.result()
+
+        self.assertEqual(len(load_written_values(self.Session)), 250)
+
+    async def test_disabled_without_field_ids(self):
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            updated = await write_back_analytics(amo, self.Session, [make_result(1, 10)], {"clean_price": 0})
+
+        self.assertEqual(updated, 0)
+        self.assertEqual(self.batches, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+import asyncio
+import unittest
+
+import httpx
+
+from settings.amo_cache import AsyncTTLCache
+from tests.test_async_amo_api import make_amo
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class AsyncTTLCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def test_expires_entries_after_ttl(self):
+        clock = FakeClock()
+        cache = AsyncTTLCache(maxsize=10, ttl=5, clock=clock)
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        self.assertEqual(await cache.get_or_load("a", load), 1)
+        clock.now = 4.9
+        self.assertEqual(await cache.get_or_load("a", load), 1)
+        clock.now = 5.0
+        self.assertEqual(await cache.get_or_load("a", load), 2)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "coalesced": 0, "size": 1, "maxsize": 10})
+
+    async def test_evicts_least_recently_used(self):
+        cache = AsyncTTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+
+    async def test_collapses_concurrent_misses(self):
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(cache.get_or_load("key", load) for _ in range(5)))
+
+        self.assertEqual(results, ["value"] * 5)
+        self.assertEqual(calls, 1)
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+    async def test_errors_are_shared_but_not_cached(self):
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            if calls == 1:
+                raise RuntimeError("boom")
+            return "ok"
+
+        results = await asyncio.gather(
+            cache.get_or_load("key", load), cache.get_or_load("key", load), return_exceptions=True
+        )
+
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(await cache.get_or_load("key", load), "ok")
+
+    async def test_load_is_cancelled_only_with_last_waiter(self):
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        started = asyncio.Event()
+        cancelled = False
+
+        async def load():
+            nonlocal cancelled
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+
+        waiters = [asyncio.create_task(cache.get_or_load("key", load)) for _ in range(2)]
+        await started.wait()
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        self.assertFalse(cancelled)
+
+        waiters[1].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        self.assertTrue(cancelled)
+        self.assertEqual(cache.stats()["coalesced"], 1)
+
+    async def test_loads_only_missing_keys_in_one_call(self):
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        cache.set(1, "one")
+        batches = []
+
+        async def load(keys):
+            batches.append(keys)
+            await asyncio.sleep(0.01)
+            return {key: str(key) for key in keys if key != 4}
+
+        first, second = await asyncio.gather(
+            cache.get_or_load_many([1, 2, 3, 4], load),
+            cache.get_or_load_many([2, 3], load),
+        )
+
+        self.assertEqual(batches, [[2, 3, 4]])
+        self.assertEqual(first, {1: "one", 2: "2", 3: "3"})
+        self.assertEqual(second, {2: "2", 3: "3"})
+        self.assertIsNone(cache.get(4))
+
+    async def test_invalidate_and_disabled_cache(self):
+        cache = AsyncTTLCache(maxsize=10, ttl=60)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        cache.invalidate("a")
+        cache.invalidate(["b"])
+        self.assertEqual(len(cache), 1)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+        disabled = AsyncTTLCache(maxsize=10, ttl=0)
+        disabled.set("a", 1)
+        self.assertIsNone(disabled.get("a"))
+
+        with self.assertRaisesRegex(ValueError, "maxsize"):
+            AsyncTTLCache(maxsize=-1)
+
+
+def catalog_element(element_id: int, price: int) -> dict:
+    return {
+        "id": element_id,
+        "name": f"Товар {element_id}",
+        "custom_fields_values": [{"field_code": "PRICE", "values": [{"value": price}]}],
+    }
+
+
+class AmoClientCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def test_repeat_kp_lookups_cost_no_amo_calls(self):
+        requests: list[httpx.Request] = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.url.path == "/api/v4/users/7":
+                return httpx.Response(200, json={"id": 7, "name": "Менеджер"})
+            ids = [int(value) for value in request.url.params.get_list("filter[id][]")]
+            return httpx.Response(
+                200, json={"_embedded": {"elements": [catalog_element(element_id, element_id * 10) for element_id in ids]}}
+            )
+
+        async with make_amo(handler, requests_per_second=1000, burst=10) as amo:
+            for _ in range(3):
+                manager = await amo.get_responsible_user_by_id(7)
+                elements = await amo.get_catalogs_elements(1682, {"3": 1, "1": 2})
+            self.assertEqual(len(requests), 2)
+
+            more = await amo.get_catalogs_elements(1682, {1: 1, 5: 1})
+            stats = amo.cache_stats()
+
+            amo.invalidate_catalog_elements(1682, [1])
+            await amo.get_catalogs_elements(1682, {1: 1})
+
+        self.assertEqual(manager["name"], "Менеджер")
+        self.assertEqual([element["id"] for element in elements["_embedded"]["elements"]], [1, 3])
+        self.assertEqual([element["id"] for element in more["_embedded"]["elements"]], [1, 5])
+        self.assertEqual(requests[2].url.params.get_list("filter[id][]"), ["5"])
+        self.assertEqual(requests[3].url.params.get_list("filter[id][]"), ["1"])
+        self.assertEqual(stats["users"]["hits"], 2)
+        self.assertEqual(stats["catalog_elements"]["misses"], 3)
+
+    async def test_failed_user_lookup_is_not_cached(self):
+        statuses = [500, 200]
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(statuses.pop(0), json={"id": 7, "name": "Менеджер"})
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            with self.assertLogs("settings.async_amo_api", level="ERROR"):
+                with self.assertRaises(RuntimeError):
+                    await amo.get_responsible_user_by_id(7)
+            manager = await amo.get_responsible_user_by_id(7)
+
+        self.assertEqual(manager["id"], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from models import AmoCatalogElementRecord, AmoSyncState, Base
+from services.amo_catalog import (
+    CatalogElement,
+    get_priced_catalog_elements,
+    load_catalog_elements,
+    refresh_amo_catalog,
+    store_catalog_elements,
+)
+from settings.async_amo_api import AmoAPIError
+from tests.test_async_amo_api import make_amo
+from utils.utils import build_kp_items, get_items_to_kp
+
+
+def catalog_element(element_id: int, price, updated_at: int = 100) -> dict:
+    return {
+        "id": element_id,
+        "name": f"Товар {element_id}",
+        "updated_at": updated_at,
+        "custom_fields_values": [{"field_code": "PRICE", "values": [{"value": price}]}],
+    }
+
+
+class FakeCatalog:
+    def __init__(self, elements: list[dict]) -> None:
+        self.elements = elements
+        self.requests: list[httpx.Request] = []
+        # страница списка, на которой amoCRM отвечает 503
+        self.failing_page: int | None = None
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        ids = {int(value) for value in request.url.params.get_list("filter[id][]")}
+        elements = [element for element in self.elements if not ids or element["id"] in ids]
+        limit = int(request.url.params.get("limit", 250))
+        page = int(request.url.params.get("page", 1))
+        if page == self.failing_page:
+            return httpx.Response(503, text="Service Unavailable")
+        page_elements = elements[(page - 1) * limit:page * limit]
+        if not page_elements:
+            return httpx.Response(204)
+        return httpx.Response(200, json={"_embedded": {"elements": page_elements}})
+
+
+class AmoCatalogMirrorTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        database_path = Path(self.temp_dir.name) / "test.db"
+        self.engine = create_engine(f"sqlite:///{database_path.as_posix()}")
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    async def test_full_sync_replaces_catalog_rows(self):
+        catalog = FakeCatalog([catalog_element(1, 1500), catalog_element(2, "99,5", updated_at=300)])
+
+        async with make_amo(catalog.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_catalog(amo, self.Session, 1682)
+            catalog.elements = [catalog_element(2, 120, updated_at=400), catalog_element(3, 10)]
+            result = await refresh_amo_catalog(amo, self.Session, 1682)
+
+        with self.Session() as session:
+            rows = {row.id: row.price for row in session.scalars(select(AmoCatalogElementRecord))}
+            state = session.get(AmoSyncState, "catalog_1682")
+
+        self.assertEqual((result.elements_count, result.removed_count), (2, 1))
+        self.assertEqual(rows, {2: 120, 3: 10})
+        self.assertEqual(state.updated_from, 400)
+        self.assertEqual(load_catalog_elements(self.Session, 1682, [2])[2].price, 120)
+
+    async def test_failed_page_aborts_sync_without_removing_rows(self):
+        catalog = FakeCatalog([catalog_element(element_id, 100, updated_at=element_id) for element_id in range(1, 301)])
+
+        async with make_amo(catalog.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            await refresh_amo_catalog(amo, self.Session, 1682)
+            catalog.elements = [catalog_element(element_id, 200, updated_at=1000) for element_id in range(1, 301)]
+            for failing_page in (1, 2):
+                catalog.failing_page = failing_page
+                with self.subTest(failing_page=failing_page), self.assertRaises(AmoAPIError):
+                    await refresh_amo_catalog(amo, self.Session, 1682)
+
+        with self.Session() as session:
+            prices = {row.id: row.price for row in session.scalars(select(AmoCatalogElementRecord))}
+            state = session.get(AmoSyncState, "catalog_1682")
+
+        self.assertEqual(set(prices), set(range(1, 301)))
+        self.assertEqual(set(prices.values()), {100})
+        self.assertEqual(state.updated_from, 300)
+
+    async def test_prices_kp_lines_from_table_without_amo_calls(self):
+        catalog = FakeCatalog([catalog_element(1, 1500), catalog_element(2, "99,5")])
+
+        async with make_amo(catalog.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_catalog(amo, self.Session, 1682)
+            synced_requests = len(catalog.requests)
+            priced = await get_priced_catalog_elements(amo, self.Session, 1682, [2, 1])
+            self.assertEqual(len(catalog.requests), synced_requests)
+
+            catalog.elements.append(catalog_element(5, 700))
+            with_new = await get_priced_catalog_elements(amo, self.Session, 1682, [1, 5])
+            self.assertEqual(catalog.requests[-1].url.params.get_list("filter[id][]"), ["5"])
+            stored = load_catalog_elements(self.Session, 1682, [5])
+
+        self.assertEqual(priced, [(1, "Товар 1", 1500), (2, "Товар 2", 99.5)])
+        self.assertEqual(with_new, [(1, "Товар 1", 1500), (5, "Товар 5", 700)])
+        self.assertIn(5, stored)
+
+    def test_concurrent_misses_store_same_new_elements(self):
+        # несколько промахов /kp одновременно дозагружают одни и те же элементы
+        writers = 6
+        for round_number in range(5):
+            barrier = threading.Barrier(writers)
+            elements = [
+                CatalogElement(element_id=round_number * 100 + index, name=f"Товар {index}", price=index)
+                for index in range(20)
+            ]
+
+            def store(writer: int) -> None:
+                barrier.wait()
+                store_catalog_elements(self.Session, 1682, elements)
+
+            with ThreadPoolExecutor(max_workers=writers) as executor:
+                for future in [executor.submit(store, writer) for writer in range(writers)]:
+                    future.result()
+
+        with self.Session() as session:
+            self.assertEqual(session.query(AmoCatalogElementRecord).count(), 100)
+        self.assertEqual(load_catalog_elements(self.Session, 1682, [419])[419].price, 19)
+
+    def test_build_kp_items_matches_amo_response_pricing(self):
+        response = {"_embedded": {"elements": [catalog_element(1, 1500), catalog_element(2, "99,5")]}}
+        quantities = {1: 2, 2: 3}
+
+        self.assertEqual(
+            build_kp_items([(1, "Товар 1", 1500), (2, "Товар 2", 99.5)], quantities, discount=10),
+            get_items_to_kp(response, quantities, discount=10),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,357 @@
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from models import AmoContactPhone, AmoContactRecord, AmoCustomerRecord, AmoLeadRecord, AmoSyncState, Base
+from services.amo_events import changes_from_events, poll_amo_events
+from services.amo_mirror import (
+    load_analytics_data,
+    load_analytics_leads,
+    refresh_amo_mirror,
+    replace_mirror_records,
+    save_sync_state,
+    store_mirror_page,
+)
+from settings.async_amo_api import ANALYTICS_PIPELINE_ID, AmoAPIError, AmoContact, AmoLead
+from tests.test_async_amo_api import make_amo
+
+
+def make_lead(lead_id: int, *, status_id: int = 142, updated_at: int = 100, price: int = 1000) -> dict:
+    return {
+        "id": lead_id,
+        "price": price,
+        "pipeline_id": 1628622,
+        "status_id": status_id,
+        "created_at": 10,
+        "closed_at": 20,
+        "updated_at": updated_at,
+        "custom_fields_values": [
+            {"field_id": 935651, "values": [{"value": 1_700_000_000}]},
+            {"field_id": 938609, "values": [{"value": "Розница"}]},
+        ],
+        "_embedded": {"contacts": [{"id": lead_id + 100, "is_main": True}]},
+    }
+
+
+def make_customer(customer_id: int, contact_ids: list[int], *, updated_at: int = 100) -> dict:
+    return {
+        "id": customer_id,
+        "created_at": 5,
+        "updated_at": updated_at,
+        "custom_fields_values": [{"field_id": 972634, "values": [{"value": "Активный"}]}],
+        "_embedded": {"contacts": [{"id": contact_id} for contact_id in contact_ids]},
+    }
+
+
+class FakeAmoAccount:
+    def __init__(self):
+        self.leads: list[dict] = []
+        self.customers: list[dict] = []
+        self.events: list[dict] = []
+        self.requests: list[httpx.Request] = []
+        # статус ответа на перечитывание по id, например 500 при сбое amoCRM
+        self.by_id_status: int | None = None
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.by_id_status is not None and "filter[id][]" in request.url.params:
+            return httpx.Response(self.by_id_status, text="server error")
+        entity = request.url.path.rsplit("/", 1)[-1]
+        items = {"leads": self.leads, "customers": self.customers, "events": self.events}.get(entity, [])
+        ids = request.url.params.get_list("filter[id][]")
+        if ids:
+            items = [item for item in items if str(item["id"]) in ids]
+        created_from = request.url.params.get("filter[created_at][from]")
+        if created_from is not None:
+            items = [item for item in items if item["created_at"] >= int(created_from)]
+        updated_from = request.url.params.get("filter[updated_at][from]")
+        if updated_from is not None:
+            items = [item for item in items if item["updated_at"] >= int(updated_from)]
+            if not items:
+                return httpx.Response(304)
+        page = int(request.url.params["page"])
+        limit = int(request.url.params["limit"])
+        if entity != "events":
+            items = sorted(items, key=lambda item: item["updated_at"])
+        page_items = items[(page - 1) * limit:page * limit]
+        if not page_items:
+            return httpx.Response(204)
+        return httpx.Response(200, json={"_embedded": {entity: page_items}})
+
+
+class AmoMirrorTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        database_path = Path(self.temp_dir.name) / "test.db"
+        self.engine = create_engine(
+            f"sqlite:///{database_path.as_posix()}",
+            connect_args={"check_same_thread": False},
+        )
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(
+            bind=self.engine,
+            autocommit=False,
+            autoflush=False,
+            expire_on_commit=False,
+        )
+        self.account = FakeAmoAccount()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    async def test_refresh_is_incremental_and_tracks_stage_moves(self):
+        self.account.leads = [make_lead(1), make_lead(2, status_id=555)]
+        self.account.customers = [make_customer(10, [101, 102])]
+
+        async with make_amo(self.account.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads", "customers"))
+
+            first_requests = list(self.account.requests)
+            self.assertTrue(all("filter[updated_at][from]" not in str(r.url) for r in first_requests))
+            lead_request = next(r for r in first_requests if r.url.path.endswith("/leads"))
+            self.assertEqual(lead_request.url.params["filter[pipeline_id][]"], "1628622")
+            self.assertNotIn("filter[statuses][0][status_id]", lead_request.url.params)
+
+            leads, customers = load_analytics_data(self.Session)
+            self.assertEqual([lead.lead_id for lead in leads], [1])
+            self.assertEqual(leads[0].shipment_at, 1_700_000_000)
+            self.assertEqual(leads[0].paid_at, 0)
+            self.assertEqual(leads[0].project, "Розница")
+            self.assertEqual(leads[0].contact_id, 101)
+            self.assertEqual(list(customers[0].contacts_id), [101, 102])
+            self.assertEqual(customers[0].status, "Активный")
+
+            # сделка 2 перешла в успешный статус, сделка 1 не менялась
+            self.account.requests.clear()
+            self.account.leads[1] = make_lead(2, status_id=142, updated_at=200, price=5)
+            await refresh_amo_mirror(amo, self.Session, entities=("leads", "customers"), overlap=60)
+
+        lead_request = next(r for r in self.account.requests if r.url.path.endswith("/leads"))
+        # курсор 100 минус запас перечитывания
+        self.assertEqual(lead_request.url.params["filter[updated_at][from]"], "40")
+        self.assertIn("If-Modified-Since", lead_request.headers)
+
+        leads, _ = load_analytics_data(self.Session)
+        self.assertEqual([(lead.lead_id, lead.lead_price) for lead in leads], [(1, 1000), (2, 5)])
+        with self.Session() as session:
+            self.assertEqual(session.scalar(select(AmoLeadRecord.status_id).where(AmoLeadRecord.id == 2)), 142)
+            self.assertEqual(session.get(AmoSyncState, "leads").updated_from, 200)
+            self.assertEqual(session.get(AmoSyncState, "customers").updated_from, 100)
+            self.assertEqual(len(session.scalars(select(AmoCustomerRecord)).all()), 1)
+
+    async def test_lead_updated_mid_scan_does_not_hide_the_next_one(self):
+        self.account.leads = [make_lead(lead_id, updated_at=1000 + lead_id) for lead_id in range(1, 261)]
+        moved = False
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal moved
+            response = self.account.handler(request)
+            if request.url.path.endswith("/leads") and not moved:
+                # сделка 1 меняется после первой страницы и уезжает в конец списка:
+                # смещение второй страницы пропускает сделку 251
+                moved = True
+                self.account.leads[0] = make_lead(1, updated_at=5000)
+            return response
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, page_prefetch=1) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+            with self.Session() as session:
+                self.assertIsNone(session.get(AmoLeadRecord, 251))
+                # сделка 1 встретилась дважды: курсор остаётся на её прежнем updated_at
+                self.assertEqual(session.get(AmoSyncState, "leads").updated_from, 1001)
+
+            await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+
+        with self.Session() as session:
+            self.assertEqual(session.query(AmoLeadRecord).count(), 260)
+            self.assertEqual(session.get(AmoSyncState, "leads").updated_from, 5000)
+
+    async def test_failed_refresh_keeps_cursor(self):
+        self.account.leads = [make_lead(1, updated_at=100)]
+
+        async with make_amo(self.account.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+
+        self.account.leads = [make_lead(lead_id, updated_at=200 + lead_id) for lead_id in range(1, 301)]
+        pages = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal pages
+            pages += 1
+            if pages > 1:
+                raise httpx.ReadTimeout("timed out", request=request)
+            return self.account.handler(request)
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, max_retries=0, page_prefetch=1) as amo:
+            with self.assertRaises(httpx.ReadTimeout):
+                await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+
+        with self.Session() as session:
+            # первая страница сохранена, но курсор не ушёл за необойдённые сделки
+            self.assertEqual(session.query(AmoLeadRecord).count(), 250)
+            self.assertEqual(session.get(AmoSyncState, "leads").updated_from, 100)
+
+    async def test_analytics_leads_are_read_in_keyset_pages(self):
+        self.account.leads = [make_lead(lead_id) for lead_id in (5, 1, 3, 2, 4)]
+
+        async with make_amo(self.account.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+
+        first = load_analytics_leads(self.Session, limit=2)
+        second = load_analytics_leads(self.Session, after_id=first[-1].lead_id, limit=2)
+        last = load_analytics_leads(self.Session, after_id=second[-1].lead_id, limit=2)
+
+        self.assertEqual([[lead.lead_id for lead in page] for page in (first, second, last)], [[1, 2], [3, 4], [5]])
+
+    async def test_events_apply_stage_moves_and_deletions(self):
+        self.account.leads = [make_lead(1), make_lead(2), make_lead(3)]
+        self.account.customers = [make_customer(10, [101])]
+
+        async with make_amo(self.account.handler, requests_per_second=1000, burst=10) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads", "customers"))
+            save_sync_state(self.Session, "events", 1000)
+
+            moved = make_lead(2, updated_at=1001)
+            moved["pipeline_id"] = 999
+            self.account.leads = [make_lead(1, status_id=143, updated_at=1001), moved]
+            self.account.customers = []
+            self.account.events = [
+                {"id": "e1", "type": "lead_status_changed", "entity_type": "lead", "entity_id": 1, "created_at": 1001},
+                {"id": "e2", "type": "lead_deleted", "entity_type": "lead", "entity_id": 3, "created_at": 1002},
+                {"id": "e3", "type": "entity_linked", "entity_type": "lead", "entity_id": 2, "created_at": 1003},
+                {"id": "e4", "type": "customer_deleted", "entity_type": "customer", "entity_id": 10, "created_at": 1004},
+                {"id": "e5", "type": "task_added", "entity_type": "task", "entity_id": 77, "created_at": 999},
+            ]
+            self.account.requests.clear()
+            result = await poll_amo_events(amo, self.Session)
+
+        self.assertEqual(result.events_count, 4)
+        self.assertEqual(result.cursor, 1004)
+        self.assertGreater(result.lag_seconds, 0)
+        leads_request = next(r for r in self.account.requests if r.url.path.endswith("/leads"))
+        self.assertEqual(leads_request.url.params.get_list("filter[id][]"), ["1", "2"])
+
+        with self.Session() as session:
+            rows = {row.id: row for row in session.scalars(select(AmoLeadRecord))}
+            self.assertEqual(set(rows), {1})
+            self.assertEqual(rows[1].status_id, 143)
+            self.assertEqual(session.scalars(select(AmoCustomerRecord)).all(), [])
+            state = session.get(AmoSyncState, "events")
+            self.assertEqual(state.updated_from, 1004)
+            self.assertEqual(state.lag_seconds, result.lag_seconds)
+        leads, customers = load_analytics_data(self.Session)
+        self.assertEqual((leads, customers), ([], []))
+
+    async def test_failed_refetch_keeps_mirror_and_events_cursor(self):
+        self.account.leads = [make_lead(1), make_lead(2)]
+
+        async with make_amo(self.account.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            await refresh_amo_mirror(amo, self.Session, entities=("leads",))
+            save_sync_state(self.Session, "events", 1000)
+            self.account.events = [
+                {"id": "e1", "type": "lead_status_changed", "entity_type": "lead", "entity_id": 1, "created_at": 1001},
+                {"id": "e2", "type": "sale_field_changed", "entity_type": "lead", "entity_id": 2, "created_at": 1002},
+            ]
+
+            self.account.by_id_status = 500
+            with self.assertRaises(AmoAPIError):
+                await poll_amo_events(amo, self.Session)
+
+            with self.Session() as session:
+                self.assertEqual(set(session.scalars(select(AmoLeadRecord.id))), {1, 2})
+                self.assertEqual(session.get(AmoSyncState, "events").updated_from, 1000)
+
+            # после сбоя те же события применяются заново; сделки 2 в ответе
+            # amoCRM нет — она удалена
+            self.account.by_id_status = None
+            self.account.leads = [make_lead(1, status_id=143, updated_at=1001)]
+            result = await poll_amo_events(amo, self.Session)
+
+        self.assertEqual(result.cursor, 1002)
+        with self.Session() as session:
+            rows = {row.id: row for row in session.scalars(select(AmoLeadRecord))}
+            self.assertEqual(set(rows), {1})
+            self.assertEqual(rows[1].status_id, 143)
+
+    async def test_first_poll_starts_cursor_at_current_time(self):
+        async with make_amo(self.account.handler) as amo:
+            result = await poll_amo_events(amo, self.Session)
+
+        self.assertEqual(result.events_count, 0)
+        self.assertEqual(self.account.requests, [])
+        with self.Session() as session:
+            self.assertEqual(session.get(AmoSyncState, "events").updated_from, result.cursor)
+
+    def test_restored_entity_is_refetched_instead_of_deleted(self):
+        changes = changes_from_events([
+            {"type": "lead_restored", "entity_type": "lead", "entity_id": 5, "created_at": 20},
+            {"type": "lead_deleted", "entity_type": "lead", "entity_id": 5, "created_at": 10},
+            {"type": "contact_deleted", "entity_type": "contact", "entity_id": 6, "created_at": 10},
+        ])
+
+        self.assertEqual(changes.changed["leads"], {5})
+        self.assertEqual(changes.deleted["leads"], set())
+        self.assertEqual(changes.deleted["contacts"], {6})
+
+    def test_concurrent_writers_insert_same_new_ids(self):
+        # обновление аналитики, лента событий и синхронизация контактов
+        # одновременно вставляют одни и те же новые id
+        writers = 6
+        for round_number in range(5):
+            base_id = round_number * 100
+            barrier = threading.Barrier(writers)
+
+            def write(writer: int) -> None:
+                leads = [
+                    AmoLead(
+                        lead_id=base_id + index,
+                        lead_price=writer,
+                        created_at=1,
+                        close_at=2,
+                        contact_id=base_id + index,
+                        shipment_at=None,
+                        pipeline_id=ANALYTICS_PIPELINE_ID,
+                        status_id=142,
+                        updated_at=base_id + writer,
+                    )
+                    for index in range(20)
+                ]
+                contacts = [
+                    AmoContact(
+                        contact_id=base_id + index,
+                        customer_id=None,
+                        attestate_at=0,
+                        updated_at=base_id + writer,
+                        phones=(f"7900{base_id + index:07d}",),
+                    )
+                    for index in range(20)
+                ]
+                barrier.wait()
+                if writer % 2:
+                    store_mirror_page(self.Session, "leads", leads)
+                    store_mirror_page(self.Session, "contacts", contacts)
+                    save_sync_state(self.Session, "leads", base_id + writer)
+                else:
+                    replace_mirror_records(self.Session, "contacts", [c.contact_id for c in contacts], contacts)
+                    replace_mirror_records(self.Session, "leads", [lead.lead_id for lead in leads], leads)
+
+            with ThreadPoolExecutor(max_workers=writers) as executor:
+                for future in [executor.submit(write, writer) for writer in range(writers)]:
+                    future.result()
+
+        with self.Session() as session:
+            self.assertEqual(session.query(AmoLeadRecord).count(), 100)
+            self.assertEqual(session.query(AmoContactRecord).count(), 100)
+            self.assertEqual(session.query(AmoContactPhone).count(), 100)
+            self.assertEqual(session.query(AmoSyncState).count(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import httpx
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from models import AmoContactPhone, Base
+from services.amo_mirror import replace_mirror_records
+from services.amo_phones import DUPLICATE_PHONE_MESSAGE, get_contact_by_phone
+from settings.async_amo_api import AmoCRMWrapperAsync, contact_phones
+from tests.test_async_amo_api import make_amo
+
+
+def make_contact(contact_id: int, *phones: str, updated_at: int = 100) -> dict:
+    return {
+        "id": contact_id,
+        "updated_at": updated_at,
+        "custom_fields_values": [
+            {"field_code": "PHONE", "values": [{"value": phone, "enum_code": "WORK"} for phone in phones]}
+        ],
+    }
+
+
+class AmoPhoneIndexTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{(Path(self.temp_dir.name) / 'test.db').as_posix()}")
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.requests: list[httpx.Request] = []
+        self.contacts: list[dict] = []
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if not self.contacts:
+            return httpx.Response(204)
+        return httpx.Response(200, json={"_embedded": {"contacts": self.contacts}})
+
+    def store_contacts(self, contacts: list[dict], requested_ids: list[int] | None = None) -> None:
+        records = [AmoCRMWrapperAsync._contact_from_payload(contact) for contact in contacts]
+        replace_mirror_records(self.Session, "contacts", requested_ids or [], records)
+
+    def indexed_phones(self) -> list[tuple[str, int]]:
+        with self.Session() as session:
+            rows = session.scalars(select(AmoContactPhone).order_by(AmoContactPhone.phone))
+            return [(row.phone, row.contact_id) for row in rows]
+
+    def test_contact_phones_use_correct_phone_normalization(self):
+        contact = make_contact(1, "+7 (900) 000-00-01", "89000000001", "8-900-000-00-02", "")
+
+        self.assertEqual(contact_phones(contact), ("9000000001", "9000000002"))
+        self.assertEqual(contact_phones({"id": 2}), ())
+
+    def test_mirror_keeps_index_in_sync(self):
+        self.store_contacts([make_contact(1, "+79000000001"), make_contact(2, "+79000000002")])
+        self.store_contacts([make_contact(1, "+79000000003", updated_at=200)])
+        self.assertEqual(self.indexed_phones(), [("9000000002", 2), ("9000000003", 1)])
+
+        self.store_contacts([], requested_ids=[2])
+        self.assertEqual(self.indexed_phones(), [("9000000003", 1)])
+
+    async def test_index_hit_makes_no_amo_call(self):
+        self.store_contacts([make_contact(1, "+79000000001")])
+
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            ok, contact = await get_contact_by_phone(amo, self.Session, "9000000001")
+
+        self.assertEqual((ok, contact), (True, {"id": 1}))
+        self.assertEqual(self.requests, [])
+
+    async def test_duplicate_phone_in_index_is_reported(self):
+        self.store_contacts([make_contact(1, "+79000000001"), make_contact(2, "89000000001")])
+
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            ok, message = await get_contact_by_phone(amo, self.Session, "9000000001")
+
+        self.assertEqual((ok, message), (False, DUPLICATE_PHONE_MESSAGE))
+        self.assertEqual(self.requests, [])
+
+    async def test_miss_falls_back_to_amo_and_remembers_phones(self):
+        self.contacts = [make_contact(5, "+7 900 000-00-05", "+79000000006")]
+
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            ok, contact = await get_contact_by_phone(amo, self.Session, "9000000005")
+            again = await get_contact_by_phone(amo, self.Session, "9000000006")
+
+        self.assertTrue(ok)
+        self.assertEqual(contact["id"], 5)
+        self.assertEqual(again, (True, {"id": 5}))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.indexed_phones(), [("9000000005", 5), ("9000000006", 5)])
+
+    async def test_not_found_is_not_indexed(self):
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            ok, message = await get_contact_by_phone(amo, self.Session, "9000000009")
+
+        self.assertEqual((ok, message), (False, "Контакт не найден"))
+        self.assertEqual(self.indexed_phones(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
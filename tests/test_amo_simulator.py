@@ -0,0 +1,61 @@
+import unittest
+
+import httpx
+
+from benchmarks.amo_simulator import SimulatedAmoAccount, SimulatedAmoTransport
+from settings.async_amo_api import AmoCRMWrapperAsync
+from tests.test_async_amo_api import make_token
+from utils.analytics import build_streamed_amo_results
+
+
+def make_simulated_amo(transport: SimulatedAmoTransport) -> AmoCRMWrapperAsync:
+    return AmoCRMWrapperAsync(
+        path="unused.env",
+        amocrm_subdomain="example",
+        amocrm_client_id="client-id",
+        amocrm_client_secret="client-secret",
+        amocrm_redirect_url="https://example.test/oauth",
+        amocrm_access_token=make_token(),
+        amocrm_refresh_token="refresh-token",
+        amocrm_secret_code="secret-code",
+        requests_per_second=1000,
+        burst=10,
+        transport=transport,
+    )
+
+
+class SimulatedAmoTransportTests(unittest.IsolatedAsyncioTestCase):
+    async def test_client_reads_whole_simulated_account(self):
+        account = SimulatedAmoAccount.generate(leads=600, customers=120, seed=3)
+        transport = SimulatedAmoTransport(account, requests_per_second=0, latency=0, jitter=0)
+
+        async with make_simulated_amo(transport) as amo:
+            leads = await amo.get_pipeline_1628622_status_142_leads()
+            customers = await amo.get_customers_with_contacts()
+            results = await build_streamed_amo_results(amo)
+
+        customer_contacts = {contact_id for customer in account.customers for contact_id in customer.contact_ids}
+        expected = [
+            lead.lead_id
+            for lead in account.leads
+            if lead.contact_id in customer_contacts and lead.project != "Крупные заказы"
+        ]
+        self.assertEqual([lead.lead_id for lead in leads], [lead.lead_id for lead in account.leads])
+        self.assertEqual(len(customers), 120)
+        self.assertEqual(sorted({result.lead_obj.lead_id for result in results}), expected)
+        self.assertNotIn(429, transport.stats()["statuses"])
+
+    async def test_rejects_requests_over_server_rate_limit(self):
+        account = SimulatedAmoAccount.generate(leads=10, customers=2)
+        transport = SimulatedAmoTransport(account, requests_per_second=2, latency=0, jitter=0)
+
+        async with httpx.AsyncClient(transport=transport, base_url="https://example.amocrm.ru") as client:
+            responses = [await client.get("/api/v4/users/7") for _ in range(3)]
+
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(responses[2].headers["Retry-After"], "1")
+        self.assertEqual(transport.stats()["statuses"], {200: 2, 429: 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
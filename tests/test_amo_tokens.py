@@ -0,0 +1,135 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base
+from settings.amo_tokens import (
+    AmoTokens,
+    DatabaseTokenStore,
+    EnvFileTokenStore,
+    FileTokenStore,
+    create_token_store,
+)
+from tests.test_async_amo_api import make_amo, make_token
+
+
+class FileTokenStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "tokens.json"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_saves_atomically_and_loads(self):
+        store = FileTokenStore(self.path)
+        self.assertIsNone(store.load())
+
+        store.save(AmoTokens(access_token="a1", refresh_token="r1"))
+        store.save(AmoTokens(access_token="a2", refresh_token="r2"))
+
+        self.assertEqual(FileTokenStore(self.path).load(), AmoTokens("a2", "r2"))
+        self.assertEqual(sorted(p.name for p in Path(self.temp_dir.name).iterdir()), ["tokens.json"])
+
+    def test_only_one_store_holds_refresh_lock(self):
+        first = FileTokenStore(self.path)
+        second = FileTokenStore(self.path)
+
+        self.assertTrue(first.try_acquire_refresh())
+        self.assertFalse(second.try_acquire_refresh())
+        first.release_refresh()
+        self.assertTrue(second.try_acquire_refresh())
+        second.release_refresh()
+
+    def test_env_store_keeps_other_settings(self):
+        env_path = Path(self.temp_dir.name) / ".env"
+        env_path.write_text("BOT_TOKEN=bot\nAMOCRM_ACCESS_TOKEN=old\nAMOCRM_REFRESH_TOKEN=old\n")
+        store = EnvFileTokenStore(env_path)
+
+        store.save(AmoTokens(access_token="a1", refresh_token="r1"))
+
+        self.assertEqual(store.load(), AmoTokens("a1", "r1"))
+        self.assertIn("BOT_TOKEN=bot", env_path.read_text())
+
+    def test_rejects_unknown_store(self):
+        with self.assertRaisesRegex(ValueError, "redis"):
+            create_token_store("redis", env_path=".env", file_path="t.json", session_factory=None)
+
+
+class DatabaseTokenStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        database_path = Path(self.temp_dir.name) / "test.db"
+        self.engine = create_engine(f"sqlite:///{database_path.as_posix()}")
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_saves_and_elects_single_refresher(self):
+        first = DatabaseTokenStore(self.Session)
+        second = DatabaseTokenStore(self.Session)
+
+        self.assertTrue(first.try_acquire_refresh())
+        self.assertFalse(second.try_acquire_refresh())
+        first.save(AmoTokens(access_token="a1", refresh_token="r1"))
+        first.release_refresh()
+
+        self.assertEqual(second.load(), AmoTokens("a1", "r1"))
+        self.assertTrue(second.try_acquire_refresh())
+
+    def test_expired_lease_can_be_taken_over(self):
+        crashed = DatabaseTokenStore(self.Session, lease_seconds=-1)
+        other = DatabaseTokenStore(self.Session)
+
+        self.assertTrue(crashed.try_acquire_refresh())
+        self.assertTrue(other.try_acquire_refresh())
+
+
+class SharedTokenRefreshTests(unittest.IsolatedAsyncioTestCase):
+    async def test_workers_share_one_oauth_refresh(self):
+        new_token = make_token(expires_in=7200)
+        oauth_calls = 0
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal oauth_calls
+            if request.url.path == "/oauth2/access_token":
+                oauth_calls += 1
+                await asyncio.sleep(0.05)
+                return httpx.Response(200, json={"access_token": new_token, "refresh_token": "new-refresh"})
+            return httpx.Response(200, json={"id": 1})
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "tokens.json"
+            old_token = make_token(expires_in=-10)
+            workers = [
+                make_amo(handler, access_token=old_token, token_store=FileTokenStore(path), token_refresh_margin=0)
+                for _ in range(3)
+            ]
+            with patch("settings.async_amo_api.TOKEN_STORE_POLL_INTERVAL", 0.01):
+                for amo in workers:
+                    await amo.open()
+                try:
+                    await asyncio.gather(*(amo.get_lead_by_id(1) for amo in workers))
+                finally:
+                    for amo in workers:
+                        await amo.close()
+
+            stored = FileTokenStore(path).load()
+
+        self.assertEqual(oauth_calls, 1)
+        self.assertEqual({amo.amocrm_access_token for amo in workers}, {new_token})
+        self.assertEqual({amo.amocrm_refresh_token for amo in workers}, {"new-refresh"})
+        self.assertEqual(stored, AmoTokens(new_token, "new-refresh"))
+
+
+if __name__ == "__main__":
+    unittest.main()
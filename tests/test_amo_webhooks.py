@@ -0,0 +1,154 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+import httpx
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import main
+from models import AmoLeadRecord, Base
+from services.amo_mirror import AmoChanges, refresh_amo_mirror
+from services.amo_webhooks import AmoWebhookQueue, parse_amo_webhook
+from tests.test_amo_mirror import FakeAmoAccount, make_lead
+from tests.test_async_amo_api import make_amo
+
+
+WEBHOOK_BODY = urlencode([
+    ("leads[status][0][id]", "11"),
+    ("leads[status][0][status_id]", "142"),
+    ("leads[status][0][pipeline_id]", "1628622"),
+    ("leads[delete][0][id]", "12"),
+    ("contacts[update][0][id]", "21"),
+    ("contacts[update][0][type]", "contact"),
+    ("contacts[update][1][id]", "22"),
+    ("contacts[update][1][type]", "company"),
+    ("customers[add][0][id]", "31"),
+    ("leads[note][0][note][id]", "99"),
+    ("account[subdomain]", "example"),
+])
+
+
+class AmoWebhookParserTests(unittest.TestCase):
+    def test_collects_changed_and_deleted_ids(self):
+        changes = parse_amo_webhook(WEBHOOK_BODY.encode())
+
+        self.assertEqual(changes.changed["leads"], {11})
+        self.assertEqual(changes.deleted["leads"], {12})
+        self.assertEqual(changes.changed["contacts"], {21})
+        self.assertEqual(changes.changed["customers"], {31})
+        self.assertEqual(len(changes), 4)
+
+    def test_ignores_invalid_ids(self):
+        with self.assertLogs("services.amo_webhooks", level="WARNING"):
+            changes = parse_amo_webhook("leads[update][0][id]=abc")
+
+        self.assertFalse(changes)
+
+
+class AmoWebhookQueueTests(unittest.IsolatedAsyncioTestCase):
+    async def test_merges_queued_changes_into_one_batch(self):
+        queue = AmoWebhookQueue(batch_delay=0.05)
+        first = AmoChanges()
+        first.mark_changed("leads", 1)
+        second = AmoChanges()
+        second.mark_deleted("leads", 1)
+        second.mark_changed("contacts", 5)
+
+        self.assertFalse(queue.submit(AmoChanges()))
+        self.assertTrue(queue.submit(first))
+        asyncio.get_running_loop().call_later(0.01, queue.submit, second)
+        batch = await queue.next_batch()
+
+        self.assertEqual(batch.changed["leads"], set())
+        self.assertEqual(batch.deleted["leads"], {1})
+        self.assertEqual(batch.changed["contacts"], {5})
+
+    async def test_batch_is_capped_by_size(self):
+        queue = AmoWebhookQueue(batch_delay=1.0, max_batch_size=2)
+        for lead_id in range(3):
+            changes = AmoChanges()
+            changes.mark_changed("leads", lead_id)
+            queue.submit(changes)
+
+        batch = await asyncio.wait_for(queue.next_batch(), 0.5)
+
+        self.assertEqual(batch.changed["leads"], {0, 1})
+
+    async def test_worker_applies_batches_to_mirror(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            engine = create_engine(f"sqlite:///{(Path(temp_dir) / 'test.db').as_posix()}")
+            Base.metadata.create_all(engine)
+            Session = sessionmaker(bind=engine, expire_on_commit=False)
+            account = FakeAmoAccount()
+            account.leads = [make_lead(11, status_id=555), make_lead(12)]
+
+            async with make_amo(account.handler, requests_per_second=1000, burst=10) as amo:
+                await refresh_amo_mirror(amo, Session, entities=("leads",))
+                account.leads = [make_lead(11, updated_at=200)]
+
+                queue = AmoWebhookQueue(batch_delay=0)
+                worker = asyncio.create_task(queue.run(amo, Session))
+                queue.submit(parse_amo_webhook(WEBHOOK_BODY))
+                for _ in range(100):
+                    await asyncio.sleep(0.01)
+                    with Session() as session:
+                        rows = {row.id: row.status_id for row in session.scalars(select(AmoLeadRecord))}
+                    if rows == {11: 142}:
+                        break
+                worker.cancel()
+                await asyncio.gather(worker, return_exceptions=True)
+            engine.dispose()
+
+        self.assertEqual(rows, {11: 142})
+
+
+class AmoWebhookEndpointTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        transport = httpx.ASGITransport(app=main.app)
+        self.client = httpx.AsyncClient(transport=transport, base_url="https://example.test")
+
+    async def asyncTearDown(self) -> None:
+        await self.client.aclose()
+
+    async def test_queues_parsed_changes(self):
+        with (
+            patch.object(main.config.amo_config, "webhook_token", "secret"),
+            patch.object(main.amo_webhook_queue, "submit", return_value=True) as submit,
+        ):
+            response = await self.client.post(
+                "/amo/webhook?token=secret",
+                content=WEBHOOK_BODY,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"status": "ok", "changes": 4})
+        self.assertEqual(submit.call_args.args[0].deleted["leads"], {12})
+
+    async def test_rejects_invalid_token(self):
+        with (
+            patch.object(main.config.amo_config, "webhook_token", "secret"),
+            patch.object(main.amo_webhook_queue, "submit") as submit,
+        ):
+            response = await self.client.post("/amo/webhook?token=wrong", content=WEBHOOK_BODY)
+
+        self.assertEqual(response.status_code, 401)
+        submit.assert_not_called()
+
+    async def test_rejects_webhooks_without_configured_token(self):
+        with (
+            patch.object(main.config.amo_config, "webhook_token", None),
+            patch.object(main.amo_webhook_queue, "submit") as submit,
+        ):
+            response = await self.client.post("/amo/webhook", content=WEBHOOK_BODY)
+
+        self.assertEqual(response.status_code, 503)
+        submit.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
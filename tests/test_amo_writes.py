@@ -0,0 +1,417 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import httpx
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import main
+import services.amo_phones
+from models import AmoWriteDeadLetter, Base
+from services.amo_phones import find_contact_ids_by_phone, remember_contact_phones
+from services.amo_writes import AmoWriteError, AmoWriteQueue, store_dead_letters
+from tests.test_amo_phones import make_contact
+from tests.test_async_amo_api import make_amo
+
+
+class FakeAmoWrites:
+    def __init__(self) -> None:
+        self.batches: list[tuple[str, list[dict]]] = []
+        self.reject = lambda entities: False
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        entities = json.loads(request.content)
+        self.batches.append((request.url.path, entities))
+        if self.reject(entities):
+            return httpx.Response(400, json={"title": "Bad Request"})
+        key = {"/api/v4/leads/link": "links", "/api/v4/leads/notes": "notes"}.get(
+            request.url.path, request.url.path.rsplit("/", 1)[-1]
+        )
+        created = [{"id": 1000 + index, "request_id": str(index)} for index in range(len(entities))]
+        return httpx.Response(200, json={"_embedded": {key: created}})
+
+
+class AmoWriteQueueTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{(Path(self.temp_dir.name) / 'test.db').as_posix()}")
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.amo = FakeAmoWrites()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    async def run_queue(self, queue: AmoWriteQueue, futures: list[asyncio.Future]) -> list:
+        async with make_amo(self.amo.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            worker = asyncio.create_task(queue.run(amo, self.Session))
+            try:
+                return await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 2)
+            finally:
+                worker.cancel()
+                await asyncio.gather(worker, return_exceptions=True)
+
+    async def test_groups_mutations_by_kind_into_batches(self):
+        queue = AmoWriteQueue(batch_delay=0.02, max_batch_size=3)
+        futures = queue.submit_many("tasks", [{"text": str(index)} for index in range(4)])
+        futures += queue.submit_many("lead_links", [{"entity_id": 1, "to_entity_id": 2}])
+
+        results = await self.run_queue(queue, futures)
+
+        self.assertEqual(
+            [(path, len(entities)) for path, entities in self.amo.batches],
+            [("/api/v4/tasks", 3), ("/api/v4/tasks", 1), ("/api/v4/leads/link", 1)],
+        )
+        self.assertEqual([result["id"] for result in results], [1000, 1001, 1002, 1000, 1000])
+
+    async def test_isolates_bad_mutation_and_dead_letters_it(self):
+        queue = AmoWriteQueue(batch_delay=0.01, max_attempts=2, retry_delay=0.01)
+        self.amo.reject = lambda entities: any(entity.get("bad") for entity in entities)
+        futures = queue.submit_many("tasks", [{"text": "ok"}, {"text": "broken", "bad": True}])
+
+        with self.assertLogs("services.amo_writes", level="ERROR"):
+            good, bad = await self.run_queue(queue, futures)
+
+        with self.Session() as session:
+            dead = session.scalars(select(AmoWriteDeadLetter)).all()
+
+        self.assertEqual(good["id"], 1000)
+        self.assertIsInstance(bad, AmoWriteError)
+        self.assertEqual([(row.kind, row.payload["text"], row.attempts) for row in dead], [("tasks", "broken", 2)])
+        # общая пачка, затем вторая попытка каждого изменения отдельно
+        self.assertEqual([len(entities) for _, entities in self.amo.batches], [2, 1, 1])
+
+    async def test_ambiguous_failure_is_not_resent(self):
+        # amoCRM создал задачи, но ответ потерялся: повтор создал бы дубли
+        queue = AmoWriteQueue(batch_delay=0.01, max_attempts=5, retry_delay=0.01)
+        accept = self.amo.handler
+
+        async def lost_response(request: httpx.Request) -> httpx.Response:
+            await accept(request)
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        future = queue.submit("tasks", {"text": "once"})
+        async with make_amo(lost_response, requests_per_second=1000, burst=10) as amo:
+            worker = asyncio.create_task(queue.run(amo, self.Session))
+            with self.assertLogs("services.amo_writes", level="ERROR"):
+                result = await asyncio.wait_for(asyncio.gather(future, return_exceptions=True), 2)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+        with self.Session() as session:
+            dead = session.scalars(select(AmoWriteDeadLetter)).all()
+
+        self.assertIsInstance(result[0], AmoWriteError)
+        self.assertEqual(len(self.amo.batches), 1)
+        self.assertEqual([(row.payload["text"], row.attempts) for row in dead], [("once", 1)])
+        self.assertIn("ReadTimeout", dead[0].error)
+
+    async def test_retries_batch_that_never_reached_amo(self):
+        queue = AmoWriteQueue(batch_delay=0.01, max_attempts=3, retry_delay=0.01)
+        accept = self.amo.handler
+        failures = iter([httpx.ConnectError("refused"), httpx.Response(503)])
+
+        async def flaky(request: httpx.Request) -> httpx.Response:
+            failure = next(failures, None)
+            if isinstance(failure, Exception):
+                raise failure
+            return failure or await accept(request)
+
+        self.amo.handler = flaky
+        results = await self.run_queue(queue, [queue.submit("tasks", {"text": "retry"})])
+
+        self.assertEqual(results[0]["id"], 1000)
+        self.assertEqual(len(self.amo.batches), 1)
+
+    async def test_drain_waits_for_batch_in_flight(self):
+        queue = AmoWriteQueue(batch_delay=0)
+        received = asyncio.Event()
+        release = asyncio.Event()
+        accept = self.amo.handler
+
+        async def slow_handler(request: httpx.Request) -> httpx.Response:
+            received.set()
+            await release.wait()
+            return await accept(request)
+
+        self.amo.handler = slow_handler
+        future = queue.submit("tasks", {"text": "in flight"})
+        async with make_amo(self.amo.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            worker = asyncio.create_task(queue.run(amo, self.Session))
+            await asyncio.wait_for(received.wait(), 1)
+            # остановка сервиса: обработчик отменяется посреди отправки
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+            asyncio.get_running_loop().call_later(0.01, release.set)
+            await asyncio.wait_for(queue.drain(amo, self.Session), 1)
+
+        self.assertEqual(future.result()["id"], 1000)
+        self.assertEqual(len(self.amo.batches), 1)
+
+    async def test_drain_flushes_pending_retries_and_dead_letters_failures(self):
+        queue = AmoWriteQueue(batch_delay=0, max_attempts=5, retry_delay=60)
+        self.amo.reject = lambda entities: any(entity.get("bad") for entity in entities)
+        good = queue.submit("tasks", {"text": "retry"})
+        bad = queue.submit("tasks", {"text": "broken", "bad": True})
+
+        async with make_amo(self.amo.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+            worker = asyncio.create_task(queue.run(amo, self.Session))
+            while not self.amo.batches:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+            # повторы отложены на минуту; при остановке они отправляются сразу
+            with self.assertLogs("services.amo_writes", level="ERROR"):
+                await asyncio.wait_for(queue.drain(amo, self.Session), 1)
+
+        with self.Session() as session:
+            dead = session.scalars(select(AmoWriteDeadLetter)).all()
+
+        self.assertEqual(good.result()["id"], 1000)
+        self.assertIsInstance(bad.exception(), AmoWriteError)
+        self.assertEqual([(row.payload["text"], row.attempts) for row in dead], [("broken", 2)])
+        self.assertEqual([len(entities) for _, entities in self.amo.batches], [2, 1, 1])
+
+    async def test_overflow_is_dead_lettered_instead_of_raising(self):
+        queue = AmoWriteQueue(maxsize=1)
+        queued = queue.submit("tasks", {"text": "queued"})
+        with self.assertLogs("services.amo_writes", level="ERROR"):
+            overflow = queue.submit("tasks", {"text": "overflow"})
+            async with make_amo(self.amo.handler, requests_per_second=1000, burst=10, max_retries=0) as amo:
+                await queue.drain(amo, self.Session)
+
+        with self.Session() as session:
+            dead = session.scalars(select(AmoWriteDeadLetter)).all()
+
+        self.assertEqual(queued.result()["id"], 1000)
+        self.assertIsInstance(overflow.exception(), AmoWriteError)
+        self.assertEqual([(row.payload["text"], row.error) for row in dead], [("overflow", "write queue is full")])
+
+    async def test_dead_letter_table_is_bounded(self):
+        queue = AmoWriteQueue()
+        for index in range(5):
+            queue.submit("tasks", {"text": str(index)})
+        mutations = [queue._queue.get_nowait() for _ in range(5)]
+
+        store_dead_letters(self.Session, mutations[:3], "boom", limit=4)
+        store_dead_letters(self.Session, mutations[3:], "boom", limit=4)
+
+        with self.Session() as session:
+            texts = [row.payload["text"] for row in session.scalars(select(AmoWriteDeadLetter))]
+        self.assertEqual(texts, ["1", "2", "3", "4"])
+
+
+class AmoWriteEndpointTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        transport = httpx.ASGITransport(app=main.app)
+        self.client = httpx.AsyncClient(transport=transport, base_url="https://example.test")
+
+    async def asyncTearDown(self) -> None:
+        await self.client.aclose()
+
+    async def test_marketplace_items_are_queued_without_amo_call(self):
+        with (
+            patch.object(main.amo_write_queue, "submit_many") as submit_many,
+            patch.object(main.amo_api, "post_entities") as post_entities,
+        ):
+            response = await self.client.post(
+                "/sheets/marketplace",
+                json={"data": {"lead_id": 5, "items": [{"id": 7, "quantity": 2}, {"id": 8, "quantity": 0}]}},
+            )
+
+        self.assertEqual(response.json(), {"status": "ok"})
+        post_entities.assert_not_called()
+        kind, links = submit_many.call_args.args
+        self.assertEqual(kind, "lead_links")
+        self.assertEqual([(link["entity_id"], link["to_entity_id"]) for link in links], [(5, 7)])
+
+    async def notify_yandex_order(self, handler, order_id: int = 77) -> tuple[httpx.Response, Mock]:
+        order = {
+            "order": {
+                "buyer": {"id": 1, "firstName": "Иван", "lastName": "Петров"},
+                "items": [{"buyerPrice": 100, "count": 2, "offerName": "Реле"}],
+                "itemsTotal": 200,
+                "delivery": {"address": {"city": "Москва", "country": "Россия", "street": "Тверская", "house": "1"}},
+            }
+        }
+        buyer = {"result": {"phone": "+79000000000"}}
+        yandex_responses = iter([order, buyer])
+        amo = make_amo(handler, requests_per_second=1000, burst=10)
+        await amo.open()
+        try:
+            with (
+                patch.object(main, "amo_api", amo),
+                patch.object(main, "SessionLocal", self.Session),
+                patch.object(main.bot, "send_message"),
+                patch.object(main.requests, "get") as yandex_get,
+                patch.object(main.amo_write_queue, "submit") as submit,
+            ):
+                yandex_get.side_effect = lambda **kwargs: Mock(json=lambda: next(yandex_responses))
+                response = await self.client.post("/market/new_order/notification", json={"orderId": order_id})
+        finally:
+            await amo.close()
+        return response, submit
+
+    def use_temp_database(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        engine = create_engine(f"sqlite:///{(Path(temp_dir.name) / 'test.db').as_posix()}")
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine, expire_on_commit=False)
+        self.addCleanup(temp_dir.cleanup)
+        self.addCleanup(engine.dispose)
+        self.addCleanup(main.market_order_contacts.invalidate)
+
+    async def test_yandex_order_creates_lead_and_contact_in_one_request(self):
+        self.use_temp_database()
+        requests: list[httpx.Request] = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.method == "GET":
+                return httpx.Response(204)
+            return httpx.Response(200, json=[{"id": 501, "contact_id": 601, "request_id": ["0"], "merged": False}])
+
+        response, submit = await self.notify_yandex_order(handler)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(request.method, request.url.path) for request in requests],
+            [("GET", "/api/v4/contacts"), ("POST", "/api/v4/leads/complex")],
+        )
+        lead = json.loads(requests[1].content)[0]
+        self.assertEqual(lead["_embedded"]["contacts"][0]["first_name"], "Иван")
+        self.assertEqual(lead["_embedded"]["tags"], [{"id": 563936}])
+        kind, note = submit.call_args.args
+        self.assertEqual((kind, note["entity_id"]), ("lead_notes", 501))
+        self.assertIn("Реле: 2 шт.", note["params"]["text"])
+        # новый покупатель сразу попадает в индекс телефонов
+        self.assertEqual(find_contact_ids_by_phone(self.Session, "9000000000"), [601])
+        self.assertEqual(main.market_order_contacts.get(77), 601)
+
+    async def test_yandex_order_reuses_existing_contact(self):
+        self.use_temp_database()
+        remember_contact_phones(self.Session, 42, ("9000000000",))
+        requests: list[httpx.Request] = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, json={"_embedded": {"leads": [{"id": 502, "request_id": "0"}]}})
+
+        response, submit = await self.notify_yandex_order(handler, order_id=78)
+        with patch("services.amo_phones.find_contact_ids_by_phone") as find_ids:
+            await self.notify_yandex_order(handler, order_id=78)
+
+        self.assertEqual(response.status_code, 200)
+        find_ids.assert_not_called()
+        self.assertEqual(
+            [(request.method, request.url.path) for request in requests],
+            [("POST", "/api/v4/leads"), ("POST", "/api/v4/leads")],
+        )
+        lead = json.loads(requests[0].content)[0]
+        self.assertEqual(lead["_embedded"]["contacts"], [{"id": 42}])
+        kind, note = submit.call_args.args
+        self.assertEqual((kind, note["entity_id"]), ("lead_notes", 502))
+
+    async def test_yandex_order_ignores_contact_with_other_phone(self):
+        self.use_temp_database()
+        requests: list[httpx.Request] = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.method == "GET":
+                # полнотекстовый поиск находит номер, который лишь похож на искомый
+                return httpx.Response(200, json={"_embedded": {"contacts": [make_contact(7, "+7 910 000-00-00")]}})
+            return httpx.Response(200, json=[{"id": 503, "contact_id": 603, "request_id": ["0"], "merged": False}])
+
+        response, _ = await self.notify_yandex_order(handler, order_id=79)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(requests[0].url.params["query"], "9000000000")
+        self.assertEqual(
+            [(request.method, request.url.path) for request in requests],
+            [("GET", "/api/v4/contacts"), ("POST", "/api/v4/leads/complex")],
+        )
+        self.assertEqual(find_contact_ids_by_phone(self.Session, "9000000000"), [603])
+        self.assertEqual(find_contact_ids_by_phone(self.Session, "9100000000"), [])
+
+    async def test_yandex_order_uses_oldest_of_several_contacts(self):
+        self.use_temp_database()
+        requests: list[httpx.Request] = []
+        contacts = [
+            {**make_contact(9, "+7 900 000-00-00"), "created_at": 300},
+            {**make_contact(8, "89000000000", "+79000000001"), "created_at": 200},
+            {**make_contact(3, "+79000000009"), "created_at": 100},
+        ]
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.method == "GET":
+                return httpx.Response(200, json={"_embedded": {"contacts": contacts}})
+            return httpx.Response(200, json={"_embedded": {"leads": [{"id": 504, "request_id": "0"}]}})
+
+        response, _ = await self.notify_yandex_order(handler, order_id=80)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(request.method, request.url.path) for request in requests],
+            [("GET", "/api/v4/contacts"), ("POST", "/api/v4/leads")],
+        )
+        lead = json.loads(requests[1].content)[0]
+        self.assertEqual(lead["_embedded"]["contacts"], [{"id": 8}])
+        self.assertEqual(main.market_order_contacts.get(80), 8)
+        self.assertEqual(find_contact_ids_by_phone(self.Session, "9000000000"), [8, 9])
+
+    async def test_yandex_order_is_created_when_contact_search_fails(self):
+        self.use_temp_database()
+        requests: list[httpx.Request] = []
+        searches = iter([
+            httpx.Response(400, text="bad request"),
+            httpx.Response(200, json={"_embedded": {"contacts": [
+                {**make_contact(5, "+79000000000"), "created_at": 100},
+                {**make_contact(605, "+79000000000"), "created_at": 900},
+            ]}}),
+        ])
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if request.method == "GET":
+                return next(searches)
+            return httpx.Response(200, json=[{"id": 505, "contact_id": 605, "request_id": ["0"], "merged": False}])
+
+        with patch.object(services.amo_phones, "CONTACT_RECONCILE_DELAYS", (0.0,)):
+            response, submit = await self.notify_yandex_order(handler, order_id=81)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(request.method, request.url.path) for request in requests],
+            [("GET", "/api/v4/contacts"), ("POST", "/api/v4/leads/complex"), ("GET", "/api/v4/contacts")],
+        )
+        self.assertEqual(main.market_order_contacts.get(81), 605)
+        # повторный поиск нашёл старый контакт: менеджеру пишется примечание
+        notes = [call.args[1] for call in submit.call_args_list if call.args[0] == "lead_notes"]
+        self.assertEqual([note["entity_id"] for note in notes], [505, 505])
+        self.assertIn("дублирует контакт 5", notes[-1]["params"]["text"])
+        self.assertEqual(find_contact_ids_by_phone(self.Session, "9000000000"), [5, 605])
+
+    async def test_yandex_order_does_not_cache_missing_contact(self):
+        self.use_temp_database()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            if request.method == "GET":
+                return httpx.Response(204)
+            return httpx.Response(400, text="invalid lead")
+
+        response, _ = await self.notify_yandex_order(handler, order_id=82)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(main.market_order_contacts.get(82, "missing"), "missing")
+
+
+if __name__ == "__main__":
+    unittest.main()
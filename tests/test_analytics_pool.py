@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import time
+import unittest
+from types import SimpleNamespace
+
+from benchmarks.amo_analytics import analytics_records, join_indexed
+from benchmarks.amo_simulator import SimulatedAmoAccount, SimulatedAmoTransport
+from services.amo_analytics_writeback import collect_analytics_values
+from settings.async_amo_api import (
+    build_amo_results,
+    build_amo_results_analize_customers,
+    index_customers_by_contact,
+    join_leads_with_customers,
+)
+from tests.test_amo_simulator import make_simulated_amo
+from tests.test_utils_refactor import _random_leads_and_customers
+from utils.analytics import (
+    analyze_and_send_to_sheets,
+    build_customers_analysis_payload,
+    build_leads_payload,
+    compute_customers_payload,
+    compute_leads_payload,
+    pack_amo_results,
+    pack_customers,
+    pack_leads,
+    unpack_amo_results,
+)
+from utils.analytics_pool import AnalyticsPool
+from utils.budget_periods import parse_budget_periods
+from utils.loop_lag import LoopLagMonitor
+
+WRITEBACK_FIELDS = ("clean_price", "last_buy", "time_from_attestate")
+NOW = datetime.datetime(2026, 5, 1, 12, 0)
+
+
+class RecordingSheets:
+    def __init__(self) -> None:
+        self.payloads: list[list[dict]] = []
+
+    def send_json(self, payload, token, request_id, chunk=None, last=None):
+        self.payloads.append(payload)
+        return SimpleNamespace(status_code=200, text="ok")
+
+
+class PackedAnalyticsTests(unittest.TestCase):
+    # расчёт по распакованным кортежам должен давать то же, что по исходным записям
+    def test_packed_leads_payload_matches_inline(self):
+        for seed in range(300):
+            with self.subTest(seed=seed):
+                leads, customers = _random_leads_and_customers(seed)
+                expected = build_amo_results(leads, customers)
+
+                leads, customers = _random_leads_and_customers(seed)
+                matched = join_leads_with_customers(leads, index_customers_by_contact(customers))
+                payload, values = compute_leads_payload(pack_amo_results(matched), WRITEBACK_FIELDS)
+
+                self.assertEqual(payload, build_leads_payload(expected))
+                self.assertEqual(values, collect_analytics_values(expected, WRITEBACK_FIELDS))
+
+    def test_unpack_keeps_shared_records_shared(self):
+        account = SimulatedAmoAccount.generate(leads=300, customers=60, seed=2)
+        leads, customers = analytics_records(account)
+        matched = join_indexed(leads, customers)
+        unpacked = unpack_amo_results(pack_amo_results(matched))
+
+        self.assertEqual(unpacked, matched)
+        lead_ids = {id(result.lead_obj) for result in unpacked}
+        customer_ids = {id(result.customer_obj) for result in unpacked}
+        self.assertEqual(len(lead_ids), len({id(result.lead_obj) for result in matched}))
+        self.assertEqual(len(customer_ids), len({id(result.customer_obj) for result in matched}))
+
+    def test_packed_customers_payload_matches_inline(self):
+        periods = parse_budget_periods("all=2023-01-01..;recent=90d")
+        account = SimulatedAmoAccount.generate(leads=500, customers=100, seed=4)
+        leads, customers = analytics_records(account)
+        expected = build_customers_analysis_payload(
+            build_amo_results_analize_customers(leads, customers), periods, NOW
+        )
+
+        payload = compute_customers_payload(
+            pack_leads(leads),
+            pack_customers(customers),
+            periods,
+            NOW,
+        )
+
+        self.assertEqual(payload, expected)
+
+
+class AnalyticsPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = AnalyticsPool(workers=1)
+
+    async def asyncTearDown(self):
+        self.pool.shutdown()
+
+    def test_rejects_zero_workers(self):
+        with self.assertRaises(ValueError):
+            AnalyticsPool(workers=0)
+
+    async def test_analytics_in_pool_matches_inline(self):
+        account = SimulatedAmoAccount.generate(leads=400, customers=80, seed=5)
+        sent = {}
+        for name, pool in (("inline", None), ("pool", self.pool)):
+            transport = SimulatedAmoTransport(account, requests_per_second=0, latency=0, jitter=0)
+            sheets = RecordingSheets()
+            async with make_simulated_amo(transport) as amo:
+                await analyze_and_send_to_sheets(
+                    amo_api=amo,
+                    google_sheets=sheets,
+                    token="token",
+                    request_id=name,
+                    analytics_pool=pool,
+                )
+            sent[name] = sheets.payloads
+
+        self.assertTrue(sent["inline"][0])
+        self.assertEqual(sent["pool"], sent["inline"])
+
+    async def test_customers_payload_in_pool(self):
+        periods = parse_budget_periods(None)
+        account = SimulatedAmoAccount.generate(leads=200, customers=40, seed=6)
+        leads, customers = analytics_records(account)
+        expected = build_customers_analysis_payload(
+            build_amo_results_analize_customers(leads, customers), periods, NOW
+        )
+
+        payload = await self.pool.run(
+            compute_customers_payload,
+            pack_leads(leads),
+            pack_customers(customers),
+            periods,
+            NOW,
+        )
+
+        self.assertEqual(payload, expected)
+
+
+class LoopLagMonitorTests(unittest.IsolatedAsyncioTestCase):
+    async def test_measures_blocking_call(self):
+        monitor = LoopLagMonitor(interval=0.01, warning=0)
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        # синхронный код в цикле событий задерживает задачу монитора
+        time.sleep(0.2)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        stats = monitor.stats()
+        self.assertGreater(stats["samples"], 2)
+        self.assertGreaterEqual(stats["max_lag"], 0.15)
+        self.assertLess(stats["mean_lag"], stats["max_lag"])
+
+    def test_rejects_non_positive_interval(self):
+        with self.assertRaises(ValueError):
+            LoopLagMonitor(interval=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
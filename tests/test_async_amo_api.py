@@ -0,0 +1,369 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import httpx
+import jwt
+
+from settings.amo_decoding import custom_field_values, decode_embedded
+from settings.amo_rate_limit import AmoRateLimiter
+from settings.async_amo_api import AmoCRMWrapperAsync
+
+
+def make_token(expires_in: float = 3600) -> str:
+    return jwt.encode({"exp": int(time.time() + expires_in)}, "secret", algorithm="HS256")
+
+
+def make_amo(handler, **kwargs) -> AmoCRMWrapperAsync:
+    return AmoCRMWrapperAsync(
+        path=kwargs.pop("path", "unused.env"),
+        amocrm_subdomain="example",
+        amocrm_client_id="client-id",
+        amocrm_client_secret="client-secret",
+        amocrm_redirect_url="https://example.test/oauth",
+        amocrm_access_token=kwargs.pop("access_token", make_token()),
+        amocrm_refresh_token="refresh-token",
+        amocrm_secret_code="secret-code",
+        transport=httpx.MockTransport(handler),
+        **kwargs,
+    )
+
+
+class AmoRateLimiterTests(unittest.IsolatedAsyncioTestCase):
+    async def test_allows_burst_and_then_spaces_requests(self):
+        limiter = AmoRateLimiter(requests_per_second=50, burst=2, max_concurrency=10)
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        finished = []
+
+        async def take():
+            async with limiter:
+                finished.append(loop.time() - started_at)
+
+        await asyncio.gather(*(take() for _ in range(4)))
+
+        self.assertLess(finished[1], 0.015)
+        self.assertGreaterEqual(finished[2], 0.015)
+        self.assertGreaterEqual(finished[3], 0.035)
+
+    async def test_pause_delays_next_token(self):
+        limiter = AmoRateLimiter(requests_per_second=1000, burst=5, max_concurrency=5)
+        loop = asyncio.get_running_loop()
+        limiter.pause(0.05)
+        started_at = loop.time()
+
+        async with limiter:
+            elapsed = loop.time() - started_at
+
+        self.assertGreaterEqual(elapsed, 0.045)
+
+    def test_validates_settings(self):
+        with self.assertRaisesRegex(ValueError, "requests_per_second"):
+            AmoRateLimiter(requests_per_second=0)
+        with self.assertRaisesRegex(ValueError, "burst"):
+            AmoRateLimiter(burst=0)
+        with self.assertRaisesRegex(ValueError, "max_concurrency"):
+            AmoRateLimiter(max_concurrency=0)
+
+
+class AmoClientRateLimitTests(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_overlap_up_to_concurrency_cap(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.02)
+            in_flight -= 1
+            return httpx.Response(200, json={"id": 1})
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, max_concurrency=3) as amo:
+            await asyncio.gather(*(amo.get_lead_by_id(lead_id) for lead_id in range(9)))
+
+        self.assertEqual(max_in_flight, 3)
+
+    async def test_retries_429_after_pausing_limiter(self):
+        calls = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return httpx.Response(429, headers={"Retry-After": "0"})
+            return httpx.Response(200, json={"id": 5})
+
+        async with make_amo(handler) as amo:
+            result = await amo.get_lead_by_id(5)
+
+        self.assertEqual(result, {"id": 5})
+        self.assertEqual(calls, 2)
+
+
+    async def test_post_is_retried_only_when_not_applied(self):
+        responses = iter([
+            httpx.Response(503),
+            httpx.Response(500, json={"title": "Internal Server Error"}),
+        ])
+        calls = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal calls
+            calls += 1
+            return next(responses)
+
+        async with make_amo(handler, max_retries=3) as amo:
+            resp = await amo.post_entities("/api/v4/tasks", [{"text": "once"}])
+
+        # 503 без тела повторяется, 500 с телом мог прийти после создания задачи
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(calls, 2)
+
+
+class AmoTokenRefreshTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.env_path = Path(self.temp_dir.name) / ".env"
+        self.env_path.touch()
+        self.new_token = make_token(expires_in=7200)
+        self.oauth_calls = 0
+        self.auth_headers = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/oauth2/access_token":
+            self.oauth_calls += 1
+            await asyncio.sleep(0.01)
+            return httpx.Response(
+                200,
+                json={"access_token": self.new_token, "refresh_token": "new-refresh"},
+            )
+        self.auth_headers.append(request.headers["Authorization"])
+        return httpx.Response(200, json={"id": 1})
+
+    async def test_request_path_does_not_decode_token(self):
+        async with make_amo(self.handler, path=str(self.env_path)) as amo:
+            with patch("settings.async_amo_api.jwt.decode") as decode:
+                await asyncio.gather(*(amo.get_lead_by_id(lead_id) for lead_id in range(3)))
+
+        decode.assert_not_called()
+        self.assertEqual(self.oauth_calls, 0)
+
+    async def test_refreshes_token_in_background_before_expiry(self):
+        amo = make_amo(
+            self.handler,
+            path=str(self.env_path),
+            access_token=make_token(expires_in=60),
+            token_refresh_margin=300,
+        )
+        async with amo:
+            for _ in range(50):
+                if amo.amocrm_access_token == self.new_token:
+                    break
+                await asyncio.sleep(0.01)
+            await amo.get_lead_by_id(1)
+
+        self.assertEqual(self.oauth_calls, 1)
+        self.assertEqual(self.auth_headers, [f"Bearer {self.new_token}"])
+        self.assertIn("new-refresh", self.env_path.read_text())
+
+    async def test_expired_token_is_refreshed_once_for_concurrent_requests(self):
+        amo = make_amo(
+            self.handler,
+            path=str(self.env_path),
+            access_token=make_token(expires_in=-10),
+            token_refresh_margin=0,
+        )
+        async with amo:
+            await asyncio.gather(*(amo.get_lead_by_id(lead_id) for lead_id in range(5)))
+
+        self.assertEqual(self.oauth_calls, 1)
+        self.assertEqual(set(self.auth_headers), {f"Bearer {self.new_token}"})
+
+    def test_validates_refresh_margin(self):
+        with self.assertRaisesRegex(ValueError, "token_refresh_margin"):
+            make_amo(self.handler, token_refresh_margin=-1)
+
+
+class AmoRequestCoalescingTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.requests: list[httpx.Request] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"id": int(request.url.path.rsplit("/", 1)[-1])})
+
+    async def test_identical_concurrent_gets_share_one_request(self):
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            results = await asyncio.gather(
+                amo.get_lead_with_catalog_elements(5),
+                amo.get_lead_with_catalog_elements(5),
+                amo.get_lead_by_id(5),
+                amo.get_lead_by_id(6),
+            )
+            await amo.get_lead_by_id(5)
+
+        self.assertEqual([result["id"] for result in results], [5, 5, 5, 6])
+        # без get_reuse_ttl ответ не переиспользуется после завершения запроса
+        self.assertEqual(len(self.requests), 4)
+
+    async def test_cancelled_caller_does_not_cancel_shared_request(self):
+        async with make_amo(self.handler, requests_per_second=1000, burst=10) as amo:
+            first = asyncio.create_task(amo.get_lead_by_id(5))
+            second = asyncio.create_task(amo.get_lead_by_id(5))
+            await asyncio.sleep(0)
+            first.cancel()
+            result = await second
+
+        self.assertEqual(result, {"id": 5})
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_reuses_successful_response_until_mutation(self):
+        async with make_amo(self.handler, requests_per_second=1000, burst=10, get_reuse_ttl=30) as amo:
+            await amo.get_lead_by_id(5)
+            await amo.get_lead_by_id(5)
+            self.assertEqual(len(self.requests), 1)
+
+            await amo._base_request(type="patch", endpoint="/api/v4/leads/5", data={})
+            await amo.get_lead_by_id(5)
+            stats = amo.cache_stats()["get_requests"]
+
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+
+class AmoCustomFieldTests(unittest.TestCase):
+    def test_collects_wanted_fields_in_one_pass(self):
+        entity = {
+            "custom_fields_values": [
+                {"field_id": 1, "values": [{"value": "first"}, {"value": "second"}]},
+                {"field_id": 2, "values": []},
+                {"field_id": 3, "values": [{"value": "skipped"}]},
+                {"field_id": 1, "values": [{"value": "duplicate"}]},
+                {"field_id": 2, "values": [{"value": None}]},
+            ]
+        }
+
+        self.assertEqual(custom_field_values(entity, {1, 2, 4}), {1: "first", 2: None})
+        self.assertEqual(custom_field_values({"custom_fields_values": None}, {1}), {})
+
+    def test_parsers_keep_zero_defaults(self):
+        lead = AmoCRMWrapperAsync._lead_from_payload(make_lead_payload(1))
+        customer = AmoCRMWrapperAsync._customer_from_payload(
+            {"id": 2, "custom_fields_values": [{"field_id": 972634, "values": [{"value": None}]}]}
+        )
+        contact = AmoCRMWrapperAsync._contact_from_payload(
+            {"id": 3, "custom_fields_values": [{"field_id": 1096322, "values": [{"value": 1_700_000_000}]}]}
+        )
+
+        self.assertEqual((lead.shipment_at, lead.paid_at, lead.project), (0, 0, 0))
+        self.assertEqual(customer.status, 0)
+        self.assertEqual(contact.attestate_at, 1_700_000_000)
+
+
+def make_lead_payload(lead_id: int) -> dict:
+    return {
+        "id": lead_id,
+        "price": lead_id * 10,
+        "created_at": 1,
+        "closed_at": 2,
+        "custom_fields_values": None,
+        "_embedded": {"contacts": [{"id": lead_id + 1000, "is_main": True}]},
+    }
+
+
+class AmoPaginationTests(unittest.IsolatedAsyncioTestCase):
+    async def test_prefetches_pages_and_keeps_order(self):
+        requested_pages = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal in_flight, max_in_flight
+            page = int(request.url.params["page"])
+            limit = int(request.url.params["limit"])
+            requested_pages.append(page)
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # более ранние страницы отвечают медленнее поздних
+            await asyncio.sleep(0.01 * (6 - page) if page < 6 else 0)
+            in_flight -= 1
+            if page > 3:
+                return httpx.Response(204)
+            size = limit if page < 3 else 1
+            first_id = (page - 1) * limit
+            return httpx.Response(
+                200,
+                json={"_embedded": {"leads": [make_lead_payload(first_id + index) for index in range(size)]}},
+            )
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, page_prefetch=3) as amo:
+            leads = await amo.get_pipeline_1628622_status_142_leads(limit=2)
+
+        self.assertEqual([lead.lead_id for lead in leads], [0, 1, 2, 3, 4])
+        self.assertEqual(leads[0].contact_id, 1000)
+        self.assertEqual(max_in_flight, 3)
+        self.assertLessEqual(max(requested_pages), 5)
+
+    async def test_stops_on_error_page(self):
+        requested_pages = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            page = int(request.url.params["page"])
+            requested_pages.append(page)
+            if page == 2:
+                return httpx.Response(400, json={"title": "Bad Request"})
+            return httpx.Response(
+                200,
+                json={"_embedded": {"customers": [{"id": page, "created_at": 1, "_embedded": {"contacts": [{"id": 7}]}}]}},
+            )
+
+        async with make_amo(handler, requests_per_second=1000, burst=10, page_prefetch=2) as amo:
+            with self.assertLogs("settings.async_amo_api", level="ERROR"):
+                customers = await amo.get_customers_with_contacts(limit=1)
+
+        self.assertEqual([customer.customer_id for customer in customers], [1])
+        self.assertEqual(list(customers[0].contacts_id), [7])
+        self.assertNotIn(4, requested_pages)
+
+    async def test_page_items_are_parsed_into_records(self):
+        def handler(request: httpx.Request) -> httpx.Response:
+            page = int(request.url.params["page"])
+            if page > 1:
+                return httpx.Response(204)
+            return httpx.Response(
+                200,
+                json={"_embedded": {"leads": [make_lead_payload(1), make_lead_payload(2)]}},
+            )
+
+        async with make_amo(handler) as amo:
+            pages = [page async for page in amo._iter_pages(
+                "/api/v4/leads",
+                "",
+                embedded_key="leads",
+                parse=amo._lead_from_payload,
+            )]
+
+        self.assertEqual([[lead.lead_id for lead in page] for page in pages], [[1, 2]])
+        self.assertEqual(pages[0][1].lead_price, 20)
+
+    def test_decode_embedded_handles_empty_and_missing_keys(self):
+        self.assertEqual(decode_embedded(b"", "leads"), [])
+        self.assertEqual(decode_embedded(b'{"_embedded": {"leads": null}}', "leads"), [])
+        self.assertEqual(decode_embedded(b"[]", "leads"), [])
+        self.assertEqual(decode_embedded('{"_embedded": {"leads": [{"id": 1}]}}'.encode(), "leads"), [{"id": 1}])
+
+    def test_validates_prefetch_window(self):
+        with self.assertRaisesRegex(ValueError, "page_prefetch"):
+            make_amo(lambda request: httpx.Response(204), page_prefetch=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -38,6 +38,15 @@ class AlembicMigrationTests(unittest.TestCase):
                     "orders",
                     "order_items",
                     "order_suborders",
+                    "amo_leads",
+                    "amo_customers",
+                    "amo_contacts",
+                    "amo_sync_state",
+                    "amo_oauth_tokens",
+                    "amo_catalog_elements",
+                    "amo_write_dead_letters",
+                    "amo_contact_phones",
+                    "amo_analytics_writeback",
                 },
             )
             order_columns = {
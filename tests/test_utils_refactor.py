@@ -1,18 +1,36 @@
 import ast
 import datetime
+import random
 import tempfile
 import unittest
 from pathlib import Path
 from types import SimpleNamespace
 from unittest.mock import AsyncMock
 
-from settings.async_amo_api import AmoCustomers, AmoLead, AmoResult, AmoResultAnalizeCustomers
+from benchmarks.amo_analytics import (
+    compute_metrics_quadratic,
+    customer_groups,
+    group_customers_nested,
+    join_nested,
+    metrics_snapshot,
+)
+from settings.async_amo_api import (
+    AmoCustomers,
+    AmoLead,
+    AmoResult,
+    AmoResultAnalizeCustomers,
+    build_amo_results,
+    build_amo_results_analize_customers,
+    compute_amo_result_metrics,
+)
 from utils.analytics import (
     analyze_and_send_to_sheets,
     analyze_customers_and_send_to_sheets,
     build_customers_analysis_payload,
     build_leads_payload,
+    build_streamed_amo_results,
 )
+from utils.budget_periods import parse_budget_periods
 from utils.files import cleanup_generated_file
 from utils.formatting import format_grouped_number
 from utils.tracking import (
@@ -190,6 +208,118 @@ class AnalyticsPayloadTests(unittest.TestCase):
         )
 
 
+def _random_leads_and_customers(seed: int):
+    rng = random.Random(seed)
+    contacts = list(range(1, rng.randint(2, 12)))
+    customers = [
+        AmoCustomers(
+            customer_id=customer_id,
+            created_at=rng.choice([0, None, rng.randint(1, 50)]),
+            # контакты могут повторяться и принадлежать нескольким покупателям
+            contacts_id=rng.choices(contacts, k=rng.randint(0, 3)),
+        )
+        for customer_id in range(1, rng.randint(1, 8))
+    ]
+    leads = []
+    for lead_id in rng.sample(range(1, 200), rng.randint(0, 40)):
+        lead = _lead(
+            lead_id=lead_id,
+            lead_price=rng.choice([rng.randint(0, 100), rng.choice([0.1, 0.2, 0.7, 1e16])]),
+            contact_id=rng.choice(contacts + [None, 99]),
+            shipment_at=rng.choice([0, rng.randint(1, 20), rng.randint(1, 100)]),
+        )
+        lead.project = rng.choice(["Розница", "Опт", "Крупные заказы"])
+        leads.append(lead)
+    return leads, customers
+
+
+class AmoResultsJoinTests(unittest.TestCase):
+    # сравнение с прежними реализациями на случайных данных: общие и повторные
+    # контакты, одинаковые даты отгрузки, дробные цены, «Крупные заказы»
+    def test_matches_previous_implementation_on_random_data(self):
+        for seed in range(500):
+            with self.subTest(seed=seed):
+                leads, customers = _random_leads_and_customers(seed)
+                expected = metrics_snapshot(compute_metrics_quadratic(join_nested(leads, customers)))
+                expected_leads = [(lead.clean_price, lead.last_buy, lead.time_from_attestate) for lead in leads]
+
+                leads, customers = _random_leads_and_customers(seed)
+                self.assertEqual(metrics_snapshot(build_amo_results(leads, customers)), expected)
+                self.assertEqual(
+                    [(lead.clean_price, lead.last_buy, lead.time_from_attestate) for lead in leads],
+                    expected_leads,
+                )
+
+    def test_customer_groups_match_previous_implementation(self):
+        for seed in range(500):
+            with self.subTest(seed=seed):
+                leads, customers = _random_leads_and_customers(seed)
+                self.assertEqual(
+                    customer_groups(build_amo_results_analize_customers(leads, customers)),
+                    customer_groups(group_customers_nested(leads, customers)),
+                )
+
+    def test_invalid_price_fails_like_previous_implementation(self):
+        leads = [_lead(lead_id=1, lead_price=None, shipment_at=1), _lead(lead_id=2, shipment_at=2)]
+        with self.assertRaises(TypeError):
+            compute_amo_result_metrics([AmoResult(lead_obj=lead, customer_obj=_customer()) for lead in leads])
+
+        # цена последней сделки покупателя никуда не суммируется
+        leads = [_lead(lead_id=1, shipment_at=1), _lead(lead_id=2, lead_price=None, shipment_at=2)]
+        results = compute_amo_result_metrics([AmoResult(lead_obj=lead, customer_obj=_customer()) for lead in leads])
+        self.assertEqual(results[1].lead_obj.clean_price, 100)
+
+
+class BudgetPeriodTests(unittest.TestCase):
+    def test_configured_and_rolling_periods(self):
+        now = datetime.datetime(2026, 3, 15, 12, 0, 0)
+        paid_dates = [
+            (100, datetime.datetime(2025, 12, 31, 23, 59, 59)),
+            (200, datetime.datetime(2026, 1, 1, 0, 0, 0)),
+            (300, datetime.datetime(2026, 3, 6, 0, 0, 0)),
+            (400, datetime.datetime(2026, 3, 15, 23, 59, 59)),
+            (500, datetime.datetime(2026, 3, 16, 0, 0, 0)),
+        ]
+        leads = [
+            _lead(lead_id=index, lead_price=price, paid_at=paid_at.timestamp())
+            for index, (price, paid_at) in enumerate(paid_dates, start=1)
+        ]
+        periods = parse_budget_periods("year=2026-01-01..; last_10=10d; q4=2025-10-01..2025-12-31")
+
+        payload = build_customers_analysis_payload(
+            [AmoResultAnalizeCustomers(lead_list=leads, customer_obj=_customer())],
+            periods,
+            now=now,
+        )
+
+        self.assertEqual(
+            payload,
+            [{
+                "customer_id": 20,
+                "status": "active",
+                "leads_count": 5,
+                "clean_budjet": 1500,
+                "year": 900,
+                "last_10": 700,
+                "q4": 100,
+            }],
+        )
+
+    def test_default_periods_match_previous_windows(self):
+        periods = parse_budget_periods(None)
+
+        self.assertEqual([period.name for period in periods], [f"clean_budjet_{index}" for index in range(1, 6)])
+        self.assertEqual(
+            periods[0].bounds(datetime.date(2030, 1, 1)),
+            (datetime.datetime(2023, 7, 1, 0, 0, 0), datetime.datetime(2026, 6, 30, 23, 59, 59)),
+        )
+
+    def test_rejects_invalid_periods(self):
+        for spec in ("budget", "a=2026-01-01", "a=2026-02-01..2026-01-01", "a=0d", "a=1d;a=2d", "a=2026-13-01.."):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_budget_periods(spec)
+
+
 class _FakeSheets:
     def __init__(self):
         self.calls = []
@@ -199,13 +329,38 @@ class _FakeSheets:
         return SimpleNamespace(status_code=200)
 
 
+def _pages(*pages):
+    async def iterate():
+        for page in pages:
+            yield list(page)
+
+    return iterate
+
+
+def _sample_leads_and_customers():
+    customers = [
+        AmoCustomers(customer_id=1, created_at=5, contacts_id=[10, 11, 10], status="a"),
+        AmoCustomers(customer_id=2, created_at=0, contacts_id=[11], status="b"),
+        AmoCustomers(customer_id=3, created_at=0, contacts_id=[12], status="c"),
+    ]
+    leads = [
+        _lead(lead_id=4, lead_price=40, contact_id=10, shipment_at=30),
+        _lead(lead_id=1, lead_price=10, contact_id=11, shipment_at=20),
+        _lead(lead_id=2, lead_price=20, contact_id=10, shipment_at=10),
+        _lead(lead_id=3, lead_price=30, contact_id=99, shipment_at=5),
+        _lead(lead_id=5, lead_price=50, contact_id=12, shipment_at=0),
+    ]
+    leads[-1].project = "Крупные заказы"
+    return leads, customers
+
+
 class AnalyticsBackgroundTaskTests(unittest.IsolatedAsyncioTestCase):
-    async def test_lead_analysis_fetches_concurrently_and_sends_payload(self):
+    async def test_lead_analysis_streams_pages_and_sends_payload(self):
         lead = _lead()
         customer = _customer()
         api = SimpleNamespace(
-            get_pipeline_1628622_status_142_leads=AsyncMock(return_value=[lead]),
-            get_customers_with_contacts=AsyncMock(return_value=[customer]),
+            iter_leads=_pages([lead], [_lead(lead_id=2, contact_id=99)]),
+            iter_customers=_pages([customer]),
         )
         sheets = _FakeSheets()
 
@@ -216,11 +371,45 @@ class AnalyticsBackgroundTaskTests(unittest.IsolatedAsyncioTestCase):
             request_id="lead-request",
         )
 
-        api.get_pipeline_1628622_status_142_leads.assert_awaited_once_with()
-        api.get_customers_with_contacts.assert_awaited_once_with()
         self.assertEqual(len(sheets.calls), 1)
         self.assertEqual(sheets.calls[0]["request_id"], "lead-request")
-        self.assertEqual(sheets.calls[0]["payload"][0]["lead_id"], 1)
+        self.assertEqual([row["lead_id"] for row in sheets.calls[0]["payload"]], [1])
+        self.assertNotIn("chunk", sheets.calls[0])
+
+    async def test_streamed_results_match_list_join(self):
+        leads, customers = _sample_leads_and_customers()
+        expected = [
+            (result.lead_obj.lead_id, result.customer_obj.customer_id, result.lead_obj.clean_price, result.lead_obj.last_buy)
+            for result in build_amo_results(leads, customers)
+        ]
+
+        leads, customers = _sample_leads_and_customers()
+        api = SimpleNamespace(iter_leads=_pages(leads[:2], leads[2:]), iter_customers=_pages(customers[:1], customers[1:]))
+        streamed = [
+            (result.lead_obj.lead_id, result.customer_obj.customer_id, result.lead_obj.clean_price, result.lead_obj.last_buy)
+            for result in await build_streamed_amo_results(api)
+        ]
+
+        self.assertEqual(streamed, expected)
+        self.assertEqual([row[:2] for row in streamed], [(1, 1), (1, 2), (2, 1), (4, 1)])
+
+    async def test_lead_analysis_sends_payload_in_chunks(self):
+        leads = [_lead(lead_id=lead_id, shipment_at=lead_id) for lead_id in range(1, 6)]
+        api = SimpleNamespace(iter_leads=_pages(leads), iter_customers=_pages([_customer()]))
+        sheets = _FakeSheets()
+
+        await analyze_and_send_to_sheets(
+            amo_api=api,
+            google_sheets=sheets,
+            token="token",
+            request_id="lead-request",
+            chunk_size=2,
+        )
+
+        self.assertEqual(
+            [([row["lead_id"] for row in call["payload"]], call["chunk"], call["last"]) for call in sheets.calls],
+            [([1, 2], 0, False), ([3, 4], 1, False), ([5], 2, True)],
+        )
 
     async def test_customer_analysis_sends_payload_to_customer_client(self):
         lead = _lead()
@@ -1,18 +1,51 @@
 import asyncio
 import datetime
 import logging
+from array import array
+from dataclasses import fields
 from decimal import Decimal, InvalidOperation
+from operator import attrgetter
 from typing import Any
 
-from settings.async_amo_api import build_amo_results, build_amo_results_analize_customers
+from services.amo_analytics_writeback import (
+    active_field_ids,
+    collect_analytics_values,
+    write_back_analytics,
+    write_back_analytics_values,
+)
+from services.amo_mirror import (
+    load_analytics_customers,
+    load_analytics_data,
+    load_analytics_leads,
+    refresh_amo_mirror,
+)
+from settings.async_amo_api import (
+    AmoCustomers,
+    AmoLead,
+    AmoResult,
+    build_amo_results_analize_customers,
+    compute_amo_result_metrics,
+    index_customers_by_contact,
+    join_leads_with_customers,
+)
+from utils.analytics_pool import AnalyticsPool
+from utils.budget_periods import BudgetPeriod, parse_budget_periods, period_bounds, sum_by_periods
 from utils.utils import conver_timestamp_to_days, convert_data
 
 
 logger = logging.getLogger(__name__)
 
+# сколько сделок читать из зеркала за один запрос
+MIRROR_LEADS_PAGE_SIZE = 5000
 
-def build_leads_payload(amo_results) -> list[dict[str, Any]]:
-    return [
+# Записи уходят в процесс расчёта кортежами полей: pickle объектов со
+# __slots__ в десятки раз медленнее, чем тех же значений в кортежах.
+_lead_record = attrgetter(*(field.name for field in fields(AmoLead)))
+_customer_record = attrgetter(*(field.name for field in fields(AmoCustomers)))
+
+
+def iter_leads_payload(amo_results):
+    return (
         {
             "lead_id": result.lead_obj.lead_id,
             "lead_price": result.lead_obj.lead_price,
@@ -28,10 +61,18 @@ def build_leads_payload(amo_results) -> list[dict[str, Any]]:
             "paid_at": convert_data(result.lead_obj.paid_at),
         }
         for result in amo_results
-    ]
+    )
 
 
-def build_customers_analysis_payload(amo_results_customers) -> list[dict[str, Any]]:
+def build_leads_payload(amo_results) -> list[dict[str, Any]]:
+    return list(iter_leads_payload(amo_results))
+
+
+def build_customers_analysis_payload(
+    amo_results_customers,
+    periods: list[BudgetPeriod] | None = None,
+    now: datetime.datetime | None = None,
+) -> list[dict[str, Any]]:
     def _lead_price_value(value) -> Decimal:
         if value in (None, ""):
             return Decimal("0")
@@ -48,103 +89,274 @@ def build_customers_analysis_payload(amo_results_customers) -> list[dict[str, An
             return int(value)
         return float(value)
 
-    def _paid_at_datetime(value) -> datetime.datetime | None:
+    def _paid_at_timestamp(value) -> float | None:
         if value in (None, 0, ""):
             return None
         try:
-            return datetime.datetime.fromtimestamp(float(value))
+            timestamp = float(value)
+            # те же оплаты, что раньше отбрасывал datetime.fromtimestamp
+            datetime.datetime.fromtimestamp(timestamp)
         except (TypeError, ValueError, OverflowError, OSError):
             return None
+        return timestamp
 
-    periods = {
-        "clean_budjet_1": (
-            datetime.datetime(2023, 7, 1, 0, 0, 0),
-            datetime.datetime(2026, 6, 30, 23, 59, 59),
-        ),
-        "clean_budjet_2": (
-            datetime.datetime(2024, 7, 1, 0, 0, 0),
-            datetime.datetime(2026, 6, 30, 23, 59, 59),
-        ),
-        "clean_budjet_3": (
-            datetime.datetime(2025, 7, 1, 0, 0, 0),
-            datetime.datetime(2026, 6, 30, 23, 59, 59),
-        ),
-        "clean_budjet_4": (
-            datetime.datetime(2026, 1, 1, 0, 0, 0),
-            datetime.datetime(2026, 6, 30, 23, 59, 59),
-        ),
-        "clean_budjet_5": (
-            datetime.datetime(2026, 4, 1, 0, 0, 0),
-            datetime.datetime(2026, 6, 30, 23, 59, 59),
-        ),
-    }
+    # границы окон считаются один раз на выгрузку: скользящие окна — от сегодня
+    bounds = period_bounds(periods if periods is not None else parse_budget_periods(None), now)
 
     payload = []
     for result in amo_results_customers:
         lead_list = result.lead_list
         clean_budjet = Decimal("0")
-        period_budjets = {key: Decimal("0") for key in periods}
+        paid_prices = []
 
         for lead in lead_list:
             lead_price = _lead_price_value(lead.lead_price)
             clean_budjet += lead_price
 
-            paid_at = _paid_at_datetime(lead.paid_at)
-            if paid_at is None:
-                continue
-
-            for key, (start_at, end_at) in periods.items():
-                if start_at <= paid_at <= end_at:
-                    period_budjets[key] += lead_price
-
-        payload.append(
-            {
-                "customer_id": result.customer_obj.customer_id,
-                "status": result.customer_obj.status,
-                "leads_count": len(lead_list),
-                "clean_budjet": _json_amount(clean_budjet),
-                "clean_budjet_1": _json_amount(period_budjets["clean_budjet_1"]),
-                "clean_budjet_2": _json_amount(period_budjets["clean_budjet_2"]),
-                "clean_budjet_3": _json_amount(period_budjets["clean_budjet_3"]),
-                "clean_budjet_4": _json_amount(period_budjets["clean_budjet_4"]),
-                "clean_budjet_5": _json_amount(period_budjets["clean_budjet_5"]),
-            }
-        )
+            paid_at = _paid_at_timestamp(lead.paid_at)
+            if paid_at is not None:
+                paid_prices.append((paid_at, lead_price))
+
+        row = {
+            "customer_id": result.customer_obj.customer_id,
+            "status": result.customer_obj.status,
+            "leads_count": len(lead_list),
+            "clean_budjet": _json_amount(clean_budjet),
+        }
+        for name, amount in sum_by_periods(paid_prices, bounds).items():
+            row[name] = _json_amount(amount)
+        payload.append(row)
 
     return payload
 
 
+def pack_leads(leads) -> list[tuple]:
+    return [_lead_record(lead) for lead in leads]
+
+
+def pack_customers(customers) -> list[tuple]:
+    return [_customer_record(customer) for customer in customers]
+
+
+def pack_amo_results(amo_results) -> tuple[list[tuple], list[tuple], array]:
+    """
+    Сопоставленные записи для процесса расчёта: сделки и покупатели без
+    повторов кортежами полей, пары — их номерами подряд в array. Одна сделка
+    может попасть к нескольким покупателям, и расчёт меняет её на месте,
+    поэтому после распаковки такие записи снова ссылаются на один объект.
+    """
+    lead_positions: dict[int, int] = {}
+    customer_positions: dict[int, int] = {}
+    leads: list[tuple] = []
+    customers: list[tuple] = []
+    pairs = array("q")
+    for result in amo_results:
+        lead_position = lead_positions.get(id(result.lead_obj))
+        if lead_position is None:
+            lead_position = lead_positions[id(result.lead_obj)] = len(leads)
+            leads.append(_lead_record(result.lead_obj))
+        customer_position = customer_positions.get(id(result.customer_obj))
+        if customer_position is None:
+            customer_position = customer_positions[id(result.customer_obj)] = len(customers)
+            customers.append(_customer_record(result.customer_obj))
+        pairs.append(lead_position)
+        pairs.append(customer_position)
+    return leads, customers, pairs
+
+
+def unpack_amo_results(packed: tuple[list[tuple], list[tuple], array]) -> list[AmoResult]:
+    leads, customers, pairs = packed
+    lead_objs = [AmoLead(*lead) for lead in leads]
+    customer_objs = [AmoCustomers(*customer) for customer in customers]
+    return [
+        AmoResult(lead_obj=lead_objs[pairs[index]], customer_obj=customer_objs[pairs[index + 1]])
+        for index in range(0, len(pairs), 2)
+    ]
+
+
+def compute_leads_payload(
+    packed: tuple[list[tuple], list[tuple], array],
+    writeback_fields: tuple[str, ...] = (),
+) -> tuple[list[dict[str, Any]], dict[int, dict[str, Any]]]:
+    """
+    Расчёт аналитики по сделкам в процессе пула: метрики, строки для
+    Google Sheets и, если нужны, значения для записи в доп. поля сделок.
+    """
+    amo_results = compute_amo_result_metrics(unpack_amo_results(packed))
+    values = collect_analytics_values(amo_results, writeback_fields) if writeback_fields else {}
+    return build_leads_payload(amo_results), values
+
+
+def compute_customers_payload(
+    lead_records: list[tuple],
+    customer_records: list[tuple],
+    periods: list[BudgetPeriod] | None = None,
+    now: datetime.datetime | None = None,
+) -> list[dict[str, Any]]:
+    """Расчёт аналитики по покупателям в процессе пула."""
+    amo_results = build_amo_results_analize_customers(
+        leads=[AmoLead(*lead) for lead in lead_records],
+        customers=[AmoCustomers(*customer) for customer in customer_records],
+    )
+    return build_customers_analysis_payload(amo_results, periods, now)
+
+
+# С session_factory данные читаются из локального зеркала, которое перед этим
+# догружается изменениями из amoCRM; без него — напрямую из API.
+async def load_leads_and_customers(amo_api, session_factory=None):
+    if session_factory is None:
+        return await asyncio.gather(
+            amo_api.get_pipeline_1628622_status_142_leads(),
+            amo_api.get_customers_with_contacts(),
+        )
+
+    await refresh_amo_mirror(amo_api, session_factory, entities=("leads", "customers"))
+    return await asyncio.to_thread(load_analytics_data, session_factory)
+
+
+async def index_analytics_customers(amo_api, session_factory=None):
+    if session_factory is None:
+        customers_by_contact = {}
+        async for customers in amo_api.iter_customers():
+            index_customers_by_contact(customers, customers_by_contact)
+        return customers_by_contact
+
+    customers = await asyncio.to_thread(load_analytics_customers, session_factory)
+    return index_customers_by_contact(customers)
+
+
+async def iter_analytics_leads(amo_api, session_factory=None):
+    if session_factory is None:
+        async for leads in amo_api.iter_leads():
+            yield leads
+        return
+
+    after_id = None
+    while True:
+        leads = await asyncio.to_thread(
+            load_analytics_leads,
+            session_factory,
+            after_id,
+            MIRROR_LEADS_PAGE_SIZE,
+        )
+        if not leads:
+            return
+        yield leads
+        after_id = leads[-1].lead_id
+
+
+# Покупатели индексируются целиком, сделки идут страницами через join: в памяти
+# остаются только сопоставленные сделки. Чистый выкуп и время с прошлой покупки
+# зависят от порядка всех сделок покупателя, поэтому считаются после join.
+async def collect_matched_amo_results(amo_api, session_factory=None):
+    if session_factory is not None:
+        await refresh_amo_mirror(amo_api, session_factory, entities=("leads", "customers"))
+
+    customers_by_contact = await index_analytics_customers(amo_api, session_factory)
+    matched = []
+    leads_count = 0
+    async for leads in iter_analytics_leads(amo_api, session_factory):
+        leads_count += len(leads)
+        matched.extend(join_leads_with_customers(leads, customers_by_contact))
+    logger.info(
+        f"Analytics join finished: leads={leads_count}, contacts={len(customers_by_contact)}, "
+        f"matched={len(matched)}"
+    )
+    return matched
+
+
+async def build_streamed_amo_results(amo_api, session_factory=None):
+    return compute_amo_result_metrics(await collect_matched_amo_results(amo_api, session_factory))
+
+
+async def send_payload_to_sheets(google_sheets, rows, *, token: str, request_id: str, chunk_size: int = 0):
+    if chunk_size <= 0:
+        payload = list(rows)
+        response = await asyncio.to_thread(
+            google_sheets.send_json,
+            payload=payload,
+            token=token,
+            request_id=request_id,
+        )
+        return len(payload), response
+
+    sent = 0
+    response = None
+    for chunk, chunk_index, is_last in _iter_chunks(rows, chunk_size):
+        response = await asyncio.to_thread(
+            google_sheets.send_json,
+            payload=chunk,
+            token=token,
+            request_id=request_id,
+            chunk=chunk_index,
+            last=is_last,
+        )
+        sent += len(chunk)
+    return sent, response
+
+
+def _iter_chunks(rows, chunk_size: int):
+    rows = iter(rows)
+    chunk = [row for _, row in zip(range(chunk_size), rows)]
+    chunk_index = 0
+    while True:
+        next_chunk = [row for _, row in zip(range(chunk_size), rows)]
+        yield chunk, chunk_index, not next_chunk
+        if not next_chunk:
+            return
+        chunk = next_chunk
+        chunk_index += 1
+
+
 async def analyze_and_send_to_sheets(
         *,
         amo_api,
         google_sheets,
         token: str,
         request_id: str,
+        session_factory=None,
+        chunk_size: int = 0,
+        writeback_field_ids=None,
+        analytics_pool: AnalyticsPool | None = None,
 ) -> None:
     try:
         if google_sheets is None:
             logger.error("GOOGLE_SHEETS_WEBHOOK_URL is not configured")
             return
 
-        leads_list, customers_list = await asyncio.gather(
-            amo_api.get_pipeline_1628622_status_142_leads(),
-            amo_api.get_customers_with_contacts(),
-        )
+        # изменения сравниваются с прошлой записью в БД, поэтому без неё не пишем
+        writeback_field_ids = active_field_ids(writeback_field_ids or {}) if session_factory is not None else {}
+        matched = await collect_matched_amo_results(amo_api, session_factory)
+        if analytics_pool is None:
+            amo_results = compute_amo_result_metrics(matched)
+            rows = iter_leads_payload(amo_results)
+            writeback_values = None
+        else:
+            rows, writeback_values = await analytics_pool.run(
+                compute_leads_payload,
+                pack_amo_results(matched),
+                tuple(writeback_field_ids),
+            )
 
-        amo_results = build_amo_results(leads=leads_list, customers=customers_list)
-        payload = build_leads_payload(amo_results)
-
-        response = await asyncio.to_thread(
-            google_sheets.send_json,
-            payload=payload,
+        payload_count, response = await send_payload_to_sheets(
+            google_sheets,
+            rows,
             token=token,
             request_id=request_id,
+            chunk_size=chunk_size,
         )
 
         logger.info(
             f"Analyze request finished: request_id={request_id}, "
-            f"payload_count={len(payload)}, sheets_status={response.status_code}"
+            f"payload_count={payload_count}, sheets_status={response.status_code}"
         )
+
+        if not writeback_field_ids:
+            return
+        if writeback_values is None:
+            await write_back_analytics(amo_api, session_factory, amo_results, writeback_field_ids)
+        else:
+            await write_back_analytics_values(amo_api, session_factory, writeback_values, writeback_field_ids)
     except Exception as error:
         logger.exception(f"Analyze background task failed: request_id={request_id}, error={error}")
 
@@ -156,22 +368,30 @@ async def analyze_customers_and_send_to_sheets(
         google_sheets_customers,
         token: str,
         request_id: str,
+        session_factory=None,
+        budget_periods=None,
+        analytics_pool: AnalyticsPool | None = None,
 ) -> None:
     try:
         if google_sheets is None:
             logger.error("GOOGLE_SHEETS_WEBHOOK_URL is not configured")
             return
 
-        leads_list, customers_list = await asyncio.gather(
-            amo_api.get_pipeline_1628622_status_142_leads(),
-            amo_api.get_customers_with_contacts(),
-        )
+        leads_list, customers_list = await load_leads_and_customers(amo_api, session_factory)
 
-        amo_results = build_amo_results_analize_customers(
-            leads=leads_list,
-            customers=customers_list,
-        )
-        payload = build_customers_analysis_payload(amo_results)
+        if analytics_pool is None:
+            amo_results = build_amo_results_analize_customers(
+                leads=leads_list,
+                customers=customers_list,
+            )
+            payload = build_customers_analysis_payload(amo_results, budget_periods)
+        else:
+            payload = await analytics_pool.run(
+                compute_customers_payload,
+                pack_leads(leads_list),
+                pack_customers(customers_list),
+                budget_periods,
+            )
 
         response = await asyncio.to_thread(
             google_sheets_customers.send_json,
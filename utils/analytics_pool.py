@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import multiprocessing
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsPool:
+    """
+    Пул процессов для расчёта аналитики: join, метрики и сборка payload
+    занимают процессор на секунды и не должны держать цикл событий FastAPI.
+
+    Процессы запускаются при первом расчёте через spawn: fork процесса с
+    работающим циклом событий и потоками клиентов может унести в дочерний
+    процесс захваченные блокировки. Если процесс пула упал (например, по
+    памяти), пул пересоздаётся при следующем расчёте.
+    """
+
+    def __init__(self, workers: int = 1) -> None:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self._executor: ProcessPoolExecutor | None = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Выполняет func(*args) в процессе пула; func и аргументы должны сериализоваться pickle."""
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            logger.error("Analytics process pool is broken, it will be recreated")
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import datetime
+import re
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from decimal import Decimal
+from itertools import accumulate
+
+# Периоды по умолчанию — прежние пять окон clean_budjet_N
+DEFAULT_BUDGET_PERIODS = (
+    "clean_budjet_1=2023-07-01..2026-06-30;"
+    "clean_budjet_2=2024-07-01..2026-06-30;"
+    "clean_budjet_3=2025-07-01..2026-06-30;"
+    "clean_budjet_4=2026-01-01..2026-06-30;"
+    "clean_budjet_5=2026-04-01..2026-06-30"
+)
+
+_ROLLING_RE = re.compile(r"^(\d+)d$")
+
+
+@dataclass(frozen=True)
+class BudgetPeriod:
+    """
+    Окно суммирования бюджета покупателя, обе границы включительно.
+
+    Фиксированное окно задаётся датами start и end; если end не указан,
+    окно идёт до конца текущего дня. Скользящее окно (days) — последние
+    days дней, включая сегодняшний.
+    """
+
+    name: str
+    start: datetime.date | None = None
+    end: datetime.date | None = None
+    days: int | None = None
+
+    def bounds(self, today: datetime.date) -> tuple[datetime.datetime, datetime.datetime]:
+        if self.days is not None:
+            start = today - datetime.timedelta(days=self.days - 1)
+            end = today
+        else:
+            start = self.start
+            end = self.end or today
+        return (
+            datetime.datetime.combine(start, datetime.time.min),
+            datetime.datetime.combine(end, datetime.time(23, 59, 59)),
+        )
+
+
+def parse_budget_periods(spec: str | None) -> list[BudgetPeriod]:
+    """
+    Разбирает периоды вида ``имя=2025-07-01..2026-06-30`` (фиксированное окно),
+    ``имя=2026-01-01..`` (с даты до сегодня) и ``имя=90d`` (последние 90 дней),
+    разделённые ``;``. Пустая строка — периоды по умолчанию.
+    """
+    if not spec or not spec.strip():
+        spec = DEFAULT_BUDGET_PERIODS
+
+    periods: list[BudgetPeriod] = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        name, separator, value = (part.strip() for part in item.partition("="))
+        if not separator or not name or not value:
+            raise ValueError(f"Invalid budget period: {item!r}")
+        if name in {period.name for period in periods}:
+            raise ValueError(f"Duplicate budget period: {name!r}")
+
+        rolling = _ROLLING_RE.match(value)
+        if rolling:
+            days = int(rolling.group(1))
+            if days < 1:
+                raise ValueError(f"Budget period {name!r} must cover at least one day")
+            periods.append(BudgetPeriod(name=name, days=days))
+            continue
+
+        start_value, separator, end_value = value.partition("..")
+        if not separator:
+            raise ValueError(f"Invalid budget period: {item!r}")
+        try:
+            start = datetime.date.fromisoformat(start_value.strip())
+            end = datetime.date.fromisoformat(end_value.strip()) if end_value.strip() else None
+        except ValueError as error:
+            raise ValueError(f"Invalid budget period dates: {item!r}") from error
+        if end is not None and end < start:
+            raise ValueError(f"Budget period {name!r} ends before it starts")
+        periods.append(BudgetPeriod(name=name, start=start, end=end))
+    return periods
+
+
+def period_bounds(
+    periods: Iterable[BudgetPeriod],
+    now: datetime.datetime | None = None,
+) -> list[tuple[str, float, float]]:
+    """Границы окон в unix-времени (локальное время, как у datetime.fromtimestamp)."""
+    today = (now or datetime.datetime.now()).date()
+    result = []
+    for period in periods:
+        start_at, end_at = period.bounds(today)
+        result.append((period.name, start_at.timestamp(), end_at.timestamp()))
+    return result
+
+
+def sum_by_periods(
+    paid_prices: Iterable[tuple[float, Decimal]],
+    bounds: Sequence[tuple[str, float, float]],
+) -> dict[str, Decimal]:
+    """
+    Суммы цен по окнам. Оплаты сортируются по времени один раз и копятся
+    префиксными суммами, поэтому каждое окно — два бинарных поиска.
+    """
+    paid_prices = sorted(paid_prices, key=lambda item: item[0])
+    paid_at = [item[0] for item in paid_prices]
+    prefix = [Decimal("0"), *accumulate(item[1] for item in paid_prices)]
+    return {
+        name: prefix[bisect_right(paid_at, end_at)] - prefix[bisect_left(paid_at, start_at)]
+        for name, start_at, end_at in bounds
+    }
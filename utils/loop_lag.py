@@ -0,0 +1,47 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Задержка цикла событий: задача засыпает на interval секунд и меряет,
+    насколько позже срока проснулась. Всё, что дольше держит цикл синхронным
+    кодом, задерживает и её, и ответы остальных маршрутов. Задержка не меньше
+    warning секунд пишется в журнал; 0 — не писать.
+    """
+
+    def __init__(self, interval: float = 1.0, warning: float = 0.5) -> None:
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.interval = interval
+        self.warning = warning
+        self.reset()
+
+    def reset(self) -> None:
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def record(self, lag: float) -> None:
+        self.samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        if self.warning and lag >= self.warning:
+            logger.warning("Event loop lag %.3f s", lag)
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "samples": self.samples,
+            "max_lag": self.max_lag,
+            "mean_lag": self.total_lag / self.samples if self.samples else 0.0,
+        }
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - started_at - self.interval))
@@ -1,5 +1,6 @@
 import datetime
 import logging
+from collections.abc import Iterable
 
 from pydantic import json
 
@@ -95,22 +96,36 @@ def get_catalog_elements_from_lead(response: dict) -> dict[int, int | float]:
     return result
 
 
+def get_catalog_element_price(element: dict) -> int | float:
+    """Цена элемента каталога amoCRM из доп. поля PRICE / «Цена»; 0, если её нет."""
+    price_value = None
+    custom_fields = element.get('custom_fields_values') or []
+    for field in custom_fields:
+        field_code = field.get('field_code')
+        field_name = field.get('field_name')
+        if field_code == 'PRICE' or field_name == 'Цена':
+            values = field.get('values') or []
+            if values:
+                price_value = values[0].get('value')
+            break
+
+    price: int | float = 0
+    if price_value not in (None, ''):
+        try:
+            raw_price = float(str(price_value).replace(',', '.'))
+            price = int(raw_price) if raw_price.is_integer() else raw_price
+        except (TypeError, ValueError) as error:
+            logger.warning(f'Не удалось распарсить цену элемента: {element}, error={error}')
+    return price
+
+
 def get_items_to_kp(
         response: dict,
         catalog_elements: dict[int, int | float],
         discount: int
 ) -> list[dict[str, int | float | str]]:
-    items: list[dict[str, int | float | str]] = []
     elements = (response or {}).get('_embedded', {}).get('elements', [])
-    try:
-        discount_percent = float(discount)
-    except (TypeError, ValueError):
-        logger.warning(f'Некорректное значение скидки: {discount}. Используется 0%.')
-        discount_percent = 0.0
-
-    if discount_percent < 0:
-        discount_percent = 0.0
-
+    priced_elements: list[tuple[int, str, int | float]] = []
     for element in elements:
         name = element.get('name')
         if not name:
@@ -123,25 +138,28 @@ def get_items_to_kp(
             logger.warning(f'Некорректный id элемента каталога: {element}')
             continue
 
-        price_value = None
-        custom_fields = element.get('custom_fields_values') or []
-        for field in custom_fields:
-            field_code = field.get('field_code')
-            field_name = field.get('field_name')
-            if field_code == 'PRICE' or field_name == 'Цена':
-                values = field.get('values') or []
-                if values:
-                    price_value = values[0].get('value')
-                break
-
-        price: int | float = 0
-        if price_value not in (None, ''):
-            try:
-                raw_price = float(str(price_value).replace(',', '.'))
-                price = int(raw_price) if raw_price.is_integer() else raw_price
-            except (TypeError, ValueError) as error:
-                logger.warning(f'Не удалось распарсить цену элемента: {element}, error={error}')
+        priced_elements.append((element_id, name, get_catalog_element_price(element)))
+
+    return build_kp_items(priced_elements, catalog_elements, discount)
+
+
+def build_kp_items(
+        priced_elements: Iterable[tuple[int, str, int | float]],
+        catalog_elements: dict[int, int | float],
+        discount: int
+) -> list[dict[str, int | float | str]]:
+    """Строки КП из элементов каталога с уже известной ценой: (id, название, цена)."""
+    items: list[dict[str, int | float | str]] = []
+    try:
+        discount_percent = float(discount)
+    except (TypeError, ValueError):
+        logger.warning(f'Некорректное значение скидки: {discount}. Используется 0%.')
+        discount_percent = 0.0
+
+    if discount_percent < 0:
+        discount_percent = 0.0
 
+    for element_id, name, price in priced_elements:
         quantity_value = catalog_elements.get(element_id, 0)
         try:
             quantity_number = float(quantity_value)